@@ -0,0 +1,57 @@
+"""
+measures SqliteDb throughput with N concurrent writers, each one doing the same mix of writes a message does
+(save the message, update the session, save an asset)
+
+usage: python -m benchmarks.sqlite_writers --writers 1 4 16 --messages 500
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from cliobot.db.sqlite import SqliteDb
+
+
+def write(db, writer, messages):
+    user_id = f'user-{writer}'
+    db.create_or_get_chat_session(user_id)
+
+    for i in range(messages):
+        db.save_message(
+            user_id=user_id,
+            chat_id=user_id,
+            text=f'message {i}',
+            external_id=f'{writer}-{i}',
+        )
+        db.set_chat_context(user_id, {'last': i}, {})
+        if i % 10 == 0:
+            db.save_asset(f'{writer}-{i}', user_id, user_id, f'outputs/{writer}/{i}.png')
+            db.get_asset(f'{writer}-{i}', user_id, user_id)
+
+
+def run(writers, messages, pragmas=None):
+    with tempfile.TemporaryDirectory() as folder:
+        db = SqliteDb(os.path.join(folder, 'bench.db'), pragmas=pragmas)
+
+        threads = [threading.Thread(target=write, args=(db, w, messages)) for w in range(writers)]
+        started = time.perf_counter()
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        elapsed = time.perf_counter() - started
+
+        db.close()
+        return writers * messages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--messages', type=int, default=500, help='messages per writer')
+    parser.add_argument('--synchronous', default=None, help='override PRAGMA synchronous (eg FULL)')
+    args = parser.parse_args()
+
+    pragmas = {'synchronous': args.synchronous} if args.synchronous else None
+    print(f'{"writers":>8} {"messages/s":>12}')
+    for w in args.writers:
+        print(f'{w:>8} {run(w, args.messages, pragmas):>12.0f}')
@@ -1,14 +1,17 @@
 import asyncio
-import os
-import queue
 import threading
-import traceback
-from sys import exc_info
 from typing import Callable
 
+from cliobot.bots.dispatcher import Dispatcher, AsyncDispatcher
 from cliobot.cache import InMemoryCache
+from cliobot.cache.media_cache import MediaCache
+from cliobot.db import AsyncDatabase, async_database
 from cliobot.errors import BaseErrorHandler
+from cliobot.fetch import fetcher
 from cliobot.metrics import BaseMetrics
+from cliobot.storage import async_storage
+from cliobot.storage.archival import ArchivalQueue
+from cliobot.utils import abs_path
 
 
 class Message:
@@ -155,9 +158,9 @@ class CachedSession(Session):
             self.dirty = True
         return super().pop(key)
 
-    def persist(self, db):
+    async def persist(self, db: AsyncDatabase):
         if self.dirty:  # commit changes
-            db.set_chat_context(self.user_id, self.context, self.preferences)
+            await db.set_chat_context(self.user_id, self.context, self.preferences)
             self.dirty = False
 
     def set_preference(self, key, val):
@@ -176,8 +179,8 @@ class CachedSession(Session):
         super().clear(clear_user)
 
     @classmethod
-    def from_cache(cls, db, user_id, chat_id):
-        data = db.create_or_get_chat_session(user_id)
+    async def from_cache(cls, db: AsyncDatabase, user_id, chat_id):
+        data = await db.create_or_get_chat_session(user_id)
         return cls(
             chat_session=data,
             chat_id=chat_id,
@@ -185,44 +188,22 @@ class CachedSession(Session):
 
 class MessageHandler:
     """
-    base class for message handlers
+    base class for message handlers - dispatchers (see Dispatcher) hand them messages to handle
     """
-    def __init__(self):
-        self.running = True
-        self.sender_loop = None
 
     async def process(self, message: Message, session: CachedSession, bot):
         raise NotImplementedError
 
-    def listen(self, bot):
-        self.sender_loop = asyncio.new_event_loop()
-
-        asyncio.set_event_loop(self.sender_loop)
-        self.sender_loop.run_until_complete(self._poll(bot))
-
-    def stop(self):
-        self.running = False
-        self.sender_loop.stop()
-
-
-    async def _poll(self, bot):
-        while self.running:
-            try:
-                message = bot.internal_queue.get()
-                await self._handle_message(message, bot)
-            except (KeyboardInterrupt, SystemExit):
-                print("Shutting down...")
-                self.running = False
-                return
-            except Exception:
-                traceback.print_exc()
-                bot.metrics.capture_exception(exc_info(), 'anonymous')
-            finally:
-                bot.internal_queue.task_done()
+    def cost_class(self, message: Message):
+        """
+        how expensive handling this message is expected to be, used to pick a worker pool (see Dispatcher).
+        Called before the session is loaded, so it can only look at the message itself
+        """
+        return None
 
     async def _handle_message(self, message: Message, bot):
         print('on_message', message.__str__())
-        session = CachedSession.from_cache(
+        session = await CachedSession.from_cache(
             db=bot.db,
             user_id=message.user_id,
             chat_id=message.chat_id)
@@ -232,7 +213,7 @@ class MessageHandler:
         })
 
         try:
-            bot.db.save_message(
+            await bot.db.save_message(
                 user_id=message.user_id,
                 chat_id=message.chat_id,
                 text=message.text or '',
@@ -247,10 +228,11 @@ class MessageHandler:
             bot.metrics.capture_exception(e, session.user_id)
 
         if session.user_id is None:
-            session = bot.db.create_or_get_chat_session(message.user_id)
+            session = CachedSession(
+                chat_session=await bot.db.create_or_get_chat_session(message.user_id),
+                chat_id=message.chat_id,
+            )
             print(session)
-            session.chat_id = message.chat_id
-            session.user_id = session.get('external_user_id', None)
 
         if message.reply_to_message_id and not message.reply_to_message:
             print("Loading reply...")
@@ -263,12 +245,29 @@ class MessageHandler:
 
 class MessagingService:
 
+    @property
+    def media_cache(self) -> MediaCache:
+        # the default one is only built when needed - it scans its folder, and bots that never run don't need it
+        with self._media_cache_lock:
+            if self._media_cache is None:
+                self._media_cache = MediaCache(abs_path('cache'))
+            return self._media_cache
+
     async def initialize(self):
         raise NotImplementedError()
 
     async def get_file(self, file_id) -> (str, bytes):
         raise NotImplementedError()
 
+    async def download_file(self, file_id, out) -> str:
+        """
+        writes a file's contents into `out` (a file object) - as it's downloaded, if the platform allows it.
+        Returns its path
+        """
+        path, data = await self.get_file(file_id)
+        out.write(data)
+        return path
+
     async def get_message(self, message_id):
         raise NotImplementedError()
 
@@ -305,31 +304,49 @@ class BaseBot:
                  messaging_service: MessagingService,
                  db,
                  storage=None,
-                 internal_queue=None,
                  bot_id=None,
                  bot_language='en',
                  cache=None,
+                 results_cache=None,
+                 files_index=None,
+                 media_cache: MediaCache = None,
+                 archival: ArchivalQueue = None,
                  translator=None,
                  metrics=None,
+                 dispatcher: Dispatcher = None,
+                 clients=None,
                  ):
         self.messaging_service = messaging_service
-        self.internal_queue = internal_queue or queue.Queue()
         self.translator = translator
-        self.db = db
-        self.storage = storage
+        self.db: AsyncDatabase = async_database(db)
+        self.storage = async_storage(storage)
         self.bot_id = bot_id
         self.bot = None
         self.bot_language = bot_language
         self.cache = cache or InMemoryCache()
+        self.results_cache = results_cache  # for model results, see ModelBackedCommand.generate
+        self.files_index = files_index  # file_id -> local copy of the file, see cached_get_file
+        self._media_cache = media_cache
+        self._media_cache_lock = threading.Lock()
         self.metrics = metrics or BaseMetrics(BaseErrorHandler())
+        self.archival = archival  # generated outputs are stored through it, in the background
+        if self.archival is None and self.storage is not None:
+            self.archival = ArchivalQueue(self.storage, self.db, metrics=self.metrics)
+        # anything keeping connections around per event loop (eg the model clients), with an async close() for the
+        # current one - see close_clients
+        self.clients = [fetcher, *(clients or [])]
         self.models = {}
         self.handler_fn = handler_fn
+        self.dispatcher = dispatcher or AsyncDispatcher(handler_fn)
+        self.senders = self.dispatcher.handlers
 
-        self.senders = [handler_fn() for _ in range(int(os.cpu_count()))]
-
-        self.threads = [
-            threading.Thread(target=handler.listen, args=(self,), daemon=True) for handler in self.senders
-        ]
+    @property
+    def media_cache(self) -> MediaCache:
+        # the default one is only built when needed - it scans its folder, and bots that never run don't need it
+        with self._media_cache_lock:
+            if self._media_cache is None:
+                self._media_cache = MediaCache(abs_path('cache'))
+            return self._media_cache
 
     async def initialize(self):
         raise NotImplementedError()
@@ -341,14 +358,32 @@ class BaseBot:
         # initialize the bot commands list and stuff
         loop = asyncio.new_event_loop()
         loop.run_until_complete(self.initialize())
+        loop.run_until_complete(self.close_clients())
         loop.close()
 
         # start everything
-        [t.start() for t in self.threads]
+        self.media_cache.start()
+        self.dispatcher.start(self)
         print("Bot ready")
         self.start()
         print("blowing things up, stay calm...")
-        [s.stop() for s in self.senders]
+        self.dispatcher.stop()
+        if self.archival is not None:
+            self.archival.close()  # stores whatever is still pending, so it needs the db and storage around
+        if self.storage is not None:
+            self.storage.close()
+        self.db.close()
+        self.media_cache.close()
 
     async def enqueue(self, update):
-        self.internal_queue.put(update)
+        await self.dispatcher.submit(update)
+
+    async def close_clients(self):
+        """
+        closes the connections every client keeps for the current event loop - to be called before the loop is closed
+        """
+        for client in self.clients:
+            try:
+                await client.close()
+            except Exception as e:
+                print("Failed to close client:", e)
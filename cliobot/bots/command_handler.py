@@ -4,7 +4,7 @@ from sys import exc_info
 from typing import Optional
 
 from cliobot.bots import Message, CachedSession, MessageHandler
-from cliobot.commands import BaseCommand
+from cliobot.commands import BaseCommand, EXPENSIVE
 
 class CommandHandler(MessageHandler):
     """
@@ -36,11 +36,38 @@ class CommandHandler(MessageHandler):
         if update.reply_to_message_id and txt in self.reply_handlers:
             return self.command_handlers[txt]
 
-        if session.get('command'):
+        if session is not None and session.get('command'):
             return self.command_handlers[session.get('command')]
 
         return None
 
+    def fallback_command(self, message) -> Optional[str]:
+        if message.audio and 'audio' in self.fallback_commands:
+            return self.fallback_commands['audio']
+        elif message.video and 'video' in self.fallback_commands:
+            return self.fallback_commands['video']
+        elif message.voice and 'voice' in self.fallback_commands:
+            return self.fallback_commands['voice']
+        elif message.image and 'image' in self.fallback_commands:
+            return self.fallback_commands['image']
+        elif message.text and 'text' in self.fallback_commands:
+            return self.fallback_commands['text']
+        return None
+
+    def cost_class(self, message):
+        # the session isn't loaded yet, so commands pending on the session can't be seen here
+        try:
+            command = self.infer_command(message, None)
+        except KeyError:  # unknown command, will be dealt with later on
+            command = None
+
+        if command is None:
+            command = self.command_handlers.get(self.fallback_command(message))
+
+        if command is None:
+            return EXPENSIVE  # could be anything
+        return command.cost
+
     async def exec(self, command: BaseCommand, update: Message, session: CachedSession, bot):
         try:
             if await command.process(update, session, bot):
@@ -49,7 +76,7 @@ class CommandHandler(MessageHandler):
             traceback.print_exc()
             bot.metrics.capture_exception(exc_info(), session.user_id)
         finally:
-            session.persist(bot.db)
+            await session.persist(bot.db)
 
     async def process(self, message: Message, session: CachedSession, bot):
         inf = self.infer_command(message, session)
@@ -72,19 +99,7 @@ class CommandHandler(MessageHandler):
                 }
             )
 
-            if message.audio and 'audio' in self.fallback_commands:
-                fallback = self.fallback_commands['audio']
-            elif message.video and 'video' in self.fallback_commands:
-                fallback = self.fallback_commands['video']
-            elif message.voice and 'voice' in self.fallback_commands:
-                fallback = self.fallback_commands['voice']
-            elif message.image and 'image' in self.fallback_commands:
-                fallback = self.fallback_commands['image']
-            elif message.text and 'text' in self.fallback_commands:
-                fallback = self.fallback_commands['text']
-            else:
-                fallback = None
-
+            fallback = self.fallback_command(message)
             if fallback in self.command_handlers:
                 message.text = f'/{fallback} {message.text}'.strip()
                 await self.exec(self.command_handlers[fallback], message, session, bot)
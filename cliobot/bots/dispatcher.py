@@ -0,0 +1,337 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import traceback
+from sys import exc_info
+
+from i18n import t
+
+
+DEFAULT_POOL = 'default'
+
+STOP = object()  # queued behind everything else to stop a worker
+
+
+def session_key(message):
+    # sessions are stored per user, so that's what has to be serialized
+    if message.user_id is not None:
+        return message.user_id
+    return message.chat_id
+
+
+class ShardedQueue:
+    """
+    a set of FIFO queues, with every message routed to a fixed shard based on its session key (see session_key).
+
+    Messages from different users are spread across shards and can be handled in parallel, while messages from
+    the same user always land on the same shard and get handled in order, one at a time
+    """
+
+    def __init__(self, shards, queue_factory=queue.Queue, key_fn=session_key):
+        self.shards = [queue_factory() for _ in range(int(shards))]
+        self.key_fn = key_fn
+
+    def shard_for(self, message) -> int:
+        return hash(self.key_fn(message)) % len(self.shards)
+
+    def shard(self, idx):
+        return self.shards[idx]
+
+    def put_nowait(self, message):
+        self.shards[self.shard_for(message)].put_nowait(message)
+
+    def qsize(self):
+        return sum([q.qsize() for q in self.shards])
+
+
+class Dispatcher:
+    """
+    base class for dispatchers. A dispatcher takes the messages enqueued by the bot and hands them over to
+    message handlers (see MessageHandler).
+
+    Messages are split into worker pools by cost class (see MessageHandler.cost_class), so cheap commands don't wait
+    behind long-running ones. Messages whose class doesn't have a pool of its own go to the default pool. While a user
+    has messages queued or being handled, their new ones follow them to the same pool regardless of cost - so messages
+    from the same user are always handled in order, one at a time, and never race on their session.
+
+    Dispatchers also do admission control: messages over the per-user rate limit, messages that don't fit in the
+    queue and messages that waited in the queue for longer than `max_queue_wait` seconds are answered with a
+    "busy, try again" message instead of being processed. `max_queue_size` bounds the messages waiting across every
+    pool and shard, so a busy user can fill up what others leave unused.
+    """
+
+    def __init__(self, handler_fn, default_pool_size, pools=None, max_queue_size=0, max_queue_wait=None,
+                 rate_limiter=None):
+        self.handler_fn = handler_fn
+        self.handlers = []
+        self.pools = {
+            DEFAULT_POOL: int(default_pool_size),
+            **{k: int(v) for k, v in (pools or {}).items()},
+        }
+        self.max_queue_size = max_queue_size or 0
+        self.max_queue_wait = max_queue_wait
+        self.rate_limiter = rate_limiter
+        self.bot = None
+        self.in_flight = {}  # session key -> (pool, messages queued or being handled)
+        self.queued = 0  # messages waiting for a worker, on every pool
+        self.in_flight_lock = threading.Lock()
+
+    def start(self, bot):
+        raise NotImplementedError()
+
+    def stop(self):
+        raise NotImplementedError()
+
+    async def submit(self, message):
+        if self.rate_limiter and not self.rate_limiter.allow(session_key(message)):
+            return await self.reject(message, 'rate_limited')
+
+        message.metadata['enqueued_at'] = time.monotonic()
+        if not await self._offer(message):
+            return await self.reject(message, 'queue_full')
+
+    async def _offer(self, message) -> bool:
+        """
+        add the message to the queue, returning False if there's no room for it
+        """
+        raise NotImplementedError()
+
+    def pool_for(self, message):
+        pool = self.handlers[0].cost_class(message)
+        if pool in self.pools:
+            return pool
+        return DEFAULT_POOL
+
+    def _assign(self, message):
+        """
+        the pool a message goes to - the one the user's other messages are on, if they have any in flight - or None
+        when the queue is full. Every assigned message must be released (see _release) once it's handled or rejected
+        """
+        key = session_key(message)
+        with self.in_flight_lock:
+            if self.max_queue_size and self.queued >= self.max_queue_size:
+                return None
+            self.queued += 1
+
+            pool, count = self.in_flight.get(key, (None, 0))
+            if pool is None:
+                pool = self.pool_for(message)
+            self.in_flight[key] = (pool, count + 1)
+            return pool
+
+    def _release(self, message):
+        key = session_key(message)
+        with self.in_flight_lock:
+            pool, count = self.in_flight[key]
+            if count <= 1:
+                del self.in_flight[key]
+            else:
+                self.in_flight[key] = (pool, count - 1)
+
+    async def dispatch(self, handler, message, pool):
+        with self.in_flight_lock:  # out of the queue
+            self.queued -= 1
+
+        try:
+            waited = time.monotonic() - message.metadata.pop('enqueued_at', time.monotonic())
+            self.bot.metrics.timing(f'queue_wait.{pool}', waited)
+
+            if self.max_queue_wait and waited > self.max_queue_wait:
+                return await self.reject(message, 'deadline')
+
+            try:
+                await handler._handle_message(message, self.bot)
+            except Exception:
+                traceback.print_exc()
+                self.bot.metrics.capture_exception(exc_info(), 'anonymous')
+        finally:
+            self._release(message)
+
+    async def reject(self, message, reason):
+        bot = self.bot
+        bot.metrics.increment(f'rejected.{reason}')
+        bot.metrics.send_event(
+            event="message_rejected",
+            user_id=message.user_id,
+            params={
+                'reason': reason,
+                'chat_id': message.chat_id,
+            }
+        )
+
+        try:
+            await bot.messaging_service.send_message(
+                text=t('errors.busy', locale=getattr(message.user, 'language', None) or bot.bot_language),
+                chat_id=message.chat_id,
+                reply_to_message_id=message.message_id,
+            )
+        except Exception as e:
+            bot.metrics.capture_exception(e, message.user_id)
+
+
+class ThreadedDispatcher(Dispatcher):
+    """
+    one blocking worker thread per handler - each thread has its own event loop and handles a single message at a time,
+    consuming its own shard of its pool's queue.
+
+    On stop(), workers handle what's already queued before exiting - waiting up to `shutdown_timeout` seconds for them.
+    """
+
+    def __init__(self, handler_fn, workers=None, shutdown_timeout=10, **kwargs):
+        super().__init__(handler_fn, workers or os.cpu_count(), **kwargs)
+        self.shutdown_timeout = shutdown_timeout
+        self.queues = {
+            pool: ShardedQueue(size, queue.Queue)
+            for pool, size in self.pools.items()
+        }
+        self.workers = [
+            (handler_fn(), pool, q.shard(i))
+            for pool, q in self.queues.items()
+            for i in range(len(q.shards))
+        ]
+        self.handlers = [h for h, _, _ in self.workers]
+        self.threads = []
+        self.running = True
+
+    def start(self, bot):
+        self.bot = bot
+        self.threads = [
+            threading.Thread(target=self._listen, args=worker, daemon=True)
+            for worker in self.workers
+        ]
+        [t.start() for t in self.threads]
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for _, _, shard in self.workers:
+            shard.put(STOP)
+        for t in self.threads:
+            t.join(max(deadline - time.monotonic(), 0))
+
+    async def _offer(self, message) -> bool:
+        if not self.running:
+            return False
+        pool = self._assign(message)
+        if pool is None:
+            return False
+        self.queues[pool].put_nowait(message)
+        return True
+
+    def _listen(self, handler, pool, shard):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._poll(handler, pool, shard))
+        finally:
+            loop.run_until_complete(self.bot.close_clients())
+            loop.close()
+
+    async def _poll(self, handler, pool, shard):
+        while True:
+            message = shard.get()
+            if message is STOP:
+                shard.task_done()
+                return
+            try:
+                await self.dispatch(handler, message, pool)
+            finally:
+                shard.task_done()
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    a single event loop (on its own thread) and a sharded asyncio.Queue per pool, with up to `concurrency` messages in
+    flight at once on the default pool (one per shard), plus whatever the other pools allow.
+
+    Since handling a message is mostly waiting on a remote API, a single loop can keep hundreds of generations going.
+    """
+
+    def __init__(self, handler_fn, concurrency=200, shutdown_timeout=10, **kwargs):
+        super().__init__(handler_fn, concurrency, **kwargs)
+        self.shutdown_timeout = shutdown_timeout
+        self.handler = handler_fn()  # handlers are stateless, so all workers share one
+        self.handlers = [self.handler]
+        self.loop = None
+        self.queues = {}
+        self.thread = None
+        self._ready = threading.Event()
+        self._stopping = None
+
+    def start(self, bot):
+        self.bot = bot
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        self.loop.call_soon_threadsafe(self._stopping.set)
+        self.thread.join(self.shutdown_timeout + 1)
+
+    async def _offer(self, message) -> bool:
+        # the queue belongs to the dispatcher loop, which is usually not the one we're called from
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._put(message), self.loop))
+
+    async def _put(self, message) -> bool:
+        pool = self._assign(message)
+        if pool is None:
+            return False
+        self.queues[pool].put_nowait(message)
+        return True
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    async def _serve(self):
+        self.queues = {
+            pool: ShardedQueue(size, asyncio.Queue)
+            for pool, size in self.pools.items()
+        }
+        self._stopping = asyncio.Event()
+
+        try:
+            # initialize the messaging client before spawning the workers, so they all share the same one
+            await self.bot.messaging_service.initialize()
+        except Exception:
+            traceback.print_exc()
+
+        workers = [
+            asyncio.create_task(self._work(pool, q.shard(i)))
+            for pool, q in self.queues.items()
+            for i in range(len(q.shards))
+        ]
+        self._ready.set()
+
+        await self._stopping.wait()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[shard.join() for q in self.queues.values() for shard in q.shards]),
+                self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropping {sum([q.qsize() for q in self.queues.values()])} pending messages")
+
+        [w.cancel() for w in workers]
+        await asyncio.gather(*workers, return_exceptions=True)
+        await self.bot.close_clients()
+
+    async def _work(self, pool, shard):
+        while True:
+            message = await shard.get()
+            try:
+                await self.dispatch(self.handler, message, pool)
+            finally:
+                shard.task_done()
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class TokenBucket:
+    """
+    classic token bucket: holds up to `burst` tokens, refilled at `rate` tokens per second
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None) -> bool:
+        now = now or time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    one token bucket per key (eg a user id). Only the most recently seen `max_keys` buckets are kept around
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[key] = bucket
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+
+            return bucket.take()
+
+
+class ConcurrencyLimit:
+    """
+    caps how many calls (eg to a provider) can run at once, across every event loop - use `async with` around each
+    call. Calls over the limit wait for a slot, first come first served
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = deque()  # (loop, future) for each call waiting for a slot
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.running < self.limit and len(self.waiting) == 0:
+                self.running += 1
+                return
+            waiter = (loop, loop.create_future())
+            self.waiting.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiting:
+                    self.waiting.remove(waiter)
+                    raise
+            self.release()  # got a slot handed over right as it was cancelled, pass it on
+            raise
+
+    def release(self):
+        with self.lock:
+            while len(self.waiting) > 0:
+                loop, fut = self.waiting.popleft()
+                try:  # the slot goes straight to the next in line
+                    loop.call_soon_threadsafe(self._wake, fut)
+                    return
+                except RuntimeError:  # its loop is gone
+                    continue
+            self.running -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *args):
+        self.release()
+
+    @staticmethod
+    def _wake(fut):
+        if not fut.done():
+            fut.set_result(None)
+
+
+class ThrottledEditor:
+    """
+    keeps a message up to date with a changing value (eg a streamed answer, a preview image), editing it at most
+    once every `interval` seconds - updates in between are merged, only the latest one gets sent.
+
+    `edit` is an async function taking the value to show. update() never waits on it - a failed edit is only reported
+    by close(), when it's the last one.
+    """
+
+    def __init__(self, edit, interval=1.5):
+        self.edit = edit
+        self.interval = interval
+        self.latest = None
+        self.shown = None
+        self.edits = 0
+        self.error = None  # why the latest edit failed, if it did
+        self.editing = False
+        self.changed = asyncio.Event()
+        self.closed = False
+        self.task = None
+
+    def update(self, value):
+        self.latest = value
+        self.changed.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self, flush=True):
+        """
+        waits for the latest value to be shown, raising why it couldn't be if that edit failed - or, without `flush`,
+        only for the edit in progress (if any)
+        """
+        self.closed = True
+        if self.task is None:
+            return
+
+        if not flush:
+            self.latest = self.shown
+            if not self.editing:
+                self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            return
+
+        self.changed.set()
+        await self.task
+        if self.latest != self.shown and self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+
+            if self.latest != self.shown:
+                value = self.latest
+                self.editing = True
+                try:
+                    await self.edit(value)
+                    self.shown = value
+                    self.edits += 1
+                    self.error = None
+                except Exception as e:  # the next edit may go through - close() raises it if none does
+                    print("Failed to edit message:", e)
+                    self.error = e
+                finally:
+                    self.editing = False
+
+            if self.closed:
+                return
+            await asyncio.sleep(self.interval)
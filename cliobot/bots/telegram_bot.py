@@ -1,4 +1,5 @@
-import contextvars
+import asyncio
+import weakref
 from pathlib import Path
 
 import httpcore
@@ -12,7 +13,9 @@ from telegram.ext import ApplicationBuilder, ConversationHandler, MessageHandler
 
 from cliobot.bots import Message, User, MessagingService, BaseBot
 from cliobot.bots.command_handler import CommandHandler
+from cliobot.db import async_database
 from cliobot.errors import TransientFailure, UserBlocked, UnknownError, MessageNoLongerExists, MessageNotModifiable
+from cliobot.fetch import fetch
 from cliobot.utils import flatten
 
 
@@ -20,6 +23,11 @@ def telegram_bot_id(apikey):
     return apikey.split(':')[0]
 
 
+def reply_owner(chat_id, session=None):
+    # whose conversation a bot reply belongs to - on private chats, the chat id is the user's id
+    return session.user_id if session is not None and session.user_id else chat_id
+
+
 def convert_exceptions(func):
     async def wrapper(*args, **kwargs):
         try:
@@ -62,11 +70,11 @@ def convert_exceptions(func):
 def convert_media(media):
     if 'image' in media:
         path = media['image']
-        if path.startswith('/'):
+        if isinstance(path, str) and path.startswith('/'):
             path = Path(path)
 
         return InputMediaPhoto(
-            media=media['image'],
+            media=path,
             filename=media.get('filename', None),
             caption=media.get('text', None))
     elif 'attachment' in media:
@@ -117,23 +125,25 @@ def parse_callback_string(callback_data):
     return {}
 
 
-threadlocal_bot = contextvars.ContextVar("bot_instance", default=None)
-
-
 class TelegramMessagingService(MessagingService):
     def __init__(self, apikey, db):
         self.apikey = apikey
         self.bot_id = telegram_bot_id(apikey)
         self.db = db
+        # one client per event loop, since they can't be shared across loops - and whoever calls us on a loop (eg
+        # the polling loop, answering busy replies) gets the same one
+        self.bots = weakref.WeakKeyDictionary()
 
     async def initialize(self) -> Bot:
-        if not threadlocal_bot.get():
-            threadlocal_bot.set(Bot(self.apikey))
+        loop = asyncio.get_running_loop()
+        bot = self.bots.get(loop)
+        if bot is None:
+            bot = self.bots[loop] = Bot(self.apikey)
 
-        if not threadlocal_bot.get()._initialized:
-            await threadlocal_bot.get().initialize()
+        if not bot._initialized:
+            await bot.initialize()
 
-        return threadlocal_bot.get()
+        return bot
 
     @convert_exceptions
     @retry(TimedOut, tries=2, delay=0.5)
@@ -144,6 +154,15 @@ class TelegramMessagingService(MessagingService):
 
         return file.file_path, bytesdata
 
+    @convert_exceptions
+    @retry(TimedOut, tries=2, delay=0.5)
+    async def download_file(self, file_id, out):
+        bot = await self.initialize()
+        file = await bot.get_file(file_id)
+        await fetch(file.file_path, out)  # a full url (or a local path, on a local bot api server)
+
+        return file.file_path
+
     @convert_exceptions
     @retry(TimedOut, tries=2, delay=0.5)
     async def get_file_info(self, file_id):
@@ -200,13 +219,14 @@ class TelegramMessagingService(MessagingService):
             reply_markup=reply_markup(reply_buttons) or buttons_markup(buttons),
         )
 
-        self.db.save_message(
+        await self.db.save_message(
             user_id=self.bot_id,
             chat_id=chat_id,
             text=text or '',
             external_id=res.id,
             image=res.photo[-1].file_id,
             is_forward=False,
+            owner_id=reply_owner(chat_id, session),
         )
 
         return res
@@ -238,12 +258,13 @@ class TelegramMessagingService(MessagingService):
             reply_markup=reply_markup(reply_buttons) or buttons_markup(buttons),
         )
 
-        self.db.save_message(
+        await self.db.save_message(
             user_id=self.bot_id,
             chat_id=chat_id,
             text=text or '',
             external_id=res.id,
             is_forward=False,
+            owner_id=reply_owner(chat_id, session),
         )
 
         return res
@@ -314,6 +335,7 @@ class TelegramBot(BaseBot):
                  ):
         self.apikey = apikey
         self.app = ApplicationBuilder().token(apikey).build()
+        db = async_database(db)
 
         super().__init__(
             db=db,
@@ -0,0 +1,264 @@
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls for the same key: while a call is in flight, callers asking for the same key wait for
+    it and get the same result (or exception) instead of starting a call of their own.
+
+    Works across event loops (eg the ThreadedDispatcher's workers), with the call running on the loop of whoever
+    asked first. If that caller gets cancelled, the ones waiting start over instead of failing along with it.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> concurrent.futures.Future
+        self.lock = threading.Lock()
+
+    async def do(self, key, fn):
+        while True:
+            with self.lock:
+                fut = self.calls.get(key)
+                if fut is None:
+                    fut = self.calls[key] = concurrent.futures.Future()
+                    break
+
+            waiter = asyncio.wrap_future(fut)
+            # unlike awaiting it, this only raises CancelledError when we're the ones being cancelled - and leaves the
+            # call alone when we are
+            await asyncio.wait([waiter])
+            if not waiter.cancelled():
+                return waiter.result()
+
+        try:
+            res = await fn()
+        except BaseException as e:
+            self._done(key)
+            if isinstance(e, Exception):
+                fut.set_exception(e)
+            else:  # cancelled - someone else will take over
+                fut.cancel()
+            raise
+
+        self._done(key)
+        fut.set_result(res)
+        return res
+
+    def in_flight(self):
+        return len(self.calls)
+
+    def _done(self, key):
+        # forgotten before it resolves, so late callers never see a cancelled call and start a new one instead
+        with self.lock:
+            del self.calls[key]
+
+
+class Cache:
+    """
+    base class for caches. Values are stored with an optional ttl (in seconds)
+    """
+
+    def __init__(self, name='cache', metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.singleflight = SingleFlight()
+
+    def get(self, key, default=None):
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def aset(self, key, value, ttl=None):
+        self.set(key, value, ttl)
+
+    async def get_or_compute(self, key, fn, ttl=None):
+        """
+        return the cached value for key, or await fn() to compute (and cache) it. Concurrent calls for the same
+        missing key only run fn once.
+        """
+        res = await self.aget(key, MISSING)
+        if res is not MISSING:
+            return res
+
+        async def compute():
+            value = await fn()
+            await self.aset(key, value, ttl)
+            return value
+
+        return await self.singleflight.do(key, compute)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0,
+        }
+
+    def _count(self, metric, value=1):
+        setattr(self, metric, getattr(self, metric) + value)
+        if self.metrics:
+            self.metrics.increment(f'{self.name}.{metric}', value)
+
+
+def sizeof(value):
+    """
+    roughly how much memory value takes, including whatever it holds - eg the images in a GenerationResults, which
+    sys.getsizeof alone would count as a few pointers
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    if hasattr(value, '__dict__'):  # eg pydantic models
+        return sys.getsizeof(value) + sizeof(vars(value))
+    return sys.getsizeof(value)
+
+
+class InMemoryCache(Cache):
+    """
+    in-process cache, evicting the least recently used entries once it holds more than `max_items` entries or more
+    than `max_bytes` worth of values (as measured by `size_fn`)
+    """
+
+    def __init__(self, max_items=10000, max_bytes=None, ttl=None, size_fn=sizeof, name='cache', metrics=None):
+        super().__init__(name, metrics)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_fn = size_fn
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self._count('misses')
+                return default
+
+            self.entries.move_to_end(key)
+            self._count('hits')
+            return entry[2]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        size = self.size_fn(value)
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (time.monotonic() + ttl if ttl else None, size, value)
+            self.size += size
+
+            while len(self.entries) > 1 and (
+                    (self.max_items and len(self.entries) > self.max_items) or
+                    (self.max_bytes and self.size > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+                self._count('evictions')
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            'items': len(self.entries),
+            'bytes': self.size,
+        }
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+
+class TieredCache(Cache):
+    """
+    a stack of caches, fastest (and smallest) first - eg memory in front of disk. Reads go down the tiers until
+    one has the key, copying it into the faster ones on the way back. Writes go to every tier.
+    """
+
+    def __init__(self, tiers: list[Cache], name='cache', metrics=None):
+        super().__init__(name, metrics)
+        self.tiers = tiers
+
+    def get(self, key, default=None):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key, MISSING)
+            if value is not MISSING:
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                self._count('hits')
+                return value
+
+        self._count('misses')
+        return default
+
+    def set(self, key, value, ttl=None):
+        for tier in self.tiers:
+            tier.set(key, value, ttl)
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    async def aget(self, key, default=None):
+        for i, tier in enumerate(self.tiers):
+            value = await tier.aget(key, MISSING)
+            if value is not MISSING:
+                for faster in self.tiers[:i]:
+                    await faster.aset(key, value)
+                self._count('hits')
+                return value
+
+        self._count('misses')
+        return default
+
+    async def aset(self, key, value, ttl=None):
+        for tier in self.tiers:
+            await tier.aset(key, value, ttl)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            'tiers': [tier.stats() for tier in self.tiers],
+        }
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from cliobot.cache import Cache
+
+
+class DiskCache(Cache):
+    """
+    cache keeping each (pickled) value on its own file under `folder` - slower than memory, but much bigger, and it
+    survives restarts.
+
+    Holds up to `max_bytes`, evicting the least recently used files beyond that (a file's mtime is bumped whenever
+    it's read). Writes go to a temp file renamed into place, so readers never see half written values.
+    """
+
+    def __init__(self, folder, max_bytes=1024 ** 3, ttl=None, name='disk_cache', metrics=None):
+        super().__init__(name, metrics)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # filename -> size, least recently used first
+        self.size = 0
+
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for f in os.scandir(folder):
+            if f.is_file() and not f.name.startswith('.'):
+                st = f.stat()
+                entries.append((st.st_mtime, f.name, st.st_size))
+        for _, filename, size in sorted(entries):
+            self.files[filename] = size
+            self.size += size
+
+    def get(self, key, default=None):
+        filename = self._filename(key)
+        path = os.path.join(self.folder, filename)
+        try:
+            with open(path, 'rb') as f:
+                expires_at, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self._count('misses')
+            return default
+
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            self._count('misses')
+            return default
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # evicted in the meantime, the value is still good
+            pass
+        with self.lock:
+            if filename in self.files:
+                self.files.move_to_end(filename)
+
+        self._count('hits')
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        data = pickle.dumps((time.time() + ttl if ttl else None, value))
+        filename = self._filename(key)
+
+        fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(self.folder, filename))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        with self.lock:
+            self.size += len(data) - self.files.pop(filename, 0)
+            self.files[filename] = len(data)
+
+            while len(self.files) > 1 and self.size > self.max_bytes:
+                oldest, size = self.files.popitem(last=False)
+                self.size -= size
+                self._unlink(oldest)
+                self._count('evictions')
+
+    def delete(self, key):
+        filename = self._filename(key)
+        with self.lock:
+            self.size -= self.files.pop(filename, 0)
+        self._unlink(filename)
+
+    def clear(self):
+        with self.lock:
+            for filename in self.files:
+                self._unlink(filename)
+            self.files.clear()
+            self.size = 0
+
+    async def aget(self, key, default=None):
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def aset(self, key, value, ttl=None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            'items': len(self.files),
+            'bytes': self.size,
+        }
+
+    def _filename(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(os.path.join(self.folder, filename))
+        except FileNotFoundError:
+            pass
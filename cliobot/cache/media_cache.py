@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from cliobot.cache import Cache
+
+TEMP_PREFIX = '.tmp-'
+
+# temp files older than this (in seconds) were left behind by a crashed writer
+STALE_TEMP_FILE = 3600
+
+# evictions go down to this fraction of the quota, so the next few writes don't trigger another round
+EVICT_TO = 0.9
+
+
+class MediaCache(Cache):
+    """
+    files downloaded for commands (eg attachments), kept under `folder` and keyed by their path relative to it -
+    set() takes a file's contents, get() returns the path to it.
+
+    Holds up to `max_bytes`: once start()ed, a janitor thread evicts the least recently accessed files (by atime, bumped
+    on every get) every `janitor_interval` seconds, or right away once writes go over the quota - until then, writes
+    over the quota evict inline. Files are written to a temp
+    file renamed into place, so other workers (or processes) never read half written files.
+    """
+
+    def __init__(self, folder, max_bytes=1024 ** 3, janitor_interval=300, name='media_cache', metrics=None):
+        super().__init__(name, metrics)
+        self.folder = os.path.abspath(folder)
+        self.max_bytes = max_bytes
+        self.janitor_interval = janitor_interval
+
+        self.items, self.size = 0, 0
+        for _, _, size in self._files():
+            self.items += 1
+            self.size += size
+
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.janitor = None
+
+    def start(self):
+        """
+        starts the janitor thread (without a `janitor_interval`, there's none) - until close()
+        """
+        with self.cond:
+            if not self.janitor_interval or self.janitor is not None or self.stopped:
+                return
+            self.janitor = threading.Thread(target=self._collect_periodically, daemon=True)
+            self.janitor.start()
+
+    def path(self, key) -> Path:
+        path = os.path.normpath(os.path.join(self.folder, key))
+        if not path.startswith(self.folder + os.sep):
+            raise ValueError(f'Invalid media cache key: {key}')
+        return Path(path)
+
+    def get(self, key, default=None):
+        path = self.path(key)
+        try:
+            st = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))  # atime is what evictions go by
+        except FileNotFoundError:
+            self._count('misses')
+            return default
+
+        self._count('hits')
+        return path
+
+    def set(self, key, value, ttl=None):
+        with self.writer(key) as f:
+            f.write(value)
+        return self.path(key)
+
+    @contextmanager
+    def writer(self, key):
+        """
+        a file to write the contents of `key` into, bit by bit - it only shows up on the cache once the block exits
+        without errors
+        """
+        path = self.path(key)
+        os.makedirs(path.parent, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+                size = f.tell()
+            previous = file_size(path)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self._added(size, previous)
+
+    def delete(self, key):
+        path = self.path(key)
+        size = file_size(path)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        if size is not None:
+            with self.cond:
+                self.items -= 1
+                self.size -= size
+
+    def clear(self):
+        with self.cond:
+            if not os.path.isdir(self.folder):
+                return
+            for f in os.scandir(self.folder):
+                if f.is_dir():
+                    shutil.rmtree(f.path, ignore_errors=True)
+                else:
+                    os.unlink(f.path)
+            self.items, self.size = 0, 0
+
+    def collect(self):
+        """
+        evicts the least recently accessed files until the cache is back under its quota - and cleans up temp files
+        left behind by crashed writers
+        """
+        files = sorted(self._files(cleanup=True))
+        size = sum(s for _, _, s in files)
+
+        evicted = 0
+        if size > self.max_bytes:
+            for _, path, file_size in files:
+                if size <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:  # someone else got to it
+                    pass
+                size -= file_size
+                evicted += 1
+
+        with self.cond:
+            self.items, self.size = len(files) - evicted, size
+        if evicted > 0:
+            self._count('evictions', evicted)
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.janitor is not None:
+            self.janitor.join()
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            'items': self.items,
+            'bytes': self.size,
+        }
+
+    def _added(self, size, replaced=None):
+        with self.cond:
+            if replaced is None:
+                self.items += 1
+                self.size += size
+            else:  # overwrote what was there
+                self.size += size - replaced
+            if self.size <= self.max_bytes:
+                return
+            if self.janitor is not None:
+                self.cond.notify()
+                return
+        self.collect()
+
+    def _files(self, cleanup=False):
+        """
+        (atime, path, size) of every file in the cache
+        """
+        now = time.time()
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    if name.startswith(TEMP_PREFIX):
+                        if cleanup and now - st.st_mtime > STALE_TEMP_FILE:
+                            os.unlink(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                yield st.st_atime, path, st.st_size
+
+    def _collect_periodically(self):
+        while True:
+            with self.cond:
+                if not self.stopped and self.size <= self.max_bytes:
+                    self.cond.wait(self.janitor_interval)
+                if self.stopped:
+                    return
+
+            try:
+                self.collect()
+            except Exception as e:
+                print("Failed to clean up the media cache:", e)
+                with self.cond:  # don't spin on a broken disk
+                    if not self.stopped:
+                        self.cond.wait(self.janitor_interval)
+
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
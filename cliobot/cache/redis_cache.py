@@ -0,0 +1,61 @@
+import asyncio
+import pickle
+
+import redis
+
+from cliobot.cache import Cache
+
+
+class RedisCache(Cache):
+    """
+    cache backed by redis (or anything speaking its protocol), shared by every bot process pointing at it.
+
+    Values are pickled. Memory bounds and eviction are up to the server - configure it with `maxmemory` and an
+    LRU `maxmemory-policy` (eg allkeys-lru). Evictions reported by stats() are the server-wide count.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='cliobot:', ttl=None, client=None, name='cache',
+                 metrics=None):
+        super().__init__(name, metrics)
+        self.client = client or redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            self._count('misses')
+            return default
+
+        self._count('hits')
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self.client.set(
+            self.prefix + key,
+            pickle.dumps(value),
+            px=int(ttl * 1000) if ttl else None,
+        )
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if len(keys) > 0:
+            self.client.delete(*keys)
+
+    async def aget(self, key, default=None):
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def aset(self, key, value, ttl=None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def stats(self) -> dict:
+        res = super().stats()
+        try:
+            res['evictions'] = self.client.info('stats').get('evicted_keys', 0)
+        except redis.ResponseError:  # not every server speaking the protocol supports INFO
+            pass
+        return res
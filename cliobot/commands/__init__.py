@@ -1,7 +1,18 @@
-from typing import List, Optional
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, AsyncIterator
 
 from pydantic import BaseModel, ValidationError
 
+from cliobot.cache import SingleFlight
+
+# command cost classes - each one gets its own pool of workers, so cheap commands stay snappy when the bot is busy
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+
 
 class BasePrompt(BaseModel):
     command: str
@@ -109,13 +120,17 @@ async def notify_errors(exc, messaging_service, chat_id, reply_to_message_id=Non
 
 
 class BaseCommand:
-    def __init__(self, command, name, description, examples, reply_only=False, prompt_class=BasePrompt):
+    cost = CHEAP
+
+    def __init__(self, command, name, description, examples, reply_only=False, prompt_class=BasePrompt, cost=None):
         self.command = command
         self.name = name
         self.description = description
         self.examples = examples
         self.reply_only = reply_only
         self.prompt_class = prompt_class
+        if cost is not None:
+            self.cost = cost
 
     async def process(self, message, context, bot) -> bool:
         """
@@ -148,9 +163,17 @@ class BaseCommand:
 
 
 class ImageUrl(BaseModel):
-    url: str
+    url: Optional[str] = None  # a remote url or a local path...
+    data: Optional[bytes] = None  # ...or the image itself, for models returning it inline
+    mimetype: str = 'image/png'
     prompt: str = None
 
+    def media(self):
+        """
+        what to hand over to the messaging service (and storage) - the bytes when there's no file around
+        """
+        return self.url or self.data
+
 
 class GenerationResults(BaseModel):
     texts: List[str] = None
@@ -171,16 +194,108 @@ class Model:
     A model is a class that contains a prompt class and a generate function that takes a prompt and returns a result
     """
 
+    streams = False  # whether stream() yields text as it's generated, or only the whole of it once done
+
     def __init__(self, prompt_class):
         self.prompt_class = prompt_class
 
     async def generate(self, parsed) -> GenerationResults:
         raise NotImplementedError()
 
+    def is_deterministic(self, parsed) -> bool:
+        """
+        whether the same prompt (and input files) always gets the same result - if so, results can be cached
+        """
+        return False
+
+    def fingerprint(self) -> str:
+        """
+        identifies what's behind this model (eg a model version), for caching its results
+        """
+        return type(self).__qualname__
+
+    async def generate_with_previews(self, parsed, on_preview) -> GenerationResults:
+        """
+        same as generate, calling `on_preview(image bytes, progress from 0 to 1)` with in-progress images along
+        the way - for models able to show them
+        """
+        return await self.generate(parsed)
+
+    async def stream(self, parsed) -> AsyncIterator[str]:
+        """
+        generates text incrementally, yielding the new parts (deltas) as they come
+        """
+        res = await self.generate(parsed)
+        for t in res.texts or []:
+            yield t
+
+    async def stream_images(self, parsed, on_preview=None) -> AsyncIterator[ImageUrl]:
+        """
+        generates images, yielding each one as soon as it's done - for models generating several of them at once.
+        Previews, if any, go to `on_preview` (see generate_with_previews)
+        """
+        if on_preview is not None:
+            res = await self.generate_with_previews(parsed, on_preview)
+        else:
+            res = await self.generate(parsed)
+        for i in res.images or []:
+            yield i
+
+
+async def fan_out(count, fn) -> AsyncIterator:
+    """
+    runs `fn(i)` for every i in range(count) concurrently, yielding their results in the order they complete.
+    Stopping to iterate (or a failure) cancels the ones still running
+    """
+    tasks = [asyncio.create_task(fn(i)) for i in range(count)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def result_key(model, parsed) -> str:
+    """
+    cache key for a model's results: the model, plus the normalized prompt - with local files replaced by a hash of
+    their contents, so the same file uploaded (or forwarded) twice gets the same key
+    """
+    params = parsed if isinstance(parsed, dict) else parsed.model_dump()
+
+    normalized = {}
+    for k, v in sorted(params.items()):
+        if k == 'command' or v is None:  # the same prompt can come from different commands
+            continue
+        if isinstance(v, Path) or (isinstance(v, str) and v.startswith('/') and os.path.isfile(v)):
+            v = 'sha256:' + await asyncio.to_thread(file_hash, v)
+        elif isinstance(v, str):
+            v = v.strip()
+        normalized[k] = v
+
+    payload = json.dumps([model.fingerprint(), normalized], sort_keys=True, default=str)
+    return 'result:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def file_hash(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# model calls in flight, by result_key
+in_flight = SingleFlight()
+
 
 class ModelBackedCommand(BaseCommand):
-    def __init__(self, command, name, description, examples, models, default_model=None, reply_only=False):
-        super().__init__(command, name, description, examples, reply_only)
+    cost = EXPENSIVE
+
+    def __init__(self, command, name, description, examples, models, default_model=None, reply_only=False,
+                 cost=None):
+        super().__init__(command, name, description, examples, reply_only, cost=cost)
         self.models = models
         self.default_model = default_model
 
@@ -193,6 +308,40 @@ class ModelBackedCommand(BaseCommand):
         """
         raise NotImplementedError()
 
+    async def generate(self, model, parsed, bot, on_preview=None) -> GenerationResults:
+        """
+        runs the model, going through the bot's results cache when the model is deterministic for this prompt - in
+        which case concurrent calls for the same prompt and inputs are also coalesced into one
+        """
+
+        async def run():
+            if on_preview is not None:
+                return await model.generate_with_previews(parsed, on_preview)
+            return await model.generate(parsed)
+
+        if not model.is_deterministic(parsed):
+            return await run()
+
+        # identical requests running at the same time (eg a voice note forwarded to a few groups) share one call
+        key = await result_key(model, parsed)
+        cache = getattr(bot, 'results_cache', None)
+        if cache is None:
+            return await in_flight.do(key, run)
+        return await cache.get_or_compute(key, run)
+
+    async def stream_images(self, model, parsed, bot, on_preview=None) -> AsyncIterator[ImageUrl]:
+        """
+        same as generate, yielding the images as each one is done - cached (deterministic) results come all at once
+        """
+        if model.is_deterministic(parsed):
+            res = await self.generate(model, parsed, bot, on_preview=on_preview)
+            for i in res.images or []:
+                yield i
+            return
+
+        async for i in model.stream_images(parsed, on_preview=on_preview):
+            yield i
+
     async def process(self, message, session, bot) -> bool:
         """
         parses message and returns the right model to handle it, or None if the message is not a valid command
@@ -29,7 +29,7 @@ class Transcribe(ModelBackedCommand):
             bot=bot,
         )
 
-        res = await model.generate(parsed)
+        res = await self.generate(model, parsed, bot)
         await bot.messaging_service.delete_message(
             message_id=msg.message_id,
             chat_id=message.chat_id,
@@ -1,10 +1,15 @@
+from cliobot.bots.ratelimit import ThrottledEditor
 from cliobot.commands import send_error_message_image, ModelBackedCommand
-from cliobot.db.utils import upload_asset, cached_get_file
+from cliobot.db.utils import cached_get_file
 from cliobot.utils import abs_path
 
 
+# previews replace the media on the placeholder, which telegram rate limits harder than text edits
+PREVIEW_INTERVAL = 3
+
+
 class TextToImage(ModelBackedCommand):
-    def __init__(self, models, default_model):
+    def __init__(self, models, default_model, preview_interval=PREVIEW_INTERVAL):
         super().__init__(
             command='image',
             name="image",
@@ -15,6 +20,7 @@ class TextToImage(ModelBackedCommand):
             models=models,
             default_model=default_model,
         )
+        self.preview_interval = preview_interval
 
     async def run_model(self, parsed, model, message, session, bot):
         msg = await bot.messaging_service.send_media(
@@ -26,40 +32,56 @@ class TextToImage(ModelBackedCommand):
             reply_to_message_id=message.message_id,
         )
 
+        async def show_preview(preview):
+            image, progress = preview
+            await bot.messaging_service.edit_message_media(
+                chat_id=msg.chat_id,
+                message_id=msg.id,
+                media={
+                    'image': image,
+                    'text': f"Generating image, please wait... {int(progress * 100)}%",
+                },
+            )
+
+        previews = ThrottledEditor(show_preview, interval=self.preview_interval)
+
+        async def on_preview(image, progress):
+            previews.update((image, progress))
+
+        delivered = 0
         try:
-            res = await model.generate(parsed)
-            images = res.images
-            for r in images:
-                upload_asset(
-                    session=session,
-                    local_path=r.url,
-                    db=bot.db,
-                    storage=bot.storage,
-                    folder='outputs',
-                )
+            try:
+                async for image in self.stream_images(model, parsed, bot, on_preview=on_preview):
+                    if delivered == 0:
+                        await previews.close(flush=False)  # so a late preview can't replace the result
+                        await bot.messaging_service.edit_message_media(
+                            chat_id=msg.chat_id,
+                            message_id=msg.id,
+                            media={
+                                'image': image.media()
+                            },
+                            text=image.prompt,
+                        )
+                    else:
+                        await bot.messaging_service.send_media(
+                            chat_id=msg.chat_id,
+                            media={
+                                'image': image.media()
+                            },
+                            text=image.prompt,
+                        )
+                    delivered += 1
 
-            if len(images) == 1:
-                await bot.messaging_service.edit_message_media(
-                    chat_id=msg.chat_id,
-                    message_id=msg.id,
-                    media={
-                        'image': images[0].url
-                    },
-                    text=images[0].prompt,
-                )
-            elif len(images) > 1:
-                for r in images:
-                    await bot.messaging_service.send_media(
-                        chat_id=msg.chat_id,
-                        media={
-                            'image': r.url
-                        },
-                        text=r.prompt,
-                    )
-                await bot.messaging_service.delete_message(
-                    message_id=msg.id,
-                    chat_id=msg.chat_id,
-                )
+                    if bot.archival is not None:  # stored in the background, rather than holding up the next ones
+                        await bot.archival.archive(
+                            session=session,
+                            local_path=image.url,
+                            data=image.data,
+                            mimetype=image.mimetype,
+                            folder='outputs',
+                        )
+            finally:
+                await previews.close(flush=False)
         except Exception as e:
             await send_error_message_image(bot.messaging_service, e.__str__(), message)
 
@@ -93,7 +115,7 @@ class DescribeImage(ModelBackedCommand):
         else:
             parsed.image = image
 
-        res = await model.generate(parsed)
+        res = await self.generate(model, parsed, bot)
         for r in res.texts:
             await bot.messaging_service.send_message(
                 text=r,
@@ -1,8 +1,12 @@
+from cliobot.bots.ratelimit import ThrottledEditor
 from cliobot.commands import ModelBackedCommand
 
+# telegram rate limits edits to roughly one per second per chat
+EDIT_INTERVAL = 1.5
+
 
 class Ask(ModelBackedCommand):
-    def __init__(self, models, default_model):
+    def __init__(self, models, default_model, edit_interval=EDIT_INTERVAL):
         super().__init__(
             command='ask',
             name="ask",
@@ -13,9 +17,14 @@ class Ask(ModelBackedCommand):
             models=models,
             default_model=default_model,
         )
+        self.edit_interval = edit_interval
 
     async def run_model(self, parsed, model, message, session, bot) -> bool:
-        res = await model.generate(parsed)
+        if model.streams:
+            await self.stream_answer(parsed, model, message, bot)
+            return True
+
+        res = await self.generate(model, parsed, bot)
 
         for r in res.texts:
             await bot.messaging_service.send_message(
@@ -25,3 +34,44 @@ class Ask(ModelBackedCommand):
             )
 
         return True
+
+    async def stream_answer(self, parsed, model, message, bot):
+        """
+        posts a placeholder right away and keeps editing it as the answer comes in
+        """
+        msg = await bot.messaging_service.send_message(
+            text="Thinking...",
+            chat_id=message.chat_id,
+            reply_to_message_id=message.message_id,
+        )
+
+        async def edit(text):
+            await bot.messaging_service.edit_message(
+                message_id=msg.id,
+                chat_id=msg.chat_id,
+                text=text,
+            )
+
+        editor = ThrottledEditor(edit, interval=self.edit_interval)
+        answer = ''
+        try:
+            async for delta in model.stream(parsed):
+                answer += delta
+                if answer.strip():
+                    editor.update(answer.strip() + ' ...')
+        except BaseException:
+            editor.cancel()
+            raise
+
+        answer = answer.strip() or '🤷'
+        editor.update(answer)
+        try:
+            await editor.close()
+        except Exception as e:
+            # rather than leaving the user with a partial answer - if this fails too, they're told like for any error
+            print("Failed to edit the answer in, sending it instead:", e)
+            await bot.messaging_service.send_message(
+                text=answer,
+                chat_id=message.chat_id,
+                reply_to_message_id=message.message_id,
+            )
@@ -1,5 +1,4 @@
 import os
-import queue
 import re
 
 import i18n
@@ -8,7 +7,10 @@ from dotenv import load_dotenv
 
 from cliobot.bots import BaseBot
 from cliobot.bots.command_handler import CommandHandler
-from cliobot.cache import InMemoryCache
+from cliobot.bots.dispatcher import AsyncDispatcher, ThreadedDispatcher
+from cliobot.bots.ratelimit import RateLimiter, ConcurrencyLimit
+from cliobot.cache import InMemoryCache, TieredCache
+from cliobot.cache.media_cache import MediaCache
 from cliobot.commands.audio import Transcribe
 from cliobot.commands.help import Help
 from cliobot.commands.images import TextToImage, DescribeImage
@@ -70,30 +72,162 @@ class ConfigLoader:
             from cliobot.storage import LocalStorage
             storage = LocalStorage(self.config['storage']['folder'])
         elif storage_driver == 's3':
-            from cliobot.storage.s3 import S3Storage
+            from cliobot.storage.s3 import S3Storage, MB
+            s3_config = self.config['storage']['s3']
             storage = S3Storage(
-                access_key=self.config['storage']['s3']['access_key'],
-                secret=self.config['storage']['s3']['secret_key'],
-                bucket=self.config['storage']['s3']['bucket'],
-                region=self.config['storage']['s3']['region'],
+                access_key=s3_config['access_key'],
+                secret=s3_config['secret_key'],
+                bucket=s3_config['bucket'],
+                region=s3_config['region'],
+                workers=s3_config.get('workers', 8),
+                multipart_threshold=s3_config.get('multipart_threshold', 8 * MB),
+                multipart_chunksize=s3_config.get('multipart_chunksize', 8 * MB),
+                max_concurrency=s3_config.get('max_concurrency', 4),
+                endpoint_url=s3_config.get('endpoint_url', None),
             )
         else:
             raise Exception('unsupported storage driver:', storage_driver)
 
+        from cliobot.storage import AsyncStorageAdapter
+        storage = AsyncStorageAdapter(storage, workers=self.config['storage'].get('readers', 4))
+
+        error_handler = BaseErrorHandler()
+        metrics = BaseMetrics(error_handler)
+
+        cache_config = self.config.get('cache', {})
+        cache_driver = cache_config.get('driver', 'memory')
+        if cache_driver == 'memory':
+            cache = InMemoryCache(
+                max_items=cache_config.get('max_items', 10000),
+                max_bytes=cache_config.get('max_bytes', None),
+                ttl=cache_config.get('ttl', None),
+                metrics=metrics,
+            )
+        elif cache_driver == 'redis':
+            from cliobot.cache.redis_cache import RedisCache
+            cache = RedisCache(
+                url=cache_config.get('url', 'redis://localhost:6379/0'),
+                prefix=cache_config.get('prefix', 'cliobot:'),
+                ttl=cache_config.get('ttl', None),
+                metrics=metrics,
+            )
+        else:
+            raise Exception('unsupported cache driver:', cache_driver)
+
+        results_cache = None
+        results_config = self.config.get('results_cache', {})
+        if results_config.get('enabled', True):
+            from cliobot.cache.disk_cache import DiskCache
+
+            tiers = [InMemoryCache(
+                max_items=results_config.get('max_items', 1000),
+                max_bytes=results_config.get('max_bytes', 64 * 1024 * 1024),
+                ttl=results_config.get('ttl', 86400),
+                name='results.memory',
+                metrics=metrics,
+            )]
+            disk_config = results_config.get('disk', {})
+            if disk_config.get('enabled', True):
+                tiers.append(DiskCache(
+                    folder=disk_config.get('folder', os.path.join(self.tmp_folder, 'results')),
+                    max_bytes=disk_config.get('max_bytes', 1024 ** 3),
+                    ttl=results_config.get('ttl', 86400),
+                    name='results.disk',
+                    metrics=metrics,
+                ))
+            results_cache = TieredCache(tiers, name='results', metrics=metrics)
+
+        files_index = None
+        index_config = self.config.get('files_index', {})
+        if index_config.get('enabled', True):
+            from cliobot.cache.disk_cache import DiskCache
+
+            files_index = TieredCache([
+                InMemoryCache(
+                    max_items=index_config.get('max_items', 10000),
+                    name='files_index.memory',
+                    metrics=metrics,
+                ),
+                DiskCache(
+                    folder=index_config.get('folder', os.path.join(self.tmp_folder, 'files_index')),
+                    max_bytes=index_config.get('max_bytes', 64 * 1024 * 1024),
+                    name='files_index.disk',
+                    metrics=metrics,
+                ),
+            ], name='files_index', metrics=metrics)
+
+        media_config = self.config.get('media_cache', {})
+        media_cache = MediaCache(
+            folder=media_config.get('folder', abs_path('cache')),
+            max_bytes=media_config.get('max_bytes', 1024 ** 3),
+            janitor_interval=media_config.get('janitor_interval', 300),
+            metrics=metrics,
+        )
+
         db_driver = self.config['db']['driver']
+        sharded = None
         if db_driver == 'sqlite3':
             from cliobot.db.sqlite import SqliteDb
             db = SqliteDb(
-                file=self.config['db'].get('file', abs_path('clibot.db'))
+                file=self.config['db'].get('file', abs_path('clibot.db')),
+                pragmas=self.config['db'].get('pragmas', None),
+            )
+        elif db_driver == 'sqlite3-sharded':
+            from cliobot.db.sharded_sqlite import ShardedSqliteDb
+            db = sharded = ShardedSqliteDb(
+                folder=self.config['db'].get('folder', abs_path('clibot-shards')),
+                shards=self.config['db'].get('shards', 8),
+                pragmas=self.config['db'].get('pragmas', None),
             )
         elif db_driver == 'inmemory':
-            from cliobot.db import InMemoryDb
+            from cliobot.db.inmemory import InMemoryDb
             db = InMemoryDb()
         else:
             raise Exception('unsupported db driver:', db_driver)
 
-        error_handler = BaseErrorHandler()
-        metrics = BaseMetrics(error_handler)
+        message_log = self.config['db'].get('message_log', {})
+        if db_driver != 'inmemory' and message_log.get('enabled', True):
+            from cliobot.db.message_log import BufferedMessageLog
+            db = BufferedMessageLog(
+                db,
+                batch_size=message_log.get('batch_size', 100),
+                flush_interval=message_log.get('flush_interval', 1),
+                metrics=metrics,
+            )
+
+        session_cache = self.config['db'].get('session_cache', {})
+        if db_driver != 'inmemory' and session_cache.get('enabled', True):
+            from cliobot.db.session_cache import SessionCachingDb
+            db = SessionCachingDb(
+                db,
+                cache=cache,
+                ttl=session_cache.get('ttl', 3600),
+                flush_interval=session_cache.get('flush_interval', 5),
+                metrics=metrics,
+            )
+
+        if db_driver == 'sqlite3':
+            from cliobot.db.sqlite import AsyncSqliteDb
+            db = AsyncSqliteDb(db, readers=self.config['db'].get('readers', 4))
+        elif db_driver == 'sqlite3-sharded':
+            from cliobot.db.sharded_sqlite import AsyncShardedSqliteDb
+            db = AsyncShardedSqliteDb(db, sharded, readers=self.config['db'].get('readers', 4))
+        else:
+            from cliobot.db import AsyncDatabaseAdapter
+            db = AsyncDatabaseAdapter(db, workers=0)  # never blocks
+
+        from cliobot.storage.archival import ArchivalQueue
+        archival_config = self.config.get('archival', {})
+        archival = ArchivalQueue(
+            storage,
+            db,
+            concurrency=archival_config.get('concurrency', 4),
+            max_retries=archival_config.get('max_retries', 3),
+            retry_delay=archival_config.get('retry_delay', 1),
+            max_pending=archival_config.get('max_pending', 1000),
+            shutdown_timeout=archival_config.get('shutdown_timeout', 30),
+            metrics=metrics,
+        )
 
         commands = [
             ClearContext(),
@@ -106,11 +240,13 @@ class ConfigLoader:
         transcribe_models: dict = {}
         describe_models: dict = {}
         ask_models: dict = {}
+        clients = []  # closed on every event loop the bot uses, once done with it
 
         if self.config.get('replicate', None):
             print("**** Using Replicate API ****")
-            from cliobot.replicate.client import ReplicateEndpoint
+            from cliobot.replicate.client import ReplicateEndpoint, DEFAULT_PARALLELISM
 
+            limit = ConcurrencyLimit(self.config['replicate'].get('parallelism', DEFAULT_PARALLELISM))
             models = self.config['replicate']['endpoints']
             for v in models:
                 cli = ReplicateEndpoint(
@@ -118,6 +254,7 @@ class ConfigLoader:
                     self.config['replicate']['api_token'],
                     v['version'],
                     v['params'],
+                    limit=limit,
                 )
                 if v['kind'] == 'describe':
                     describe_models[v['model']] = cli
@@ -129,13 +266,19 @@ class ConfigLoader:
                     ask_models[v['model']] = cli
 
         if self.config.get('ollama', None):
-            from cliobot.ollama.client import OllamaText
+            from cliobot.ollama.client import OllamaText, OllamaClient
 
             print("**** Using Ollama API ****")
             endpoint = self.config['ollama']['endpoint']
+            ollama_client = OllamaClient(
+                endpoint,
+                timeout=self.config['ollama'].get('timeout', 300),
+            )
+            clients.append(ollama_client)
             for v in self.config['ollama']['models']:
                 m = OllamaText(
                     endpoint=endpoint,
+                    client=ollama_client,
                 )
                 h = None
 
@@ -153,12 +296,26 @@ class ConfigLoader:
 
         if self.config.get('openai', None):
             print("**** Using OpenAI API ****")
-            from cliobot.openai.client import OpenAIClient, GPTPrompt, Whisper1, Dalle3, Gpt4Vision
+            from cliobot.openai.client import OpenAIClient, GPTPrompt, Whisper1, Dalle3, Gpt4Vision, \
+                DEFAULT_IMAGE_PARALLELISM
+            from cliobot.openai.router import EndpointRouter
+
+            routing = self.config['openai'].get('routing', {})
 
             openai_client = OpenAIClient(
                 endpoints=self.config['openai']['endpoints'],
                 metrics=metrics,
+                timeouts=self.config['openai'].get('timeouts', None),
+                max_connections=self.config['openai'].get('max_connections', 100),
+                image_parallelism=self.config['openai'].get('image_parallelism', DEFAULT_IMAGE_PARALLELISM),
+                router=EndpointRouter(
+                    failure_threshold=routing.get('failure_threshold', 3),
+                    cooldown=routing.get('cooldown', 30),
+                    attempts=routing.get('attempts', 3),
+                    metrics=metrics,
+                ),
             )
+            clients.append(openai_client)
 
             models = self.config['openai']['models']
             if 'dall-e-3' in models:
@@ -180,8 +337,10 @@ class ConfigLoader:
             client = WebuiClient(
                 self.config['webui']['endpoint'],
                 self.config['webui'].get('auth', None),
-                temp_dir=self.tmp_folder,
+                temp_dir=self.tmp_folder if self.config['webui'].get('keep_files', False) else None,
+                progress_interval=self.config['webui'].get('progress_interval', 1),
             )
+            clients.append(client)
 
             # get all models on boot
             ms = client.get_models()
@@ -213,14 +372,9 @@ class ConfigLoader:
             ))
         commands.append(Help(commands))
 
-        self.internal_queue = queue.Queue()
-
         i18n.load_path.append(abs_path('i18n'))
         i18n.set('filename_format', '{locale}.{format}')
 
-        cache = InMemoryCache()
-        db = db
-
         translator = NullTranslator()
 
         if self.config['mode'] == 'command':
@@ -231,6 +385,31 @@ class ConfigLoader:
         else:
             raise Exception('unsupported mode:', self.config['mode'])
 
+        dispatcher_config = self.config.get('dispatcher', {})
+        rate_limit = dispatcher_config.get('rate_limit', None)
+        dispatcher_args = {
+            'pools': dispatcher_config.get('pools', None),
+            'max_queue_size': dispatcher_config.get('max_queue_size', 0),
+            'max_queue_wait': dispatcher_config.get('max_queue_wait', None),
+            'rate_limiter': RateLimiter(rate_limit['rate'], rate_limit['burst']) if rate_limit else None,
+        }
+
+        dispatcher_mode = dispatcher_config.get('mode', 'async')
+        if dispatcher_mode == 'async':
+            dispatcher = AsyncDispatcher(
+                handler_fn=handler,
+                concurrency=dispatcher_config.get('concurrency', 200),
+                **dispatcher_args,
+            )
+        elif dispatcher_mode == 'threads':
+            dispatcher = ThreadedDispatcher(
+                handler_fn=handler,
+                workers=dispatcher_config.get('workers', None),
+                **dispatcher_args,
+            )
+        else:
+            raise Exception('unsupported dispatcher mode:', dispatcher_mode)
+
         plat = self.config['bot']['platform']
         if plat == 'telegram':
             from cliobot.bots.telegram_bot import TelegramBot
@@ -238,15 +417,20 @@ class ConfigLoader:
             apikey = self.config['bot']['token']
 
             return TelegramBot(
-                internal_queue=self.internal_queue,
                 db=db,
                 storage=storage,
                 translator=translator,
                 apikey=apikey,
                 bot_language='en',
                 cache=cache,
+                results_cache=results_cache,
+                files_index=files_index,
+                media_cache=media_cache,
+                archival=archival,
                 metrics=metrics,
                 handler_fn=handler,
+                dispatcher=dispatcher,
+                clients=clients,
             )
         else:
             raise Exception('unsupported platform:', plat)
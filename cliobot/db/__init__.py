@@ -1,3 +1,6 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 
@@ -6,6 +9,13 @@ class Database:
     def set_chat_context(self, user_id, context, preferences):
         raise NotImplementedError()
 
+    def set_chat_contexts(self, items):
+        """
+        batch version of set_chat_context, for a list of (user_id, context, preferences)
+        """
+        for user_id, context, preferences in items:
+            self.set_chat_context(user_id, context, preferences)
+
     def create_or_get_chat_session(self, user_id):
         raise NotImplementedError()
 
@@ -15,13 +25,180 @@ class Database:
                      audio=None,
                      voice=None,
                      video=None,
-                     is_forward=False, context=None):
+                     is_forward=False, context=None, owner_id=None):
+        """
+        `owner_id` is the user whose conversation the message belongs to - the sender, unless set (eg for the bot's
+        own replies, which are sent by the bot but belong to the user it's talking to)
+        """
         raise NotImplementedError()
 
+    def save_messages(self, messages):
+        """
+        batch version of save_message, for a list of dicts with save_message's arguments
+        """
+        for m in messages:
+            self.save_message(**m)
+
     def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
         raise NotImplementedError()
 
     def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
+
+class DatabaseWrapper(Database):
+    """
+    base class for databases that add behavior on top of another one - everything not overridden goes straight through
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def set_chat_context(self, user_id, context, preferences):
+        return self.db.set_chat_context(user_id, context, preferences)
+
+    def set_chat_contexts(self, items):
+        return self.db.set_chat_contexts(items)
+
+    def create_or_get_chat_session(self, user_id):
+        return self.db.create_or_get_chat_session(user_id)
+
+    def save_message(self, user_id, chat_id, text, external_id, image=None, audio=None, voice=None, video=None,
+                     is_forward=False, context=None, owner_id=None):
+        return self.db.save_message(
+            user_id=user_id,
+            chat_id=chat_id,
+            text=text,
+            external_id=external_id,
+            image=image,
+            audio=audio,
+            voice=voice,
+            video=video,
+            is_forward=is_forward,
+            owner_id=owner_id,
+        )
+
+    def save_messages(self, messages):
+        return self.db.save_messages(messages)
+
+    def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
+        return self.db.get_asset(external_id, user_id, chat_id)
+
+    def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        return self.db.save_asset(external_id, user_id, chat_id, storage_path)
+
+    def close(self):
+        self.db.close()
+
+
+class AsyncDatabase:
+    """
+    non-blocking version of Database, used by the bot core - every call happens from within a message handler's
+    event loop, so a slow disk shouldn't stall every other message being handled on it
+    """
+
+    async def set_chat_context(self, user_id, context, preferences):
+        raise NotImplementedError()
+
+    async def create_or_get_chat_session(self, user_id):
+        raise NotImplementedError()
+
+    async def save_message(self,
+                           user_id, chat_id, text, external_id,
+                           image=None,
+                           audio=None,
+                           voice=None,
+                           video=None,
+                           is_forward=False, context=None, owner_id=None):
+        raise NotImplementedError()
+
+    async def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
+        raise NotImplementedError()
+
+    async def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        called once the bot stops, outside of any event loop
+        """
+        pass
+
+
+class AsyncDatabaseAdapter(AsyncDatabase):
+    """
+    exposes a (blocking) Database as an AsyncDatabase, by running its calls on a dedicated thread pool - so a slow
+    database can't starve the default executor used by everything else.
+
+    Writes can optionally go through a separate pool (see `write_workers`), for backends that serialize them anyway.
+    With `workers=0`, calls run inline instead - only meant for backends that never block, like InMemoryDb.
+    """
+
+    def __init__(self, db: Database, workers=4, write_workers=None, name='db'):
+        self.db = db
+        self.executor = None
+        self.write_executor = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-reader')
+            self.write_executor = self.executor
+        if write_workers:
+            self.write_executor = ThreadPoolExecutor(max_workers=write_workers, thread_name_prefix=f'{name}-writer')
+
+    async def set_chat_context(self, user_id, context, preferences):
+        return await self._run(self._writer_for(user_id), self.db.set_chat_context, user_id, context, preferences)
+
+    async def create_or_get_chat_session(self, user_id):
+        # creates the session when missing, but that's a one-off - it's a read for all practical purposes
+        return await self._run(self.executor, self.db.create_or_get_chat_session, user_id)
+
+    async def save_message(self, user_id, chat_id, text, external_id, image=None, audio=None, voice=None, video=None,
+                           is_forward=False, context=None, owner_id=None):
+        return await self._run(
+            self._writer_for(owner_id or user_id),
+            functools.partial(
+                self.db.save_message,
+                user_id=user_id,
+                chat_id=chat_id,
+                text=text,
+                external_id=external_id,
+                image=image,
+                audio=audio,
+                voice=voice,
+                video=video,
+                is_forward=is_forward,
+                owner_id=owner_id,
+            ),
+        )
+
+    async def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
+        return await self._run(self.executor, self.db.get_asset, external_id, user_id, chat_id)
+
+    async def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        return await self._run(
+            self._writer_for(user_id), self.db.save_asset, external_id, user_id, chat_id, storage_path)
+
+    def close(self):
+        for executor in {self.executor, self.write_executor}:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self.db.close()
+
+    def _writer_for(self, user_id):
+        return self.write_executor
+
+    async def _run(self, executor, fn, *args):
+        if executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
 
+def async_database(db) -> Optional[AsyncDatabase]:
+    """
+    wraps blocking databases with an AsyncDatabaseAdapter, leaves async ones alone
+    """
+    if db is None or isinstance(db, AsyncDatabase):
+        return db
+    return AsyncDatabaseAdapter(db)
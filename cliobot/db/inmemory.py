@@ -1,4 +1,5 @@
-from cliobot.bots import Session
+from typing import Optional
+
 from cliobot.db import Database
 
 
@@ -10,6 +11,7 @@ class InMemoryDb(Database):
         self.profiles = {}
         self.messages = {}
         self.chats = {}
+        self.assets = {}
 
     def update_job(self, job_id, fields):
         pass
@@ -18,15 +20,16 @@ class InMemoryDb(Database):
         return None
 
     def set_chat_context(self, user_id, context, preferences):
-        self.chats[user_id] = context
+        self.chats[user_id] = {
+            'external_user_id': user_id,
+            'context': context,
+            'preferences': preferences,
+        }
 
     def create_or_get_chat_session(self, user_id):
-        return Session(
-            user_id=user_id,
-            chat_id='1',
-            context={},
-            preferences={},
-        )
+        if user_id not in self.chats:
+            self.set_chat_context(user_id, {}, {})
+        return self.chats[user_id]
 
     def save_message(self,
                      user_id,
@@ -38,5 +41,20 @@ class InMemoryDb(Database):
                      voice=None,
                      video=None,
                      is_forward=False,
-                     context=None):
+                     context=None,
+                     owner_id=None):
         pass
+
+    def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
+        return self.assets.get((external_id, user_id, chat_id))
+
+    def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        asset = {
+            'id': len(self.assets) + 1,
+            'external_id': external_id,
+            'external_user_id': user_id,
+            'external_chat_id': chat_id,
+            'storage_path': storage_path,
+        }
+        self.assets[(external_id, user_id, chat_id)] = asset
+        return asset
@@ -0,0 +1,99 @@
+import threading
+
+from cliobot.db import DatabaseWrapper
+
+
+class BufferedMessageLog(DatabaseWrapper):
+    """
+    buffers save_message calls and writes them to the underlying database in batches (see Database.save_messages),
+    off the message handling path.
+
+    A batch is written once `batch_size` messages are buffered or `flush_interval` seconds after the previous one,
+    whichever comes first - so `flush_interval` is both the worst case latency and the loss window if the bot crashes.
+    Pending messages are written on close(). If writes keep failing, at most `max_buffer` messages are kept around.
+    """
+
+    def __init__(self, db, batch_size=100, flush_interval=1, max_buffer=10000, metrics=None):
+        super().__init__(db)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.metrics = metrics
+
+        self.buffer = []
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()  # one batch at a time, to keep messages in order
+        self.stopped = False
+        self.writer = threading.Thread(target=self._write_periodically, daemon=True)
+        self.writer.start()
+
+    def save_message(self, user_id, chat_id, text, external_id, image=None, audio=None, voice=None, video=None,
+                     is_forward=False, context=None, owner_id=None):
+        with self.cond:
+            self.buffer.append({
+                'user_id': user_id,
+                'chat_id': chat_id,
+                'text': text,
+                'external_id': external_id,
+                'image': image,
+                'audio': audio,
+                'voice': voice,
+                'video': video,
+                'is_forward': is_forward,
+                'owner_id': owner_id,
+            })
+
+            if len(self.buffer) > self.max_buffer:
+                dropped = len(self.buffer) - self.max_buffer
+                del self.buffer[:dropped]
+                self._count('dropped', dropped)
+
+            if len(self.buffer) >= self.batch_size:
+                self.cond.notify()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                batch = self.buffer
+                self.buffer = []
+
+            if len(batch) == 0:
+                return
+
+            try:
+                self.db.save_messages(batch)
+                self._count('written', len(batch))
+            except Exception:
+                with self.cond:  # retry on the next round
+                    self.buffer = batch + self.buffer
+                raise
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.writer.join()
+        self.flush()
+        super().close()
+
+    def _write_periodically(self):
+        while True:
+            with self.cond:
+                if not self.stopped and len(self.buffer) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+                if self.stopped:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                print("Failed to write messages:", e)
+                if self.metrics:
+                    self.metrics.capture_exception(e)
+                with self.cond:  # don't spin on a broken db
+                    if not self.stopped:
+                        self.cond.wait(self.flush_interval)
+
+    def _count(self, metric, value=1):
+        if self.metrics:
+            self.metrics.increment(f'message_log.{metric}', value)
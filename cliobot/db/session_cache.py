@@ -0,0 +1,119 @@
+import copy
+import threading
+
+from cliobot.cache import InMemoryCache
+from cliobot.db import DatabaseWrapper
+
+
+# reads of a session racing writes of the batches, before giving up on caching it
+MAX_READS = 3
+
+
+class SessionCachingDb(DatabaseWrapper):
+    """
+    write-behind session cache in front of a Database.
+
+    Sessions are kept in a cache (keyed by user id) for up to `ttl` seconds, so hot sessions are served from
+    memory. Context changes are buffered and written to the underlying database in batches, every `flush_interval`
+    seconds and on close() - meaning a crash can lose up to `flush_interval` seconds worth of context changes.
+    """
+
+    def __init__(self, db, cache=None, max_size=10000, ttl=3600, flush_interval=5, metrics=None):
+        super().__init__(db)
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+
+        # user_id -> chat session. Can be shared with other users of the bot cache, hence the key prefix
+        self.sessions = cache or InMemoryCache(max_items=max_size, name='session_cache', metrics=metrics)
+        self.dirty = {}  # user_id -> (context, preferences), waiting to be written
+        self.flushing = {}  # same as dirty, for the batch currently being written
+        self.flushes = 0  # batches written so far - see create_or_get_chat_session
+        self.lock = threading.RLock()
+
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def create_or_get_chat_session(self, user_id):
+        res = self.sessions.get(session_key(user_id))
+        if res is not None:
+            return copy.deepcopy(res)
+
+        for _ in range(MAX_READS):
+            with self.lock:
+                flushes = self.flushes
+
+            res = self.db.create_or_get_chat_session(user_id)
+
+            with self.lock:
+                # changes not written yet are newer than whatever the db has
+                pending = self.dirty.get(user_id) or self.flushing.get(user_id)
+                if pending is not None:
+                    res = {**res, 'context': pending[0], 'preferences': pending[1]}
+
+                # a batch written while reading may or may not be in what we got - read again rather than cache it
+                if self.flushes == flushes:
+                    self.sessions.set(session_key(user_id), res, self.ttl)
+                    break
+
+        return copy.deepcopy(res)
+
+    def set_chat_context(self, user_id, context, preferences):
+        context = copy.deepcopy(context)
+        preferences = copy.deepcopy(preferences)
+
+        with self.lock:
+            self.dirty[user_id] = (context, preferences)
+
+            cached = self.sessions.get(session_key(user_id))
+            if cached is not None:
+                self.sessions.set(
+                    session_key(user_id),
+                    {**cached, 'context': context, 'preferences': preferences},
+                    self.ttl)
+
+    def flush(self):
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            self.flushing = self.dirty
+            self.dirty = {}
+
+        try:
+            self.db.set_chat_contexts([
+                (user_id, context, preferences)
+                for user_id, (context, preferences) in self.flushing.items()
+            ])
+            self._count('flushed', len(self.flushing))
+        except Exception:
+            with self.lock:  # put them back for the next round, unless there's something newer already
+                self.dirty = {**self.flushing, **self.dirty}
+            raise
+        finally:
+            with self.lock:
+                self.flushing = {}
+                self.flushes += 1
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        super().close()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("Failed to flush sessions:", e)
+                if self.metrics:
+                    self.metrics.capture_exception(e)
+
+    def _count(self, metric, value=1):
+        if self.metrics:
+            self.metrics.increment(f'session_cache.{metric}', value)
+
+
+def session_key(user_id):
+    return f'session:{user_id}'
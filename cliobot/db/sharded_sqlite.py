@@ -0,0 +1,124 @@
+import os
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from cliobot.db import Database, AsyncDatabaseAdapter
+from cliobot.db.sqlite import SqliteDb
+
+
+class ShardedSqliteDb(Database):
+    """
+    spreads sessions, messages and assets across `shards` SQLite files, partitioned by user id - so writes for
+    different users don't all queue up on a single writer lock.
+
+    Everything about a user lives on a single shard, so per-user lookups are still single-file queries - messages
+    included, which go to their owner's shard rather than the sender's (so the bot's replies are kept alongside the
+    conversation they're part of, instead of all piling up on the bot's own shard). Queries
+    across every user (eg for admin tools) go through scan(), which runs them on all shards in parallel.
+    The number of shards can't change once there's data in them - users would be looked up on the wrong file.
+    """
+
+    def __init__(self, folder, shards=8, pragmas=None):
+        os.makedirs(folder, exist_ok=True)
+        self.shards = [
+            SqliteDb(os.path.join(folder, f'shard-{i:03d}.db'), pragmas=pragmas)
+            for i in range(shards)
+        ]
+        self.scanner = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='sqlite-scan')
+
+    def shard_index(self, user_id) -> int:
+        # crc32 rather than hash(), which changes across processes
+        return zlib.crc32(str(user_id).encode('utf-8')) % len(self.shards)
+
+    def shard_for(self, user_id) -> SqliteDb:
+        return self.shards[self.shard_index(user_id)]
+
+    def create_or_get_chat_session(self, user_id):
+        return self.shard_for(user_id).create_or_get_chat_session(user_id)
+
+    def set_chat_context(self, user_id, context, preferences):
+        self.shard_for(user_id).set_chat_context(user_id, context, preferences)
+
+    def set_chat_contexts(self, items):
+        by_shard = defaultdict(list)
+        for item in items:
+            by_shard[self.shard_index(item[0])].append(item)
+
+        self._on_shards({i: (self.shards[i].set_chat_contexts, batch) for i, batch in by_shard.items()})
+
+    def save_message(self, user_id, chat_id, text, external_id, image=None, audio=None, voice=None, video=None,
+                     is_forward=False, context=None, owner_id=None):
+        self.shard_for(owner_id or user_id).save_message(
+            user_id=user_id,
+            chat_id=chat_id,
+            text=text,
+            external_id=external_id,
+            image=image,
+            audio=audio,
+            voice=voice,
+            video=video,
+            is_forward=is_forward,
+        )
+
+    def save_messages(self, messages):
+        by_shard = defaultdict(list)
+        for m in messages:
+            by_shard[self.shard_index(m.get('owner_id') or m['user_id'])].append(m)
+
+        self._on_shards({i: (self.shards[i].save_messages, batch) for i, batch in by_shard.items()})
+
+    def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
+        return self.shard_for(user_id).get_asset(external_id, user_id, chat_id)
+
+    def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        return self.shard_for(user_id).save_asset(external_id, user_id, chat_id, storage_path)
+
+    def scan(self, query, params=()) -> list[dict]:
+        """
+        runs a read query on every shard in parallel, and returns all the rows (in shard order).
+        Aggregates come back once per shard - eg a count(*) returns one row per shard, to be summed up by the caller
+        """
+
+        def run(shard):
+            return shard.conn.execute(query, params).fetchall()
+
+        res = []
+        for rows in self.scanner.map(run, self.shards):
+            res.extend(rows)
+        return res
+
+    def close(self):
+        self.scanner.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+    def _on_shards(self, calls):
+        # batches for different shards are written in parallel, each one on its own file
+        futures = [self.scanner.submit(fn, batch) for fn, batch in calls.values()]
+        for f in futures:
+            f.result()
+
+
+class AsyncShardedSqliteDb(AsyncDatabaseAdapter):
+    """
+    async access to a ShardedSqliteDb (or a DatabaseWrapper around one), with a writer thread per shard - writes
+    are serialized per file, like AsyncSqliteDb does, but different shards are written to in parallel
+    """
+
+    def __init__(self, db: Database, sharded: ShardedSqliteDb, readers=4):
+        super().__init__(db, workers=readers, name='sqlite')
+        self.sharded = sharded
+        self.writers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'sqlite-writer-{i}')
+            for i in range(len(sharded.shards))
+        ]
+
+    def close(self):
+        for w in self.writers:
+            w.shutdown(wait=True)
+        super().close()
+
+    def _writer_for(self, user_id):
+        return self.writers[self.sharded.shard_index(user_id)]
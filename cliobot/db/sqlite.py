@@ -1,29 +1,70 @@
 import json
 import sqlite3
+import threading
 from typing import Optional
 
-from cliobot.db import Database
+from cliobot.db import Database, AsyncDatabaseAdapter
 from cliobot.utils import abs_path
 
+DEFAULT_PRAGMAS = {
+    'synchronous': 'NORMAL',  # safe with WAL, only the last transactions can be lost on a power failure
+    'cache_size': -64000,  # in KiB (negative) or pages (positive)
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,  # ms to wait on a locked db before giving up
+    'temp_store': 'MEMORY',
+}
+
+# applied in order, on top of schema.sql. The db's user_version tracks which ones already ran - only ever append to it
+MIGRATIONS = [
+    """
+    create index if not exists assets_lookup on assets (external_id, external_user_id, external_chat_id);
+    create index if not exists chat_messages_lookup on chat_messages (external_chat_id, external_id);
+    """,
+]
+
 
 class SqliteDb(Database):
+    """
+    SQLite in WAL mode, with one connection per thread (readers don't block the writer, and vice versa)
+    """
+
+    def __init__(self, file, pragmas=None):
+        self.file = file
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
 
-    def __init__(self, file):
-        self.conn = sqlite3.connect(file, check_same_thread=False)
-        self.conn.row_factory = dict_factory
+        self.conn.execute("PRAGMA journal_mode = WAL")
         self._create_tables()
+        self._migrate()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.file, check_same_thread=False)  # only used by this thread, but closed by any
+            conn.row_factory = dict_factory
+            for k, v in self.pragmas.items():
+                conn.execute(f"PRAGMA {k} = {v}")
+
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+
+        return conn
 
     def create_or_get_chat_session(self, external_user_id):
         cur = self.conn.cursor()  # TODO fix prefs
         cur.execute(
             "SELECT * FROM chat_sessions WHERE external_user_id = ?",
-            (external_user_id)
+            (external_user_id,)
         )
         res = cur.fetchone()
         if res is None:
             cur.execute(
-                "INSERT INTO chat_sessions (external_user_id) VALUES (?, ?)",
-                (external_user_id)
+                "INSERT OR IGNORE INTO chat_sessions (external_user_id) VALUES (?)",
+                (external_user_id,)
             )
             self.conn.commit()
             return self.create_or_get_chat_session(external_user_id)
@@ -41,11 +82,30 @@ class SqliteDb(Database):
                      audio=None,
                      voice=None,
                      video=None,
-                     is_forward=False):
+                     is_forward=False,
+                     context=None,
+                     owner_id=None):
+        self.save_messages([{
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'text': text,
+            'external_id': external_id,
+            'image': image,
+            'audio': audio,
+            'voice': voice,
+            'video': video,
+            'is_forward': is_forward,
+        }])
+
+    def save_messages(self, messages):
         cur = self.conn.cursor()
-        cur.execute(
-            "INSERT INTO chat_messages(external_id, external_user_id, external_chat_id, text, external_image_id, external_audio_id, external_voice_id, external_video_id, is_forward) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (external_id, user_id, chat_id, text, image, audio, voice, video, is_forward)
+        cur.executemany(
+            "INSERT INTO chat_messages(external_id, external_user_id, external_chat_id, text, external_image_id, external_audio_id, external_voice_id, external_video_id, is_forward) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (m['external_id'], m['user_id'], m['chat_id'], m['text'], m.get('image'), m.get('audio'),
+                 m.get('voice'), m.get('video'), m.get('is_forward', False))
+                for m in messages
+            ]
         )
         self.conn.commit()
 
@@ -57,6 +117,14 @@ class SqliteDb(Database):
         )
         self.conn.commit()
 
+    def set_chat_contexts(self, items):
+        cur = self.conn.cursor()
+        cur.executemany(
+            "UPDATE chat_sessions SET context = ?, preferences = ? WHERE external_user_id = ?",
+            [(json.dumps(context), json.dumps(preferences), user_id) for user_id, context, preferences in items]
+        )
+        self.conn.commit()
+
     def get_asset(self, external_id, user_id, chat_id) -> Optional[dict]:
         cur = self.conn.cursor()
         cur.execute(
@@ -69,20 +137,49 @@ class SqliteDb(Database):
 
         return res
 
-    def save_asset(self, external_id, user_id, chat_id, storage_path) -> (dict, bool):
+    def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
         cur = self.conn.cursor()
         cur.execute(
-            "INSERT INTO assets(external_id, external_user_id, external_chat_id, storage_path) VALUES (?, ?, ?, ?)",
+            "INSERT INTO assets(external_id, external_user_id, external_chat_id, storage_path) VALUES (?, ?, ?, ?) RETURNING *",
             (external_id, user_id, chat_id, storage_path)
         )
+        res = cur.fetchone()
         self.conn.commit()
-        return self.get_asset(external_id, user_id, chat_id)
+        return res
+
+    def close(self):
+        with self.lock:
+            for c in self.connections:
+                c.close()
+            self.connections = []
+        self.local = threading.local()
 
     def _create_tables(self):
         with open(abs_path('schema.sql'), 'r') as f:
             self.conn.executescript(f.read())
 
+    def _migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()['user_version']
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Applying migration {i}")
+            self.conn.executescript(f"BEGIN; {migration}; PRAGMA user_version = {i}; COMMIT;")
+
 
 def dict_factory(cursor, row):
     fields = [column[0] for column in cursor.description]
     return {key: value for key, value in zip(fields, row)}
+
+
+class AsyncSqliteDb(AsyncDatabaseAdapter):
+    """
+    async access to a SqliteDb (or a DatabaseWrapper around one). WAL lets any number of reads run alongside a write,
+    but writes still serialize on the database lock - so they go through a single writer thread instead of contending
+    for it (and sleeping on busy_timeout) across the whole pool, while reads get `readers` threads of their own.
+    """
+
+    def __init__(self, db: Database, readers=4):
+        super().__init__(db, workers=readers, write_workers=1, name='sqlite')
+
+    @classmethod
+    def open(cls, file, pragmas=None, readers=4):
+        return cls(SqliteDb(file, pragmas=pragmas), readers=readers)
@@ -1,58 +1,85 @@
+import asyncio
+import hashlib
 import mimetypes
 import os
 from pathlib import Path
 
-import requests
-
-from cliobot.utils import md5_hash, abs_path, base64_to_bytes
+from cliobot.cache import SingleFlight
+from cliobot.fetch import fetch, is_fetchable, open_stream, copy_file, is_url, stream
+from cliobot.utils import md5_hash
 
 
 def asset_filename(folder, user_id, filename):
     return f"{folder}/{user_id}/{filename}"
 
 
+# downloads in flight - the same attachment showing up in several chats at once is only fetched once
+fetches = SingleFlight()
+
+
 async def cached_get_file(file_id, bot, session) -> Path:
     """
     get a file_id and return the local path to the file
     if the file is already cached, return the cached file
     if the file_id is a url or a local path, download it to the cache folder and return the local path
 
+    where a file_id is cached is looked up on the bot's files_index first, so files already downloaded are found
+    without any network call. Files live on the bot's media_cache, which evicts the least recently used ones.
+
     :param file_id:
     :param bot:
     :param session:
     :return:
     """
-    info = await bot.messaging_service.get_file_info(file_id)
-    filepath = info['file_path']
-
-    af = abs_path(asset_filename('cache', session.user_id, hashed_filename(filepath)))
-    if os.path.exists(af):
-        return Path(af)
-
-    os.makedirs(os.path.dirname(af), exist_ok=True)
-    try:
-        data = get_data(file_id)
-    except FileNotFoundError as e:
-        _, data = await bot.messaging_service.get_file(file_id)
-
-    with open(af, 'wb') as f:
-        f.write(data)
-
-    return Path(af)
-
-
-def get_data(filepath):
-    if filepath.startswith('data:'):
-        return base64_to_bytes(filepath)
-    elif os.path.exists(filepath):
-        with open(filepath, 'rb') as f:
-            data = f.read()
-            return data
-    elif filepath.startswith('http'):
-        return requests.get(filepath).content
+    index = getattr(bot, 'files_index', None)
+    index_key = f'media:{session.user_id}:{file_id}'
+
+    key = None
+    if index is not None:
+        key = await index.aget(index_key)
+
+    if key is None and is_fetchable(file_id):  # no need to ask the messaging service about it
+        key = f"{session.user_id}/{hashed_filename(str(file_id))}"
+    elif key is None:
+        info = await fetches.do(('info', file_id), lambda: bot.messaging_service.get_file_info(file_id))
+        key = f"{session.user_id}/{hashed_filename(info['file_path'])}"
+        if index is not None:
+            await index.aset(index_key, key)
+
+    media = bot.media_cache
+    path = await asyncio.to_thread(media.get, key)
+    if path is not None:
+        return path
+
+    async def download():
+        with media.writer(key) as f:
+            await fetch_file(file_id, f, bot)
+        return media.path(key)
+
+    async def save():
+        # other users asking for the same file at the same time get a copy of the one download
+        path = await fetches.do(('download', file_id), download)
+        if path != media.path(key):
+            await asyncio.to_thread(copy_to_cache, path, media, key)
+        return media.path(key)
+
+    return await fetches.do(('file', media.folder, key), save)
+
+
+async def fetch_file(file_id, out, bot):
+    """
+    streams a file into `out` - from wherever it is, if file_id is a url or a local path, or from the messaging
+    service otherwise
+    """
+    if is_fetchable(file_id):
+        await fetch(file_id, out)
     else:
-        with open(filepath, 'rb') as f:
-            return f.read()
+        await bot.messaging_service.download_file(file_id, out)
+
+
+def copy_to_cache(path, media, key):
+    with media.writer(key) as f:
+        copy_file(path, f)
 
 
 def hashed_filename(local_path):
@@ -66,23 +93,75 @@ def hashed_filename(local_path):
     return md5_hash(local_path) + '.' + ext
 
 
-def upload_asset(
+async def upload_asset(
         session,
         local_path,
         db,
         storage,
         folder,
-        file_id=None):
-    data = get_data(local_path)
-
-    storage_path = storage.save_data(
-        data,
-        asset_filename(folder, session.user_id, hashed_filename(local_path)),
-        mimetype=mimetypes.guess_type(local_path)[0],
+        file_id=None,
+        data=None,
+        mimetype=None):
+    """
+    saves a file to storage (see save_to_storage), and records it
+    """
+    external_id, storage_path = await save_to_storage(
+        session=session,
+        local_path=local_path,
+        storage=storage,
+        folder=folder,
+        file_id=file_id,
+        data=data,
+        mimetype=mimetype,
     )
-    return db.save_asset(
-        external_id=file_id or md5_hash(local_path),
+
+    return await db.save_asset(
+        external_id=external_id,
         user_id=session.user_id,
         chat_id=session.chat_id,
         storage_path=storage_path,
     )
+
+
+async def save_to_storage(
+        session,
+        local_path,
+        storage,
+        folder,
+        file_id=None,
+        data=None,
+        mimetype=None):
+    """
+    saves a file (or its contents, from `data` - in which case local_path is optional) to an AsyncStorage, returning
+    its (external id, storage path). local_path can also be a url, or a data url
+    """
+    if data is None:
+        mimetype = mimetypes.guess_type(local_path)[0]
+        filename = hashed_filename(local_path)
+        external_id = file_id or md5_hash(local_path)
+
+        if is_url(local_path):  # piped from the download straight into storage
+            storage_path = await storage.save_data(
+                stream(local_path),
+                asset_filename(folder, session.user_id, filename),
+                mimetype=mimetype,
+            )
+        else:
+            async with open_stream(local_path) as f:
+                storage_path = await storage.save_data(
+                    f,
+                    asset_filename(folder, session.user_id, filename),
+                    mimetype=mimetype,
+                )
+    else:
+        digest = hashlib.md5(data).hexdigest()
+        filename = f"{digest}{mimetypes.guess_extension(mimetype or '') or ''}"
+        external_id = file_id or digest
+
+        storage_path = await storage.save_data(
+            data,
+            asset_filename(folder, session.user_id, filename),
+            mimetype=mimetype,
+        )
+
+    return external_id, storage_path
@@ -0,0 +1,182 @@
+import asyncio
+import inspect
+import io
+import os
+import shutil
+import tempfile
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiohttp
+
+from cliobot.utils import base64_to_bytes, redact, CHUNK_SIZE, SPOOL_SIZE
+
+
+class Fetcher:
+    """
+    streams files - remote ones, local ones or data urls - into any sink with a write() method (sync or async), a
+    chunk at a time, so memory use stays the same no matter how big they are. Writes to anything but async sinks and
+    in-memory buffers happen off the event loop.
+
+    Keeps one aiohttp session per event loop, since they can't be shared across loops.
+    """
+
+    def __init__(self, timeout=300, max_connections=100, chunk_size=CHUNK_SIZE):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.chunk_size = chunk_size
+        self.sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
+
+    async def fetch(self, src, out) -> int:
+        """
+        writes the contents of `src` into `out`, returning how many bytes were written
+        """
+        size = 0
+        async for chunk in self.stream(src):
+            await write(out, chunk)
+            size += len(chunk)
+        return size
+
+    async def stream(self, src) -> AsyncIterator[bytes]:
+        """
+        the contents of `src`, a chunk at a time
+        """
+        src = str(src)
+        if src.startswith('data:'):
+            yield base64_to_bytes(src)
+            return
+
+        if is_url(src):
+            session = self._session()
+            async with session.get(src) as r:
+                if r.status != 200:
+                    raise Exception(f"Failed to download {redact(src)} {r.status}")
+
+                async for chunk in r.content.iter_chunked(self.chunk_size):
+                    yield chunk
+            return
+
+        if not os.path.isfile(src):
+            raise FileNotFoundError(src)
+
+        with open(src, 'rb') as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def close(self):
+        """
+        closes the session for the current event loop
+        """
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = self.sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return session
+
+
+fetcher = Fetcher()
+
+
+async def fetch(src, out) -> int:
+    return await fetcher.fetch(src, out)
+
+
+def stream(src) -> AsyncIterator[bytes]:
+    return fetcher.stream(src)
+
+
+async def write(out, chunk):
+    if inspect.iscoroutinefunction(out.write):
+        return await out.write(chunk)
+    if isinstance(out, io.BytesIO):
+        return out.write(chunk)
+    return await asyncio.to_thread(out.write, chunk)  # eg a file, which might block on disk
+
+
+def is_url(src) -> bool:
+    return str(src).startswith('http://') or str(src).startswith('https://')
+
+
+def is_fetchable(src) -> bool:
+    """
+    whether fetch() can get to src by itself - as opposed to eg a telegram file id
+    """
+    return str(src).startswith('data:') or is_url(src) or os.path.isfile(str(src))
+
+
+@asynccontextmanager
+async def open_stream(src, spool_size=SPOOL_SIZE):
+    """
+    a readable file object with the contents of `src` - local files are opened as they are, anything else is
+    fetched into a temp file, held in memory only up to `spool_size` bytes
+    """
+    if not str(src).startswith('data:') and os.path.isfile(str(src)):
+        with open(src, 'rb') as f:
+            yield f
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as f:
+        await fetch(src, f)
+        f.seek(0)
+        yield f
+
+
+class BlockingReader(io.RawIOBase):
+    """
+    a readable (not seekable) file object over an async iterator of byte chunks, for blocking code running on
+    another thread (eg boto3) - each read waits on the iterator, running on `loop`.
+
+    Unlike raw files, read(n) only comes back short at the end of the stream - boto3 tells small uploads from
+    multipart ones by how much a read gets it.
+    """
+
+    def __init__(self, chunks, loop):
+        self.chunks = chunks.__aiter__()
+        self.loop = loop
+        self.buffer = b''
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+
+        chunks, missing = [], size
+        while missing > 0:
+            chunk = super().read(missing)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            missing -= len(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, b):
+        while len(self.buffer) == 0 and not self.done:
+            try:
+                self.buffer = asyncio.run_coroutine_threadsafe(self.chunks.__anext__(), self.loop).result()
+            except StopAsyncIteration:
+                self.done = True
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def copy_file(src, out, chunk_size=CHUNK_SIZE):
+    with open(src, 'rb') as f:
+        shutil.copyfileobj(f, out, chunk_size)
@@ -1,9 +1,24 @@
+import threading
+
+
 class BaseMetrics:
     def __init__(self, error_handler):
         self.error_handler = error_handler
+        self.counters = {}
+        self.timings = {}  # metric -> (count, total seconds, max seconds)
+        self.lock = threading.Lock()
 
     def capture_exception(self, exception, user_id='anonymous'):
         self.error_handler.capture_exception(exception)
 
     def send_event(self, event, user_id='anonymous', params=None):
         print(f"EVENT: {event} / {user_id} / {params}")
+
+    def increment(self, metric, value=1):
+        with self.lock:
+            self.counters[metric] = self.counters.get(metric, 0) + value
+
+    def timing(self, metric, seconds):
+        with self.lock:
+            count, total, slowest = self.timings.get(metric, (0, 0.0, 0.0))
+            self.timings[metric] = (count + 1, total + seconds, max(slowest, seconds))
@@ -7,8 +7,8 @@ from cliobot.metrics import BaseMetrics
 
 class MixpanelMetrics(BaseMetrics):
     def __init__(self, key, error_handler):
+        super().__init__(error_handler)
         self.mp = None
-        self.error_handler = error_handler
         if key != '':
             self.mp = Mixpanel(key, consumer=AsyncBufferedConsumer())
 
@@ -1,7 +1,9 @@
+import asyncio
 import json
-from typing import Optional
+import weakref
+from typing import Optional, AsyncIterator
 
-import requests
+import aiohttp
 
 from cliobot.commands import Model, GenerationResults, BasePrompt
 from cliobot.utils import decode_image
@@ -11,39 +13,102 @@ class OllamaPrompt(BasePrompt):
     prompt: Optional[str] = "what's in this image?"
     image: Optional[str]
 
+
+class OllamaClient:
+    """
+    async client for Ollama's API, keeping connections alive across calls - one session per event loop, since
+    aiohttp sessions can't be shared across loops.
+
+    Generations are streamed: cancelling (or stopping to iterate) drops the connection, which stops it on the server.
+    """
+
+    def __init__(self, endpoint, timeout=300, max_connections=100):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
+
+    async def generate(self, params) -> AsyncIterator[dict]:
+        """
+        yields every NDJSON object of a /api/generate response as soon as it's received
+        """
+        session = self._session()
+        async with session.post(f'{self.endpoint}/api/generate', json=params) as r:
+            r.raise_for_status()
+
+            buffer = b''
+            async for chunk in r.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if line.strip():
+                        yield self._parse(line)
+
+            if buffer.strip():
+                yield self._parse(buffer)
+
+    async def close(self):
+        """
+        closes the session for the current event loop
+        """
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _parse(self, line):
+        body = json.loads(line)
+        if 'error' in body:
+            raise Exception(body['error'])
+        return body
+
+    def _session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = self.sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return session
+
+
 class OllamaText(Model):
-    def __init__(self, endpoint):
+    streams = True
+
+    def __init__(self, endpoint, client: OllamaClient = None):
         super().__init__(
             prompt_class=OllamaPrompt,
         )
         self.endpoint = endpoint
+        self.client = client or OllamaClient(endpoint)
 
     async def generate(self, parsed) -> GenerationResults:
+        response = ''
+        async for response_part in self.stream(parsed):
+            response += response_part
+
+        return GenerationResults(
+            texts=[response.strip()]
+        )
+
+    def is_deterministic(self, parsed) -> bool:
+        return parsed.image is not None  # describing an image, rather than chatting
+
+    def fingerprint(self) -> str:
+        return f'ollama:{self.endpoint}'
+
+    async def stream(self, parsed):
         params = {
             'model': parsed.model,
             'prompt': parsed.prompt,
         }
 
         if parsed.image:
-            params['images'] = [decode_image(parsed.image)]
+            params['images'] = [await asyncio.to_thread(decode_image, parsed.image)]
             if params['images'][0].startswith('data:image'):
                 params['images'][0] = params['images'][0].split(',')[1]
 
-        r = requests.post(f'{self.endpoint}/api/generate',
-                          json=params,
-                          stream=True)
-        r.raise_for_status()
-
-        response = ''
-        for line in r.iter_lines():
-            body = json.loads(line)
+        async for body in self.client.generate(params):
             response_part = body.get('response', '')
-            print(response_part, end='', flush=True)
-            response += response_part
-
-            if 'error' in body:
-                raise Exception(body['error'])
-
-        return GenerationResults(
-            texts=[response.strip()]
-        )
+            if response_part:
+                yield response_part
@@ -1,10 +1,15 @@
+import asyncio
+import weakref
 from pathlib import Path
-from typing import Optional
+from typing import Optional, AsyncIterator
 
+import httpx
 import openai
 from pydantic import Field
 
-from cliobot.commands import BasePrompt, Model, GenerationResults, ImageUrl
+from cliobot.bots.ratelimit import ConcurrencyLimit
+from cliobot.commands import BasePrompt, Model, GenerationResults, ImageUrl, fan_out
+from cliobot.openai.router import EndpointRouter, Endpoint
 from cliobot.utils import image_to_base64, open_image, decode_image
 
 VALID_DALLE3_SIZES = ['1024x1792', '1024x1024', '1792x1024']
@@ -12,6 +17,16 @@ DALLE3_RATIOS = [float(x[0]) / float(x[1]) for x in
                  [x.split('x') for x in VALID_DALLE3_SIZES]
                  ]
 
+# seconds, per model kind
+DEFAULT_TIMEOUTS = {
+    'default': 60,
+    'dall-e-3': 120,
+    'whisper-1': 120,
+}
+
+# dall-e 3 images being generated at once, across every request
+DEFAULT_IMAGE_PARALLELISM = 4
+
 
 # A set of commands using OpenAI's APIs
 class TranscribePrompt(BasePrompt):
@@ -28,11 +43,16 @@ class Whisper1(Model):
         )
 
     async def generate(self, parsed) -> GenerationResults:
-        txt = self.openai_client.transcribe(parsed.audio)
+        txt = await self.openai_client.transcribe(parsed.audio)
         return GenerationResults(texts=[txt])
 
+    def is_deterministic(self, parsed) -> bool:
+        return True
+
 
 class GPTPrompt(Model):
+    streams = True
+
     def __init__(self, openai_client):
         super().__init__(
             prompt_class=BasePrompt,
@@ -40,15 +60,20 @@ class GPTPrompt(Model):
         self.openai_client = openai_client
 
     async def generate(self, parsed):
-        res = self.openai_client.ask(
+        res = await self.openai_client.ask(
             parsed.prompt
         )
         return GenerationResults(texts=[res])
 
+    async def stream(self, parsed):
+        async for delta in self.openai_client.ask_stream(parsed.prompt):
+            yield delta
+
 
 class Dalle3Prompt(BasePrompt):
     size: str = Field(default='1024x1024',
                       examples=VALID_DALLE3_SIZES)  # TODO adjust size?
+    num: int = Field(default=1, ge=1, le=4)
 
 
 class Dalle3(Model):
@@ -59,22 +84,21 @@ class Dalle3(Model):
         self.openai_client = openai_client
 
     async def generate(self, parsed) -> GenerationResults:
-        res = self.openai_client.dalle3_txt2img(
-            prompt=parsed.prompt,
-            num=1,
-            size=parsed.size,
-        )
-
         return GenerationResults(
-            images=[
-                ImageUrl(
-                    url=img.url,
-                    prompt=img.revised_prompt,
-                )
-                for img in res
-            ]
+            images=[img async for img in self.stream_images(parsed)]
         )
 
+    async def stream_images(self, parsed, on_preview=None):
+        async for img in self.openai_client.dalle3_txt2img_stream(
+                prompt=parsed.prompt,
+                num=parsed.num,
+                size=parsed.size,
+        ):
+            yield ImageUrl(
+                url=img.url,
+                prompt=img.revised_prompt,
+            )
+
 
 class DescribePrompt(BasePrompt):
     image: str
@@ -89,13 +113,16 @@ class Gpt4Vision(Model):
         self.openai_client = openai_client
 
     async def generate(self, parsed) -> GenerationResults:
-        res = self.openai_client.img2text(
+        res = await self.openai_client.img2text(
             prompt=parsed.prompt,
             image_url=parsed.image,
         )
 
         return GenerationResults(texts=[res])
 
+    def is_deterministic(self, parsed) -> bool:
+        return True  # not strictly, but a description is as good as another
+
 
 def dalle_size(size):
     if not size in VALID_DALLE3_SIZES:
@@ -109,95 +136,206 @@ def dalle_size(size):
 
 
 class OpenAIClient:
-    # OpenAI wrapper that supports multiple regions and a mix of azure + openai apis
+    """
+    OpenAI wrapper that supports multiple regions and a mix of azure + openai apis.
 
-    def __init__(self, endpoints, metrics):
-        self.metrics = metrics
+    Calls are routed across every endpoint able to serve them (see EndpointRouter): azure deployments of the model's
+    kind first, then the openai ones. Failing endpoints are taken out of rotation, and their calls retried elsewhere.
+
+    Calls are async, and every endpoint shares one pooled HTTP client per event loop (httpx connections can't
+    be shared across loops) - so any number of requests can be in flight from a single loop without blocking it.
+    Each call gets the timeout configured for its model kind, and is aborted right away if cancelled.
+    """
 
-        self.v1_configs = [v for v in endpoints if v['api_type'] == 'open_ai']
-        self.v1_clients = [
-            openai.OpenAI(
-                api_key=v['api_key'],
-                base_url=v['base_url'],
-            ) for v in self.v1_configs]
-
-        self.azure_configs = [v for v in endpoints if v['api_type'] == 'azure']
-        self.azure_clients = [
-            openai.AzureOpenAI(
-                api_key=v['api_key'],
-                azure_endpoint=v['base_url'],
-                api_version=v['api_version'],
-            ) for v in self.azure_configs]
-
-    def transcribe(self, audio_file):
+    def __init__(self, endpoints, metrics, timeouts=None, max_connections=100, max_retries=0, router=None,
+                 image_parallelism=DEFAULT_IMAGE_PARALLELISM):
+        self.metrics = metrics
+        self.images_limit = ConcurrencyLimit(image_parallelism)
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.max_connections = max_connections
+        self.max_retries = max_retries  # on the same endpoint - retrying on other ones is up to the router
+
+        self.configs = endpoints
+        self.router = router or EndpointRouter(metrics=metrics)
+        for i, v in enumerate(endpoints):
+            if v['api_type'] == 'azure':
+                self.router.add(v['kind'], Endpoint(i, v, model=v['model']))
+            elif v['api_type'] == 'open_ai':
+                self.router.add('*', Endpoint(i, v, priority=1))
+
+        self.clients = weakref.WeakKeyDictionary()  # event loop -> (clients, by endpoint index; http client)
+
+    async def transcribe(self, audio_file):
         if isinstance(audio_file, str):
             audio_file = Path(audio_file)
-
-        client, model = self._get_client('whisper-1')
-        res = client.audio.transcriptions.create(
-            file=audio_file,
-            model=model,
-        )
-
-        return res.text
-
-    def img2text(self, prompt, image_url, max_tokens=300) -> str:
-        image_url = decode_image(image_url)
-
-        client, model = self._get_client('gpt-4-vision-preview')
-
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url,
+        data = await asyncio.to_thread(audio_file.read_bytes)
+
+        async def call(client, model):
+            res = await client.audio.transcriptions.create(
+                file=(audio_file.name, data),
+                model=model,
+                timeout=self._timeout('whisper-1'),
+            )
+            return res.text
+
+        return await self._call('whisper-1', call)
+
+    async def img2text(self, prompt, image_url, max_tokens=300) -> str:
+        image_url = await asyncio.to_thread(decode_image, image_url)
+
+        async def call(client, model):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_url,
+                                },
                             },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=max_tokens,
+                        ],
+                    }
+                ],
+                max_tokens=max_tokens,
+                timeout=self._timeout('gpt-4-vision-preview'),
+            )
+            return response.choices[0].message.content
+
+        return await self._call('gpt-4-vision-preview', call)
+
+    async def dalle3_txt2img(self, prompt, num, size):
+        return [img async for img in self.dalle3_txt2img_stream(prompt, num, size)]
+
+    async def dalle3_txt2img_stream(self, prompt, num, size) -> AsyncIterator:
+        """
+        dall-e 3 only makes one image per request, so `num` of them are requested concurrently (no more than
+        `image_parallelism` at a time, across every call) - yielding each image as soon as it's done
+        """
+
+        async def call(client, model):
+            res = await client.images.generate(
+                model=model,
+                n=1,
+                quality='hd',
+                size=dalle_size(size),
+                prompt=prompt,
+                timeout=self._timeout('dall-e-3'),
+            )
+            return res.data
+
+        async def generate(_):
+            async with self.images_limit:
+                return await self._call('dall-e-3', call)
+
+        async for data in fan_out(num, generate):
+            for img in data:
+                yield img
+
+    async def ask(self, prompt, model_version='gpt-4'):
+        async def call(client, model):
+            res = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        'role': 'user',
+                        'content': prompt,
+                    }
+                ],
+                timeout=self._timeout(model_version),
+            )
+            return res.choices[0].message.content
+
+        return await self._call(model_version, call)
+
+    async def ask_stream(self, prompt, model_version='gpt-4') -> AsyncIterator[str]:
+        """
+        same as ask, yielding the answer's tokens as they're generated
+        """
+
+        async def call(client, model):
+            return await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        'role': 'user',
+                        'content': prompt,
+                    }
+                ],
+                stream=True,
+                timeout=self._timeout(model_version),
+            )
+
+        # the endpoint counts as busy for as long as the stream goes on, not just until it starts
+        stream, endpoint = await self._open(model_version, call)
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:  # azure sends some empty ones
+                    yield chunk.choices[0].delta.content
+        finally:
+            try:
+                await stream.response.aclose()
+            finally:
+                self.router.release(endpoint)
+
+    async def close(self):
+        """
+        closes the connection pool for the current event loop
+        """
+        clients = self.clients.pop(asyncio.get_running_loop(), None)
+        if clients is not None:
+            await clients[1].aclose()
+
+    def _timeout(self, model_kind):
+        return self.timeouts.get(model_kind, self.timeouts['default'])
+
+    async def _call(self, model_kind, fn):
+        clients, _ = self._loop_clients()
+        return await self.router.call(
+            model_kind,
+            lambda endpoint: fn(clients[endpoint.index], endpoint.model or model_kind),
         )
 
-        return response.choices[0].message.content
-
-    def dalle3_txt2img(self, prompt, num, size):
-        client, model = self._get_client('dall-e-3')
-        res = client.images.generate(
-            model=model,
-            n=1,
-            quality='hd',
-            size=dalle_size(size),
-            prompt=prompt,
-        )
-        return res.data
-
-    def ask(self, prompt, model_version='gpt-4'):
-        client, model = self._get_client(model_version)
-        res = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    'role': 'user',
-                    'content': prompt,
-                }
-            ]
+    async def _open(self, model_kind, fn):
+        clients, _ = self._loop_clients()
+        return await self.router.open(
+            model_kind,
+            lambda endpoint: fn(clients[endpoint.index], endpoint.model or model_kind),
         )
-        return res.choices[0].message.content
-
-    def _get_client(self, model_kind):
-        if len(self.azure_clients) > 0:
-            for i, v in enumerate(self.azure_configs):
-                if v['kind'] == model_kind:
-                    return self.azure_clients[i], v['model']
-
-        if len(self.v1_clients) > 0:
-            return self.v1_clients[0], model_kind
 
-        raise Exception("No OpenAI client available!")
+    def _loop_clients(self):
+        loop = asyncio.get_running_loop()
+        clients = self.clients.get(loop)
+        if clients is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                timeout=self.timeouts['default'],
+            )
+
+            clients = self.clients[loop] = ([self._build_client(v, http_client) for v in self.configs], http_client)
+
+        return clients
+
+    def _build_client(self, config, http_client):
+        if config['api_type'] == 'azure':
+            return openai.AsyncAzureOpenAI(
+                api_key=config['api_key'],
+                azure_endpoint=config['base_url'],
+                api_version=config['api_version'],
+                max_retries=self.max_retries,
+                http_client=http_client,
+            )
+        elif config['api_type'] == 'open_ai':
+            return openai.AsyncOpenAI(
+                api_key=config['api_key'],
+                base_url=config['base_url'],
+                max_retries=self.max_retries,
+                http_client=http_client,
+            )
+        return None
@@ -0,0 +1,239 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import openai
+
+# how much each new latency sample weighs on an endpoint's moving average
+LATENCY_SMOOTHING = 0.2
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    failures that say something about the endpoint (throttled, down, slow) rather than about the request itself -
+    those are worth retrying somewhere else
+    """
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    if not isinstance(e, openai.APIStatusError):
+        return None
+    try:
+        return float(e.response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+async def cancellable(aw):
+    """
+    awaits `aw` on a task of its own, so cancelling the caller always cancels it - even when the call itself swallows
+    the cancel (as httpx/anyio can do while a connection is being set up) and goes on to return a result
+    """
+    call = asyncio.ensure_future(aw)
+    try:
+        await asyncio.wait([call])
+    except asyncio.CancelledError:
+        call.cancel()
+        await asyncio.wait([call])
+        raise
+    return call.result()
+
+
+class Endpoint:
+    """
+    one deployment serving a model kind, along with its health stats
+    """
+
+    def __init__(self, index, config, model=None, priority=0):
+        self.index = index  # position on the client's list of endpoints
+        self.config = config
+        self.model = model  # None = serves any model, under its own name
+        self.priority = priority  # lower goes first, higher ones are only used when those are all unavailable
+        self.weight = config.get('weight', 1)
+        self.name = config.get('name') or '/'.join(
+            x for x in [urlparse(config['base_url']).hostname, model] if x)
+
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.throttled = 0
+        self.consecutive_failures = 0
+        self.latency = None  # moving average, in seconds
+        self.open_until = 0  # circuit breaker - unavailable until then
+
+    def available(self, now):
+        return self.open_until <= now
+
+    def score(self):
+        # least outstanding requests (relative to its weight), then fastest
+        return (self.outstanding + 1) / self.weight, self.latency or 0
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'throttled': self.throttled,
+            'latency': self.latency,
+            'open_until': self.open_until,
+        }
+
+
+class EndpointRouter:
+    """
+    spreads calls across every endpoint serving a model kind, sending each one to the endpoint with the fewest
+    requests in flight (scaled by their `weight`).
+
+    Endpoints failing `failure_threshold` times in a row (timeouts, 5xx, throttling) are taken out of rotation for
+    `cooldown` seconds - or for as long as a 429's retry-after says - and then get a single chance to recover.
+    Calls failing that way are retried on another endpoint, up to `attempts` times in total.
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=30, attempts=3, metrics=None, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.attempts = attempts
+        self.metrics = metrics
+        self.clock = clock
+        self.endpoints: dict[str, list[Endpoint]] = {}
+        self.lock = threading.Lock()  # endpoints are shared by the event loops of every worker thread
+
+    def add(self, kind, endpoint: Endpoint):
+        """
+        registers an endpoint serving a model kind - or every kind, with kind='*'
+        """
+        self.endpoints.setdefault(kind, []).append(endpoint)
+
+    def candidates(self, kind) -> list[Endpoint]:
+        return self.endpoints.get(kind, []) + self.endpoints.get('*', [])
+
+    def acquire(self, kind, exclude=()) -> Optional[Endpoint]:
+        """
+        picks an endpoint for a call and counts it as in flight - must be followed by a release()
+        """
+        with self.lock:
+            candidates = [e for e in self.candidates(kind) if e not in exclude]
+            if len(candidates) == 0:
+                return None
+
+            now = self.clock()
+            available = [e for e in candidates if e.available(now)]
+            if len(available) > 0:
+                top = min(e.priority for e in available)
+                endpoint = min((e for e in available if e.priority == top), key=Endpoint.score)
+            else:  # everything is down - try whatever comes back the soonest rather than failing outright
+                endpoint = min(candidates, key=lambda e: e.open_until)
+
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                # half open, a single call gets through - reopens right away if it fails too
+                endpoint.open_until = now + self.cooldown
+
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, elapsed=None, error: Optional[Exception] = None):
+        """
+        records how a call went - without `elapsed`, the call didn't finish (eg cancelled) and tells nothing about it
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
+        self.record(endpoint, elapsed, error)
+
+    def record(self, endpoint: Endpoint, elapsed=None, error: Optional[Exception] = None):
+        """
+        same as release, without taking the call off the endpoint's outstanding ones
+        """
+        with self.lock:
+            if elapsed is None:
+                return
+
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.open_until = 0
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += LATENCY_SMOOTHING * (elapsed - endpoint.latency)
+                self._timing(endpoint, 'latency', elapsed)
+                return
+
+            if not is_retryable(error):  # the request's fault, not the endpoint's
+                return
+
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            self._count(endpoint, 'failures')
+
+            wait = retry_after(error)
+            if isinstance(error, openai.RateLimitError):
+                endpoint.throttled += 1
+                self._count(endpoint, 'throttled')
+
+            if wait is not None:
+                endpoint.open_until = max(endpoint.open_until, self.clock() + wait)
+            elif endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.open_until = self.clock() + self.cooldown
+                self._count(endpoint, 'circuit_open')
+
+    async def call(self, kind, fn):
+        """
+        runs `fn(endpoint)` on the best endpoint available for the given kind, retrying elsewhere on failures
+        """
+        res, endpoint = await self.open(kind, fn)
+        self.release(endpoint)
+        return res
+
+    async def open(self, kind, fn):
+        """
+        same as call, for results that keep the endpoint busy after fn returns (eg streams) - returns the result along
+        with the endpoint, which counts as outstanding until it's release()d
+        """
+        tried = []
+        error = None
+        for _ in range(self.attempts):
+            endpoint = self.acquire(kind, exclude=tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+
+            started = time.perf_counter()
+            try:
+                res = await cancellable(fn(endpoint))
+            except Exception as e:
+                self.release(endpoint, time.perf_counter() - started, e)
+                if not is_retryable(e):
+                    raise
+                error = e
+                continue
+            except BaseException:  # cancelled, doesn't count for or against the endpoint
+                self.release(endpoint)
+                raise
+
+            self.record(endpoint, time.perf_counter() - started)
+            return res, endpoint
+
+        if error is not None:
+            raise error
+        raise Exception(f"No OpenAI endpoint available for {kind}!")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                kind: [e.stats() for e in endpoints]
+                for kind, endpoints in self.endpoints.items()
+            }
+
+    def _count(self, endpoint, metric):
+        if self.metrics:
+            self.metrics.increment(f'openai.{endpoint.name}.{metric}')
+
+    def _timing(self, endpoint, metric, seconds):
+        if self.metrics:
+            self.metrics.timing(f'openai.{endpoint.name}.{metric}', seconds)
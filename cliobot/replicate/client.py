@@ -2,9 +2,13 @@ from types import AsyncGeneratorType
 
 from replicate.client import Client
 
-from cliobot.commands import Model, BasePrompt, GenerationResults, ImageUrl
+from cliobot.bots.ratelimit import ConcurrencyLimit
+from cliobot.commands import Model, BasePrompt, GenerationResults, ImageUrl, fan_out
 from cliobot.utils import decode_image
 
+# predictions running at once, across every endpoint
+DEFAULT_PARALLELISM = 4
+
 
 class ReplicatePrompt(BasePrompt):
     image: str
@@ -12,7 +16,14 @@ class ReplicatePrompt(BasePrompt):
 
 
 class ReplicateEndpoint(Model):
-    def __init__(self, kind, api_key, version, params):
+    """
+    a model hosted on replicate, with its inputs described by `params`.
+
+    A param flagged with `fan_out` (eg num_outputs) is split into that many predictions of one output each, run
+    concurrently - at most as many at a time as `limit` (shared by every endpoint) allows
+    """
+
+    def __init__(self, kind, api_key, version, params, limit: ConcurrencyLimit = None):
         super().__init__(
             prompt_class=None,
         )
@@ -21,8 +32,39 @@ class ReplicateEndpoint(Model):
         self.api_key = api_key
         self.params = params
         self.client = Client(api_key)
+        self.limit = limit or ConcurrencyLimit(DEFAULT_PARALLELISM)
 
     async def generate(self, params) -> GenerationResults:
+        txt = ''
+        imgs = []
+
+        async for r in self._outputs(params):
+            if self.kind == 'image':
+                imgs.append(self._image(r, params))
+            else:
+                txt += r
+
+        if len(txt) > 0:
+            txts = [txt]
+        else:
+            txts = []
+
+        return GenerationResults(
+            texts=txts,
+            images=imgs,
+        )
+
+    async def stream_images(self, params, on_preview=None):
+        async for r in self._outputs(params):
+            yield self._image(r, params)
+
+    def _image(self, output, params):
+        return ImageUrl(
+            url=output,
+            prompt=params['prompt'],
+        )
+
+    def _input_args(self, params) -> dict:
         input_args = {}
         for k, v in self.params.items():
             default = v.get('default', None)
@@ -41,40 +83,51 @@ class ReplicateEndpoint(Model):
             if input_args[k] is None:
                 del input_args[k]
 
-        res = await self.client.async_run(
-            self.version,
-            input_args
-        )
-
-        if isinstance(res, AsyncGeneratorType):
-            result = []
-            async for item in res:
-                result.append(item)
-            res = result
-
-        txt = ''
-        imgs = []
-
-        for r in res:
-            if self.kind == 'image':
-                imgs.append(
-                    ImageUrl(
-                        url=r,
-                        prompt=params['prompt'],
-                    )
-                )
-            else:
-                txt += r
-
-        if len(txt) > 0:
-            txts = [txt]
-        else:
-            txts = []
-
-        return GenerationResults(
-            texts=txts,
-            images=imgs,
-        )
+        return input_args
+
+    async def _outputs(self, params):
+        """
+        yields the prediction's outputs as they come - from all of them, when fanning out
+        """
+        input_args = self._input_args(params)
+
+        fan_out_param = next((k for k, v in self.params.items() if v.get('fan_out')), None)
+        count = int(input_args.get(fan_out_param, 1)) if fan_out_param else 1
+        if count <= 1:
+            async for r in self._predict(input_args):
+                yield r
+            return
+
+        async def predict(i):
+            args = {**input_args, fan_out_param: 1}
+            if args.get('seed') is not None:  # same seed, same image - so each one gets the next seed
+                args['seed'] = int(args['seed']) + i
+            return [r async for r in self._predict(args)]
+
+        async for outputs in fan_out(count, predict):
+            for r in outputs:
+                yield r
+
+    async def _predict(self, input_args):
+        async with self.limit:
+            res = await self.client.async_run(
+                self.version,
+                input_args
+            )
+
+            if isinstance(res, AsyncGeneratorType):  # streamed, the slot is held until it's done
+                async for item in res:
+                    yield item
+                return
+
+        for r in res or []:
+            yield r
+
+    def is_deterministic(self, params) -> bool:
+        return self.kind == 'describe'
+
+    def fingerprint(self) -> str:
+        return f'replicate:{self.version}'
 
 
 
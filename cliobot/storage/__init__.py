@@ -1,8 +1,55 @@
+import asyncio
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
+from cliobot.fetch import BlockingReader
+from cliobot.utils import CHUNK_SIZE
 
-class LocalStorage:
+
+class Storage:
+    """
+    base class for file storages. Calls block - the bot core goes through an AsyncStorage instead
+    """
+
+    def save_data(self, data, path, mimetype) -> str:
+        """
+        data is either bytes or a readable file object. Returns the path it was saved to
+        """
+        raise NotImplementedError()
+
+    async def asave_data(self, data, path, mimetype) -> str:
+        """
+        same as save_data, off the event loop - data can also be an async iterator of byte chunks
+        """
+        if hasattr(data, '__aiter__'):
+            data = BlockingReader(data, asyncio.get_running_loop())
+        return await asyncio.to_thread(self.save_data, data, path, mimetype)
+
+    def get_data(self, path) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def exists(self, path) -> bool:
+        raise NotImplementedError()
+
+    def stream_data(self, path, localpath):
+        """
+        copies the file at `path` to `localpath`
+        """
+        raise NotImplementedError()
+
+    def full_path(self, path):
+        return os.path.join(self.base_path(), path)
+
+    def base_path(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class LocalStorage(Storage):
     '''save image to local storage'''
 
     def __init__(self, folder="./"):
@@ -11,18 +58,21 @@ class LocalStorage:
         os.makedirs(folder, exist_ok=True)
 
     def save_data(self, data, path, mimetype):
+        """
+        data is either bytes or a readable file object, copied over a chunk at a time
+        """
         if path.startswith('/'):
             path = path[1:]
 
         os.makedirs(os.path.join(self.folder, os.path.dirname(path)), exist_ok=True)
         with open(os.path.join(self.folder, path), 'wb') as f:
-            f.write(data)
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, CHUNK_SIZE)
 
         return path
 
-    def full_path(self, path):
-        return os.path.join(self.base_path(), path)
-
     def base_path(self):
         return self.folder
 
@@ -38,6 +88,77 @@ class LocalStorage:
         if not os.path.exists(remote):
             raise FileNotFoundError(remote)
 
-        with open(remote, 'rb') as f:
-            with open(localpath, 'wb') as f2:
-                f2.write(f.read())
\ No newline at end of file
+        shutil.copyfile(remote, localpath)
+
+
+class AsyncStorage:
+    """
+    non-blocking version of Storage, used by the bot core
+    """
+
+    async def save_data(self, data, path, mimetype) -> str:
+        """
+        data is either bytes, a readable file object or an async iterator of byte chunks. Returns the path it was
+        saved to
+        """
+        raise NotImplementedError()
+
+    async def get_data(self, path) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    async def exists(self, path) -> bool:
+        raise NotImplementedError()
+
+    async def stream_data(self, path, localpath):
+        raise NotImplementedError()
+
+    def full_path(self, path):
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        called once the bot stops, outside of any event loop
+        """
+        pass
+
+
+class AsyncStorageAdapter(AsyncStorage):
+    """
+    exposes a (blocking) Storage as an AsyncStorage. Saves go through the storage's own asave_data (eg S3Storage
+    uploads on a pool of its own), everything else runs on a dedicated pool of `workers` threads.
+    """
+
+    def __init__(self, storage: Storage, workers=4, name='storage'):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-reader')
+
+    async def save_data(self, data, path, mimetype) -> str:
+        return await self.storage.asave_data(data, path, mimetype)
+
+    async def get_data(self, path) -> Optional[bytes]:
+        return await self._run(self.storage.get_data, path)
+
+    async def exists(self, path) -> bool:
+        return await self._run(self.storage.exists, path)
+
+    async def stream_data(self, path, localpath):
+        return await self._run(self.storage.stream_data, path, localpath)
+
+    def full_path(self, path):
+        return self.storage.full_path(path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.storage.close()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+
+def async_storage(storage) -> Optional[AsyncStorage]:
+    """
+    wraps blocking storages with an AsyncStorageAdapter, leaves async ones alone
+    """
+    if storage is None or isinstance(storage, AsyncStorage):
+        return storage
+    return AsyncStorageAdapter(storage)
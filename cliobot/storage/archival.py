@@ -0,0 +1,170 @@
+import asyncio
+import threading
+
+from cliobot.db import AsyncDatabase
+from cliobot.db.utils import save_to_storage
+from cliobot.fetch import fetcher
+from cliobot.storage import AsyncStorage
+
+
+class ArchivalQueue:
+    """
+    stores generated outputs in the background: archive() saves a file to storage and records it on the db (like
+    upload_asset), on an event loop of its own - so results are shown as soon as they're ready rather than once they're
+    stored, and storing them doesn't depend on the handler that asked for it still being around.
+
+    Up to `concurrency` files are stored at once. A failed step is retried up to `max_retries` times, `retry_delay`
+    seconds apart (doubling every time) - and a failed db write doesn't upload the file again. Once `max_pending`
+    files are waiting, archive() waits for room instead of piling them up (or dropping them). Whatever is pending on
+    close() gets up to `shutdown_timeout` seconds to be stored - files archived after that are dropped (and counted
+    as such).
+    """
+
+    def __init__(self, storage: AsyncStorage, db: AsyncDatabase, concurrency=4, max_retries=3, retry_delay=1,
+                 max_pending=1000, shutdown_timeout=30, metrics=None):
+        self.storage = storage
+        self.db = db
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_pending = max_pending
+        self.shutdown_timeout = shutdown_timeout
+        self.metrics = metrics
+
+        self.loop = None
+        self.queue = None
+        self.thread = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = None
+
+    async def archive(self, session, local_path, folder, file_id=None, data=None, mimetype=None):
+        """
+        queues a file to be stored - see upload_asset for the arguments. Returns once it's queued, not stored
+        """
+        job = dict(
+            session=session,
+            local_path=local_path,
+            folder=folder,
+            file_id=file_id,
+            data=data,
+            mimetype=mimetype,
+        )
+        with self.lock:  # so close() can't shut the loop down in between
+            if self.closed:
+                queued = None
+            else:
+                self._start()
+                queued = asyncio.run_coroutine_threadsafe(self._put(job), self.loop)
+
+        if queued is None or not await asyncio.wrap_future(queued):
+            print("Not storing file, the archival queue is closed")
+            self._count('dropped')
+
+    async def join(self):
+        """
+        waits until everything queued so far is stored (or given up on)
+        """
+        if self.loop is None or self.loop.is_closed():
+            return
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.queue.join(), self.loop))
+
+    def close(self):
+        with self.lock:
+            running = self.thread is not None and not self.closed
+            self.closed = True
+        if not running:
+            return
+
+        self.loop.call_soon_threadsafe(self._stopping.set)
+        self.thread.join(self.shutdown_timeout + 1)
+
+    def _start(self):
+        # called with the lock held
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    async def _serve(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self._stopping = asyncio.Event()
+        for _ in range(self.concurrency):
+            asyncio.create_task(self._work())
+        self._ready.set()
+
+        await self._stopping.wait()
+        try:
+            await asyncio.wait_for(self.queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            print(f"Gave up on storing {self.queue.qsize()} files")
+        # the workers, and anyone still waiting for room
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await fetcher.close()
+
+    async def _put(self, job) -> bool:
+        try:
+            await self.queue.put(job)
+            return True
+        except asyncio.CancelledError:  # shut down while waiting for room
+            return False
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._store(**job)
+                self._count('stored')
+            except Exception as e:
+                print("Failed to store file:", e)
+                self._count('failed')
+                if self.metrics:
+                    self.metrics.capture_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def _store(self, session, local_path, folder, file_id, data, mimetype):
+        external_id, storage_path = await self._retry(lambda: save_to_storage(
+            session=session,
+            local_path=local_path,
+            storage=self.storage,
+            folder=folder,
+            file_id=file_id,
+            data=data,
+            mimetype=mimetype,
+        ))
+
+        await self._retry(lambda: self.db.save_asset(
+            external_id=external_id,
+            user_id=session.user_id,
+            chat_id=session.chat_id,
+            storage_path=storage_path,
+        ))
+
+    async def _retry(self, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Failed to store file, retrying ({attempt + 1}/{self.max_retries}):", e)
+                self._count('retries')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    def _count(self, metric, value=1):
+        if self.metrics:
+            self.metrics.increment(f'archival.{metric}', value)
@@ -1,28 +1,81 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-class S3Storage:
-    def __init__(self, access_key, secret, bucket, region):
+from cliobot.fetch import BlockingReader
+from cliobot.storage import Storage
+
+MB = 1024 * 1024
+
+
+class S3Storage(Storage):
+    """
+    files stored on an S3 bucket (or anything speaking its API, at `endpoint_url`).
+
+    Uploads are managed transfers: anything over `multipart_threshold` goes up in `multipart_chunksize` parts,
+    `max_concurrency` of them at a time, reading the data as it goes rather than all at once.
+
+    asave_data runs them on a dedicated pool of `workers` threads, so lots of big uploads can be going on without
+    holding up the event loop (or the default executor).
+    """
+
+    def __init__(self, access_key, secret, bucket, region, workers=8, multipart_threshold=8 * MB,
+                 multipart_chunksize=8 * MB, max_concurrency=4, endpoint_url=None):
         self.bucket = bucket
         self.s3 = boto3.client('s3',
                                aws_access_key_id=access_key,
                                aws_secret_access_key=secret,
-                               region_name=region)
-        self.bucket = bucket
+                               region_name=region,
+                               endpoint_url=endpoint_url,
+                               # enough connections for every part of every upload in flight
+                               config=Config(max_pool_connections=workers * max_concurrency))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+        )
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='s3-upload')
         print(f'Connected to S3')
 
     def full_path(self, path):
         return self.base_path() + path
 
     def upload_file(self, file, key):
-        self.s3.upload_file(file, self.bucket, key)
-
+        self.s3.upload_file(file, self.bucket, key, Config=self.transfer_config)
 
     def base_path(self):
         return f'https://{self.bucket}.s3.amazonaws.com/'
 
     def save_data(self, data, path, mimetype):
-        self.s3.put_object(Body=data, Bucket=self.bucket, Key=path, ContentType=mimetype)
+        """
+        data is either bytes or a readable file object
+        """
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+
+        self.s3.upload_fileobj(
+            data,
+            self.bucket,
+            path,
+            ExtraArgs={'ContentType': mimetype} if mimetype else None,
+            Config=self.transfer_config,
+        )
+        return path
+
+    async def asave_data(self, data, path, mimetype):
+        """
+        same as save_data, on the upload threads - data can also be an async iterator of byte chunks, uploaded as
+        they come
+        """
+        loop = asyncio.get_running_loop()
+        if hasattr(data, '__aiter__'):
+            data = BlockingReader(data, loop)
+        return await loop.run_in_executor(self.executor, self.save_data, data, path, mimetype)
 
     def get_data(self, path):
         return self.fetch_file(path)['Body'].read()
@@ -45,9 +98,12 @@ class S3Storage:
 
     def stream_data(self, path, localpath):
         try:
-            return self.s3.download_file(self.bucket, path, localpath)
+            return self.s3.download_file(self.bucket, path, localpath, Config=self.transfer_config)
         except ClientError as e:
             if e.response['Error']['Code'] == "404":
                 print("The object does not exist.")
                 raise FileNotFoundError(path)
             raise e
+
+    def close(self):
+        self.executor.shutdown(wait=True)
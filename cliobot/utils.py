@@ -2,12 +2,20 @@ import base64
 import hashlib
 import io
 import os
+import tempfile
 from io import BytesIO
 from pathlib import Path
+from urllib.parse import urlsplit
 
 import requests
 from PIL import Image
 
+# how much of a file is read (or written) at a time, when streaming it
+CHUNK_SIZE = 64 * 1024
+
+# files being streamed are kept in memory up to this size, and spill over to a temp file beyond it
+SPOOL_SIZE = 1024 * 1024
+
 
 def md5_hash(txt):
     md5 = hashlib.md5()
@@ -20,8 +28,8 @@ def abs_path(path):
 
 
 def base64_to_bytes(base64_string):
-    if base64_string.startswith('data:image/png;base64,'):
-        base64_string = base64_string[len('data:image/png;base64,'):]
+    if base64_string.startswith('data:') and ';base64,' in base64_string:  # data url, of any mime type
+        base64_string = base64_string.split(';base64,', 1)[1]
     return base64.b64decode(base64_string)
 
 
@@ -100,13 +108,31 @@ def image_to_base64(image):
 
 def open_image(r):
     if r.startswith('http'):
-        return Image.open(BytesIO(download(r)))
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)  # freed along with the image
+        download(r, f)
+        f.seek(0)
+        return Image.open(f)
     return Image.open(r)
 
 
-def download(url):
-    r = requests.get(url)
-    if r.status_code == 200:
-        return r.content
-    else:
-        raise Exception(f"Failed to download {url} {r.status_code}")
+def redact(url) -> str:
+    """
+    url without its path or query, which can carry secrets - eg telegram's file urls have the bot token in them
+    """
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}/...'
+
+
+def download(url, out=None):
+    """
+    downloads url - streamed into `out` (any writable file object) a chunk at a time, if given. Otherwise the
+    contents are returned
+    """
+    with requests.get(url, stream=True) as r:
+        if r.status_code != 200:
+            raise Exception(f"Failed to download {redact(url)} {r.status_code}")
+
+        if out is None:
+            return r.content
+        for chunk in r.iter_content(CHUNK_SIZE):
+            out.write(chunk)
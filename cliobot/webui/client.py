@@ -1,24 +1,26 @@
+import asyncio
 import base64
-import io
 import os.path
 import random
+import weakref
 
+import aiohttp
 import requests
-from PIL import Image
 
-from cliobot.commands import Model, BasePrompt, GenerationResults
+from cliobot.commands import Model, BasePrompt, GenerationResults, ImageUrl
 from cliobot.utils import base64_to_bytes, abs_path
 
 
-def save_image(base64data, folder):
-    image = Image.open(
-        io.BytesIO(
-            base64_to_bytes(base64data)
-        ))
+def save_image(data: bytes, folder):
+    """
+    writes an image as is (webui returns PNGs) to a randomly named file, and returns its path
+    """
     filepath = abs_path(os.path.join(
         folder,
         f'{str(int(random.random() * 100000000))}.png'))
-    image.save(filepath)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as f:
+        f.write(data)
     return filepath
 
 
@@ -43,21 +45,49 @@ class Txt2img(Model):
         self.model = model
 
     async def generate(self, prompt):
-        print("here!", prompt)
         return await self.client.txt2img(prompt)
 
+    def is_deterministic(self, parsed) -> bool:
+        return parsed.seed != -1  # -1 = random seed
+
+    def fingerprint(self) -> str:
+        return f'webui:{self.client.endpoint}:{self.model}'
+
+    async def generate_with_previews(self, prompt, on_preview) -> GenerationResults:
+        return await self.client.txt2img(prompt, on_preview=on_preview)
+
 
 class WebuiClient:
+    """
+    async client for Auto1111's WebUI API, keeping connections alive across calls (one session per event loop).
+
+    While a txt2img job runs, its progress is polled every `progress_interval` seconds, and the in-progress
+    image handed over as a preview. WebUI only reports progress for whatever job it's running at the moment - so
+    previews are only sent while this client has a single job in flight, as they can't be told apart otherwise.
 
-    def __init__(self, endpoint, auth, temp_dir = 'tmp'):
-        self.endpoint = endpoint
-        self.auth = auth  # TODO use
+    Generated images are returned as raw bytes, exactly as webui sent them. They're only written to files (under
+    `temp_dir`) if one is set.
+    """
+
+    def __init__(self, endpoint, auth, temp_dir=None, progress_interval=1.0, timeout=600):
+        self.endpoint = endpoint.rstrip('/')
+        self.auth = auth
         self.temp_dir = temp_dir
+        self.progress_interval = progress_interval
+        self.timeout = timeout
+        self.in_flight = 0
+        self.sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp session
 
     def get_models(self):
-        return self._get(f'/sdapi/v1/sd-models')
-
-    async def txt2img(self, parsed) -> GenerationResults:
+        """
+        blocking - meant to be called on boot only
+        """
+        return requests.get(self.endpoint + '/sdapi/v1/sd-models', headers=self._headers()).json()
+
+    async def txt2img(self, parsed, on_preview=None) -> GenerationResults:
+        """
+        :param on_preview: async function called with the bytes and progress (0 to 1) of every new preview
+        """
         params = {
             'cfg_scale': parsed.cfg,
             'width': parsed.width,
@@ -69,18 +99,30 @@ class WebuiClient:
             'negative_prompt': parsed.negative,
             'steps': parsed.steps,
             'sampler_name': parsed.sampler,
-        }  # TODO previews
+        }
 
-        r = self._post(f'/sdapi/v1/txt2img', params)
+        self.in_flight += 1
+        try:
+            job = asyncio.create_task(self._post('/sdapi/v1/txt2img', params))
+            if on_preview is not None:
+                await self._watch_progress(job, on_preview)
+            r = await job
+        finally:
+            self.in_flight -= 1
 
         imgs = []
 
         for i in r['images']:
-            path = save_image(i, self.temp_dir)
-            imgs.append({
-                'url': path,
-                'prompt': parsed.prompt,
-            })
+            data = base64_to_bytes(i)
+            path = None
+            if self.temp_dir:
+                path = await asyncio.to_thread(save_image, data, self.temp_dir)
+
+            imgs.append(ImageUrl(
+                url=path,
+                data=data,
+                prompt=parsed.prompt,
+            ))
 
         return GenerationResults(
             texts=[],
@@ -131,22 +173,62 @@ class WebuiClient:
         #     "alwayson_scripts": {}
         # }
 
-    def _get(self, path):
-        args = {}
-        if self.auth:
-            encoded_credentials = base64.b64encode(self.auth.encode()).decode()
-            args['headers'] = {
-                'Authorization': f'Basic {encoded_credentials}',
-            }
-
-        return requests.get(self.endpoint + path, **args).json()
-
-    def _post(self, path, params):
-        args = {}
-        if self.auth:
-            encoded_credentials = base64.b64encode(self.auth.encode()).decode()
-            args['headers'] = {
-                'Authorization': f'Basic {encoded_credentials}',
-            }
-
-        return requests.post(self.endpoint + path, json=params, **args).json()
+    async def close(self):
+        """
+        closes the session for the current event loop
+        """
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def _watch_progress(self, job, on_preview):
+        last_preview = None
+        while True:
+            done, _ = await asyncio.wait([job], timeout=self.progress_interval)
+            if done:
+                return
+
+            if self.in_flight > 1:
+                continue
+
+            try:
+                progress = await self._get('/sdapi/v1/progress?skip_current_image=false')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:  # previews are best effort
+                print("Failed to get progress:", e)
+                continue
+
+            preview = progress.get('current_image')
+            if preview and preview != last_preview and not job.done():
+                last_preview = preview
+                try:
+                    await on_preview(base64_to_bytes(preview), progress.get('progress', 0))
+                except Exception as e:
+                    print("Failed to show preview:", e)
+
+    async def _get(self, path):
+        async with self._session().get(self.endpoint + path, headers=self._headers()) as r:
+            r.raise_for_status()
+            return await r.json()
+
+    async def _post(self, path, params):
+        async with self._session().post(self.endpoint + path, json=params, headers=self._headers()) as r:
+            r.raise_for_status()
+            return await r.json()
+
+    def _headers(self):
+        if not self.auth:
+            return {}
+
+        encoded_credentials = base64.b64encode(self.auth.encode()).decode()
+        return {
+            'Authorization': f'Basic {encoded_credentials}',
+        }
+
+    def _session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = self.sessions[loop] = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return session
@@ -0,0 +1,67 @@
+"""
+a stand-in for Auto1111's WebUI API, for tests: txt2img takes `steps` * `step_time` seconds, and reports its
+progress (with a preview of the current step) on /sdapi/v1/progress meanwhile
+"""
+import asyncio
+import base64
+import io
+
+from PIL import Image
+from aiohttp import web
+
+
+def png(color, size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+class FakeWebui:
+
+    def __init__(self, step_time=0.05):
+        self.step_time = step_time
+        self.progress = {'progress': 0, 'current_image': None}
+        self.requests = []
+        self.runner = None
+        self.endpoint = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/sdapi/v1/txt2img', self.txt2img)
+        app.router.add_get('/sdapi/v1/progress', self.get_progress)
+        app.router.add_get('/sdapi/v1/sd-models', self.sd_models)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.endpoint = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+        return self.endpoint
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def txt2img(self, request):
+        params = await request.json()
+        self.requests.append(params)
+
+        steps = params.get('steps', 20)
+        for step in range(steps):
+            self.progress = {
+                'progress': step / steps,
+                'current_image': png((step * 10 % 256, 0, 0)) if step > 0 else None,
+            }
+            await asyncio.sleep(self.step_time)
+        self.progress = {'progress': 0, 'current_image': None}
+
+        count = params.get('batch_size', 1) * params.get('n_iter', 1)
+        return web.json_response({
+            'images': [png((0, 0, 255)) for _ in range(count)],
+            'parameters': params,
+        })
+
+    async def get_progress(self, request):
+        return web.json_response(self.progress)
+
+    async def sd_models(self, request):
+        return web.json_response([{'model_name': 'sdxl', 'title': 'sdxl.safetensors'}])
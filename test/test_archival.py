@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import unittest
+from types import SimpleNamespace
+
+from cliobot.db import AsyncDatabase
+from cliobot.errors import BaseErrorHandler
+from cliobot.metrics import BaseMetrics
+from cliobot.storage import AsyncStorage
+from cliobot.storage.archival import ArchivalQueue
+
+
+class FlakyStorage(AsyncStorage):
+    def __init__(self, failures=0, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.saved = {}
+        self.attempts = 0
+        self.running = 0
+        self.peak = 0
+
+    async def save_data(self, data, path, mimetype) -> str:
+        self.attempts += 1
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures > 0:
+                self.failures -= 1
+                raise Exception('storage is down')
+            self.saved[path] = data
+            return path
+        finally:
+            self.running -= 1
+
+
+class FlakyDb(AsyncDatabase):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.assets = []
+        self.lock = threading.Lock()
+
+    async def save_asset(self, external_id, user_id, chat_id, storage_path) -> dict:
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception('db is down')
+        with self.lock:
+            self.assets.append(storage_path)
+        return {'storage_path': storage_path}
+
+
+SESSION = SimpleNamespace(user_id='1', chat_id='2')
+
+
+class TestArchivalQueue(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.metrics = BaseMetrics(BaseErrorHandler())
+
+    def queue(self, storage, db, **kwargs):
+        q = ArchivalQueue(storage, db, retry_delay=0.01, metrics=self.metrics, **kwargs)
+        self.addCleanup(q.close)
+        return q
+
+    async def archive(self, q, i):
+        await q.archive(SESSION, None, 'outputs', data=bytes([i]), mimetype='image/png')
+
+    async def test_retries(self):
+        storage, db = FlakyStorage(failures=2), FlakyDb(failures=1)
+        q = self.queue(storage, db)
+
+        await self.archive(q, 1)
+        await q.join()
+
+        self.assertEqual(len(storage.saved), 1)
+        self.assertEqual(storage.attempts, 3)  # a failed db write doesn't upload it again
+        self.assertEqual(db.assets, list(storage.saved))
+        self.assertEqual(self.metrics.counters['archival.retries'], 3)
+        self.assertEqual(self.metrics.counters['archival.stored'], 1)
+
+    async def test_gives_up(self):
+        storage, db = FlakyStorage(failures=3), FlakyDb()
+        q = self.queue(storage, db, concurrency=1, max_retries=2)
+
+        await self.archive(q, 1)
+        await self.archive(q, 2)
+        await q.join()
+
+        self.assertEqual(self.metrics.counters['archival.failed'], 1)
+        self.assertEqual(len(db.assets), 1)  # the next one still went through
+
+    async def test_bounded_concurrency(self):
+        storage, db = FlakyStorage(delay=0.02), FlakyDb()
+        q = self.queue(storage, db, concurrency=3, max_pending=2)
+
+        for i in range(10):
+            await self.archive(q, i)
+        self.assertLess(len(db.assets), 10)  # archive() doesn't wait for them to be stored
+        await q.join()
+
+        self.assertEqual(len(db.assets), 10)
+        self.assertEqual(storage.peak, 3)
+
+    async def test_closed(self):
+        storage, db = FlakyStorage(delay=0.05), FlakyDb()
+        q = self.queue(storage, db, concurrency=1, max_pending=1, shutdown_timeout=0.01)
+
+        await self.archive(q, 0)  # being stored
+        await self.archive(q, 1)  # queued
+        waiting = asyncio.create_task(self.archive(q, 2))  # waiting for room
+        await asyncio.sleep(0.01)
+        await asyncio.to_thread(q.close)
+        q.close()  # again, no-op
+
+        await asyncio.wait_for(waiting, 1)
+        await asyncio.wait_for(self.archive(q, 3), 1)  # neither stored nor stuck
+        self.assertEqual(self.metrics.counters['archival.dropped'], 2)
+
+    def test_across_loops(self):
+        storage, db = FlakyStorage(delay=0.01), FlakyDb()
+        q = ArchivalQueue(storage, db, concurrency=2)
+
+        def worker(n):
+            async def run():
+                for i in range(5):
+                    await self.archive(q, n * 5 + i)
+
+            asyncio.run(run())
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        q.close()  # what's still pending gets stored before it returns
+
+        self.assertEqual(len(db.assets), 20)
@@ -0,0 +1,450 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import fakeredis
+
+from cliobot.cache import InMemoryCache, SingleFlight, TieredCache
+from cliobot.cache.disk_cache import DiskCache
+from cliobot.cache.media_cache import MediaCache
+from cliobot.cache.redis_cache import RedisCache
+from cliobot.bots import MessagingService
+from cliobot.commands import Model, GenerationResults, ModelBackedCommand, result_key, ImageUrl
+from cliobot.db.utils import cached_get_file
+from cliobot.errors import BaseErrorHandler
+from cliobot.metrics import BaseMetrics
+
+
+class TestInMemoryCache(unittest.IsolatedAsyncioTestCase):
+
+    def test_lru(self):
+        cache = InMemoryCache(max_items=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = InMemoryCache(ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=10)
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_max_bytes(self):
+        cache = InMemoryCache(max_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        self.assertEqual(cache.stats()['bytes'], 10)
+
+        cache.set('c', b'1')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+    def test_max_bytes_nested(self):
+        cache = InMemoryCache(max_bytes=12 * 1024 * 1024)
+        for i in range(3):
+            cache.set(i, GenerationResults(images=[ImageUrl(data=bytes([i]) * 5 * 1024 * 1024, prompt='a hamster')]))
+
+        self.assertIsNone(cache.get(0))  # counted by the images it holds, not the object around them
+        self.assertIsNotNone(cache.get(2))
+        self.assertGreater(cache.stats()['bytes'], 5 * 1024 * 1024)
+
+    def test_counters(self):
+        metrics = BaseMetrics(BaseErrorHandler())
+        cache = InMemoryCache(name='test', metrics=metrics)
+        cache.set('a', None)
+        cache.get('a')
+        cache.get('b')
+
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+        self.assertEqual(metrics.counters, {'test.hits': 1, 'test.misses': 1})
+
+    async def test_get_or_compute(self):
+        cache = InMemoryCache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        res = await asyncio.gather(*[cache.get_or_compute('a', compute) for _ in range(10)])
+        self.assertEqual(res, ['result'] * 10)
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(await cache.get_or_compute('a', compute), 'result')
+        self.assertEqual(len(calls), 1)
+
+    async def test_singleflight_errors(self):
+        sf = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise ValueError('boom')
+
+        res = await asyncio.gather(*[sf.do('a', fail) for _ in range(3)], return_exceptions=True)
+        self.assertTrue(all([isinstance(r, ValueError) for r in res]))
+        self.assertEqual(sf.in_flight(), 0)
+
+    async def test_singleflight_cancelled_leader(self):
+        sf = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        leader = asyncio.create_task(sf.do('a', compute))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(sf.do('a', compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+
+        self.assertEqual(await follower, 'result')  # took over, rather than being cancelled too
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(leader.cancelled())
+
+    async def test_singleflight_cancelled_follower(self):
+        sf = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        leader = asyncio.create_task(sf.do('a', compute))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(sf.do('a', compute))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await follower
+        self.assertEqual(await leader, 'result')  # carried on without it
+
+    def test_singleflight_across_loops(self):
+        sf = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        async def compute():
+            calls.append(threading.current_thread().name)
+            started.set()
+            await asyncio.sleep(0.1)
+            return 'result'
+
+        def worker(results):
+            results.append(asyncio.run(sf.do('a', compute)))
+
+        results = []
+        threads = [threading.Thread(target=worker, args=(results,)) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        [t.start() for t in threads[1:]]
+        [t.join() for t in threads]
+
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sf.in_flight(), 0)
+
+
+class TestDiskCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_get_set(self):
+        cache = DiskCache(self.folder.name)
+        cache.set('a', {'foo': [1, 2]})
+        self.assertEqual(cache.get('a'), {'foo': [1, 2]})
+        self.assertIsNone(cache.get('b'))
+
+        # survives restarts
+        self.assertEqual(DiskCache(self.folder.name).get('a'), {'foo': [1, 2]})
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_lru(self):
+        cache = DiskCache(self.folder.name, max_bytes=2500)
+        for k in ['a', 'b']:
+            cache.set(k, b'x' * 1000)
+            time.sleep(0.01)
+
+        cache.get('a')  # b is now the least recently used
+        cache.set('c', b'x' * 1000)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(os.listdir(self.folder.name)), 2)
+
+    def test_ttl(self):
+        cache = DiskCache(self.folder.name, ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 1, ttl=10)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 1)
+
+    async def test_tiered(self):
+        memory = InMemoryCache(max_items=1)
+        cache = TieredCache([memory, DiskCache(self.folder.name)])
+
+        await cache.aset('a', 1)
+        await cache.aset('b', 2)  # evicts a from memory, but not from disk
+        self.assertEqual(memory.get('a'), None)
+
+        self.assertEqual(await cache.aget('a'), 1)
+        self.assertEqual(memory.get('a'), 1)  # back in memory
+        self.assertEqual(cache.get('c', 'nope'), 'nope')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class Echo(Model):
+    def __init__(self, delay=0):
+        super().__init__(prompt_class=None)
+        self.calls = 0
+        self.delay = delay
+
+    async def generate(self, parsed) -> GenerationResults:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return GenerationResults(texts=[parsed['prompt']])
+
+    def is_deterministic(self, parsed) -> bool:
+        return parsed.get('seed') != -1
+
+
+class TestResultCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_generate(self):
+        metrics = BaseMetrics(BaseErrorHandler())
+        bot = SimpleNamespace(results_cache=InMemoryCache(name='results', metrics=metrics))
+        command = ModelBackedCommand('echo', 'echo', '', [], {})
+        model = Echo()
+
+        for _ in range(3):
+            res = await command.generate(model, {'command': 'echo', 'prompt': 'hi '}, bot)
+            self.assertEqual(res.texts, ['hi '])
+        await command.generate(model, {'command': 'other', 'prompt': 'hi'}, bot)  # same prompt, normalized
+        self.assertEqual(model.calls, 1)
+
+        await command.generate(model, {'prompt': 'hi', 'seed': -1}, bot)
+        await command.generate(model, {'prompt': 'hi', 'seed': -1}, bot)
+        self.assertEqual(model.calls, 3)  # not deterministic
+
+        self.assertEqual(metrics.counters['results.hits'], 3)
+        self.assertEqual(metrics.counters['results.misses'], 1)
+
+    async def test_coalesces_without_cache(self):
+        bot = SimpleNamespace(results_cache=None)
+        command = ModelBackedCommand('echo', 'echo', '', [], {})
+        model = Echo(delay=0.05)
+
+        res = await asyncio.gather(*[command.generate(model, {'prompt': 'hi'}, bot) for _ in range(5)])
+        self.assertEqual([r.texts for r in res], [['hi']] * 5)
+        self.assertEqual(model.calls, 1)
+
+        await command.generate(model, {'prompt': 'hi'}, bot)  # not in flight anymore
+        self.assertEqual(model.calls, 2)
+
+        await asyncio.gather(*[command.generate(model, {'prompt': 'hi', 'seed': -1}, bot) for _ in range(2)])
+        self.assertEqual(model.calls, 4)  # not deterministic, each gets its own
+
+    async def test_key_hashes_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, f) for f in ['a.jpg', 'b.jpg', 'c.jpg']]
+            for path, content in zip(paths, [b'meme', b'meme', b'other']):
+                with open(path, 'wb') as f:
+                    f.write(content)
+
+            keys = [await result_key(Echo(), {'prompt': 'whats this?', 'image': p}) for p in paths]
+            self.assertEqual(keys[0], keys[1])  # same contents, different files
+            self.assertNotEqual(keys[0], keys[2])
+
+
+class FileMessagingService(MessagingService):
+    def __init__(self):
+        self.info_calls = 0
+        self.downloads = 0
+
+    async def get_file_info(self, file_id):
+        self.info_calls += 1
+        await asyncio.sleep(0.02)
+        return {'file_path': f'voice/{file_id}.oga'}
+
+    async def get_file(self, file_id):
+        self.downloads += 1
+        await asyncio.sleep(0.05)
+        return f'voice/{file_id}.oga', b'voice note'
+
+
+class TestMediaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_get_set(self):
+        metrics = BaseMetrics(BaseErrorHandler())
+        cache = MediaCache(self.folder.name, janitor_interval=None, metrics=metrics)
+
+        path = cache.set('1/voice.oga', b'voice note')
+        self.assertEqual(cache.get('1/voice.oga'), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'voice note')
+        self.assertIsNone(cache.get('1/other.oga'))
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['voice.oga'])  # no temp files left around
+
+        self.assertEqual(metrics.counters, {'media_cache.hits': 1, 'media_cache.misses': 1})
+        with self.assertRaises(ValueError):
+            cache.get('../outside')
+
+    def test_overwrites(self):
+        cache = MediaCache(self.folder.name, max_bytes=2500, janitor_interval=None)
+        for _ in range(5):
+            cache.set('1/voice.oga', b'x' * 1000)
+        self.assertEqual((cache.stats()['items'], cache.stats()['bytes']), (1, 1000))
+        self.assertIsNotNone(cache.get('1/voice.oga'))  # never went over the quota
+
+        cache.delete('1/voice.oga')
+        self.assertEqual((cache.stats()['items'], cache.stats()['bytes']), (0, 0))
+
+    def test_lru(self):
+        cache = MediaCache(self.folder.name, max_bytes=2500, janitor_interval=None)
+        cache.set('1/a', b'x' * 1000)
+        time.sleep(0.05)
+        cache.set('1/b', b'x' * 1000)
+        time.sleep(0.05)
+        cache.get('1/a')  # b is now the least recently used
+        time.sleep(0.05)
+        cache.set('1/c', b'x' * 1000)
+
+        self.assertIsNone(cache.get('1/b'))
+        self.assertIsNotNone(cache.get('1/a'))
+        self.assertIsNotNone(cache.get('1/c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], 2000)
+
+    def test_janitor(self):
+        cache = MediaCache(self.folder.name, max_bytes=2500, janitor_interval=10)
+        self.assertIsNone(cache.janitor)  # not until it's started
+        cache.start()
+        stale = os.path.join(self.folder.name, '.tmp-crashed')
+        with open(stale, 'wb') as f:
+            f.write(b'x')
+        os.utime(stale, (0, 0))
+
+        for k in ['a', 'b', 'c']:
+            cache.set(k, b'x' * 1000)
+            time.sleep(0.05)
+
+        for _ in range(100):  # woken up by going over quota, rather than waiting for the interval
+            if cache.stats()['evictions'] > 0:
+                break
+            time.sleep(0.01)
+        cache.close()
+
+        self.assertEqual(sorted(os.listdir(self.folder.name)), ['b', 'c'])
+        self.assertEqual(MediaCache(self.folder.name, janitor_interval=None).stats()['bytes'], 2000)
+
+
+class TestCachedGetFile(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.session = SimpleNamespace(user_id='1')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def bot(self, **kwargs):
+        return SimpleNamespace(
+            messaging_service=FileMessagingService(),
+            media_cache=MediaCache(os.path.join(self.folder.name, 'media'), janitor_interval=None),
+            **kwargs,
+        )
+
+    async def test_concurrent_downloads(self):
+        bot = self.bot()
+
+        paths = await asyncio.gather(*[cached_get_file('abc', bot, self.session) for _ in range(5)])
+        self.assertEqual(len(set(paths)), 1)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'voice note')
+
+        self.assertEqual(bot.messaging_service.info_calls, 1)
+        self.assertEqual(bot.messaging_service.downloads, 1)
+
+    async def test_files_index(self):
+        index = os.path.join(self.folder.name, 'index')
+        bot = self.bot(files_index=DiskCache(index))
+
+        path = await cached_get_file('abc', bot, self.session)
+        self.assertEqual(bot.messaging_service.info_calls, 1)
+
+        bot.files_index = DiskCache(index)  # survives restarts
+        self.assertEqual(await cached_get_file('abc', bot, self.session), path)
+        self.assertEqual(bot.messaging_service.info_calls, 1)  # no calls to telegram at all
+        self.assertEqual(bot.messaging_service.downloads, 1)
+
+        os.remove(path)  # evicted, downloaded again
+        self.assertEqual(await cached_get_file('abc', bot, self.session), path)
+        self.assertEqual(bot.messaging_service.downloads, 2)
+
+
+class TestRedisCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.cache = RedisCache(client=fakeredis.FakeRedis(), prefix='test:')
+
+    def test_get_set(self):
+        self.cache.set('a', {'foo': [1, 2]})
+        self.assertEqual(self.cache.get('a'), {'foo': [1, 2]})
+        self.assertIsNone(self.cache.get('b'))
+
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_ttl(self):
+        self.cache.set('a', 1, ttl=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('a'))
+
+    async def test_get_or_compute(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        res = await asyncio.gather(*[self.cache.get_or_compute('a', compute) for _ in range(5)])
+        self.assertEqual(res, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.get('a'), 'result')
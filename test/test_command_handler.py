@@ -4,7 +4,11 @@ from unittest import mock
 from pydantic_core._pydantic_core import ValidationError
 
 from cliobot.bots import MessagingService, Message, Session
-from cliobot.commands import to_params, notify_errors
+from cliobot.bots.command_handler import CommandHandler
+from cliobot.commands import to_params, notify_errors, CHEAP, EXPENSIVE
+from cliobot.commands.help import Help
+from cliobot.commands.session import ClearContext
+from cliobot.commands.text import Ask
 
 
 def msg(txt):
@@ -68,3 +72,22 @@ class TestCommandHandler(unittest.IsolatedAsyncioTestCase):
 
         ms.send_message.assert_called_once_with(text='Whoops!\nbla: foo', chat_id=123, reply_to_message_id=None)
         err.errors.assert_called_once()
+
+    async def test_cost_class(self):
+        handler = CommandHandler(
+            fallback_commands={'text': 'ask'},
+            commands=[
+                ClearContext(),
+                Help([]),
+                Ask({}, None),
+            ],
+        )
+
+        self.assertEqual(handler.cost_class(msg('/help')), CHEAP)
+        self.assertEqual(handler.cost_class(msg('/clear')), CHEAP)
+        self.assertEqual(handler.cost_class(msg('/ask whats up')), EXPENSIVE)
+        self.assertEqual(handler.cost_class(msg('whats up')), EXPENSIVE)  # falls back to /ask
+        self.assertEqual(handler.cost_class(msg('')), EXPENSIVE)
+
+        handler.command_handlers['help'].cost = EXPENSIVE
+        self.assertEqual(handler.cost_class(msg('/help')), EXPENSIVE)
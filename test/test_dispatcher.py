@@ -0,0 +1,232 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from cliobot.bots import Message, MessagingService, BaseBot, MessageHandler
+from cliobot.bots.dispatcher import ShardedQueue, AsyncDispatcher, ThreadedDispatcher
+from cliobot.bots.ratelimit import RateLimiter
+from cliobot.errors import BaseErrorHandler
+from cliobot.metrics import BaseMetrics
+
+
+def msg(user_id, txt):
+    return Message(
+        text=txt,
+        user_id=user_id,
+        chat_id=user_id,
+        message_id=txt,
+        user={},
+    )
+
+
+class NullMessagingService(MessagingService):
+    def __init__(self):
+        self.sent = []
+
+    async def initialize(self):
+        pass
+
+    async def send_message(self, text, chat_id, context=None, reply_to_message_id=None, reply_buttons=None,
+                           buttons=None):
+        self.sent.append((chat_id, reply_to_message_id))
+
+
+class SlowHandler(MessageHandler):
+    handled = []
+
+    def cost_class(self, message):
+        return 'expensive' if message.text.endswith('slow') else 'cheap'
+
+    async def _handle_message(self, message, bot):
+        await asyncio.sleep(0.1 if message.text.endswith('slow') else 0)
+        SlowHandler.handled.append(message.text)
+
+
+class RecordingClient:
+    def __init__(self):
+        self.closed = []
+
+    async def close(self):
+        self.closed.append(asyncio.get_running_loop())
+
+
+def build_bot(dispatcher, clients=None):
+    return BaseBot(
+        handler_fn=SlowHandler,
+        messaging_service=NullMessagingService(),
+        db=None,
+        metrics=BaseMetrics(BaseErrorHandler()),
+        dispatcher=dispatcher,
+        clients=clients,
+    )
+
+
+def wait_for(condition, timeout=5):
+    started = time.time()
+    while not condition() and time.time() - started < timeout:
+        time.sleep(0.01)
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_same_user_same_shard(self):
+        q = ShardedQueue(16)
+        for i in range(10):
+            q.put_nowait(msg('123', str(i)))
+
+        shard = q.shard(q.shard_for(msg('123', '')))
+        self.assertEqual(shard.qsize(), 10)
+        self.assertEqual([shard.get_nowait().text for _ in range(10)], [str(i) for i in range(10)])
+
+    def test_ordered_per_user(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=64))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            await bot.enqueue(msg('1', '1-first-slow'))
+            await bot.enqueue(msg('1', '1-second'))
+            for i in range(2, 50):
+                await bot.enqueue(msg(str(i), f'{i}-slow'))
+
+        started = time.time()
+        asyncio.run(send())
+        wait_for(lambda: len(SlowHandler.handled) == 50)
+        bot.dispatcher.stop()
+
+        self.assertEqual(len(SlowHandler.handled), 50)
+        self.assertLess(SlowHandler.handled.index('1-first-slow'), SlowHandler.handled.index('1-second'))
+        self.assertLess(time.time() - started, 2)  # not serialized across users
+
+    def test_stop_drains(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=2))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            for i in range(4):
+                await bot.enqueue(msg(str(i), f'{i}-slow'))
+
+        asyncio.run(send())
+        bot.dispatcher.stop()  # waits for what's already queued
+
+        self.assertEqual(sorted(SlowHandler.handled), ['0-slow', '1-slow', '2-slow', '3-slow'])
+        self.assertFalse(bot.dispatcher.thread.is_alive())
+
+    def test_no_media_cache_until_needed(self):
+        threads = threading.active_count()
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=2))
+        self.assertIsNone(bot._media_cache)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_stop_closes_clients(self):
+        client = RecordingClient()
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=2), clients=[client])
+        bot.dispatcher.start(bot)
+        bot.dispatcher.stop()
+        self.assertEqual(client.closed, [bot.dispatcher.loop])  # on the dispatcher's own loop
+
+        client = RecordingClient()
+        bot = build_bot(ThreadedDispatcher(SlowHandler, workers=2), clients=[client])
+        bot.dispatcher.start(bot)
+        bot.dispatcher.stop()
+        self.assertEqual(len(set(client.closed)), len(bot.dispatcher.threads))  # every worker's loop
+
+    def test_threaded_stop(self):
+        SlowHandler.handled = []
+        bot = build_bot(ThreadedDispatcher(SlowHandler, workers=2))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            for i in range(4):
+                await bot.enqueue(msg(str(i), f'{i}-slow'))
+
+        asyncio.run(send())
+        bot.dispatcher.stop()
+
+        self.assertEqual(sorted(SlowHandler.handled), ['0-slow', '1-slow', '2-slow', '3-slow'])
+        self.assertFalse(any(t.is_alive() for t in bot.dispatcher.threads))
+
+    def test_rate_limited(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=4, rate_limiter=RateLimiter(rate=0.01, burst=2)))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            for i in range(5):
+                await bot.enqueue(msg('1', str(i)))
+            await bot.enqueue(msg('2', 'other user'))
+
+        asyncio.run(send())
+        wait_for(lambda: len(SlowHandler.handled) == 3)
+        bot.dispatcher.stop()
+
+        self.assertEqual(sorted(SlowHandler.handled), ['0', '1', 'other user'])
+        self.assertEqual(bot.messaging_service.sent, [('1', '2'), ('1', '3'), ('1', '4')])
+        self.assertEqual(bot.metrics.counters['rejected.rate_limited'], 3)
+
+    def test_queue_full_and_deadline(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=1, max_queue_size=2, max_queue_wait=0.15))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            for i in range(4):
+                await bot.enqueue(msg('1', f'{i}-slow'))
+
+        asyncio.run(send())
+        wait_for(lambda: len(bot.messaging_service.sent) == 2)
+        bot.dispatcher.stop()
+
+        # 0 is picked up right away, 1 and 2 fit in the queue and 3 doesn't. 2 then waits too long behind 0 and 1
+        self.assertEqual(SlowHandler.handled, ['0-slow', '1-slow'])
+        self.assertEqual(bot.metrics.counters, {'rejected.queue_full': 1, 'rejected.deadline': 1})
+
+    def test_cheap_pool(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=1, pools={'cheap': 1}))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            for i in range(5):
+                await bot.enqueue(msg(str(i), f'{i}-slow'))
+            await bot.enqueue(msg('5', 'help'))
+
+        asyncio.run(send())
+        wait_for(lambda: len(SlowHandler.handled) == 2)
+        bot.dispatcher.stop()
+
+        # doesn't wait behind the slow ones
+        self.assertEqual(SlowHandler.handled[:2], ['help', '0-slow'])
+
+    def test_ordered_across_pools(self):
+        SlowHandler.handled = []
+        bot = build_bot(AsyncDispatcher(SlowHandler, concurrency=4, pools={'cheap': 4}))
+        bot.dispatcher.start(bot)
+
+        async def send():
+            await bot.enqueue(msg('1', 'image-slow'))
+            await bot.enqueue(msg('1', 'clear'))  # cheap, but waits for the user's generation
+            await bot.enqueue(msg('2', 'help'))
+
+        asyncio.run(send())
+        wait_for(lambda: len(SlowHandler.handled) == 3)
+        bot.dispatcher.stop()
+
+        self.assertEqual(SlowHandler.handled, ['help', 'image-slow', 'clear'])
+        self.assertEqual(bot.dispatcher.in_flight, {})
+
+    def test_queue_bound_is_global(self):
+        # not started, so nothing leaves the queue
+        dispatcher = ThreadedDispatcher(SlowHandler, workers=8, pools={'cheap': 4}, max_queue_size=6)
+
+        async def offer():
+            same_user = [await dispatcher._offer(msg('1', f'{i}-slow')) for i in range(5)]
+            cheap = [await dispatcher._offer(msg(str(i), 'help')) for i in range(2, 4)]
+            return same_user, cheap
+
+        same_user, cheap = asyncio.run(offer())
+        self.assertEqual(same_user, [True] * 5)  # a single user can use up the whole queue...
+        self.assertEqual(cheap, [True, False])  # ...which is shared by every pool
+        self.assertEqual(sum(q.qsize() for q in dispatcher.queues.values()), 6)
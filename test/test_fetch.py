@@ -0,0 +1,130 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from cliobot.bots import Session
+from cliobot.cache.media_cache import MediaCache
+from cliobot.db import AsyncDatabaseAdapter
+from cliobot.db.inmemory import InMemoryDb
+from cliobot.db.utils import cached_get_file, upload_asset
+from cliobot.fetch import Fetcher, open_stream
+from cliobot.storage import LocalStorage, AsyncStorageAdapter
+from cliobot.utils import download, CHUNK_SIZE
+
+BODY = os.urandom(5 * 1024 * 1024 + 123)
+
+
+class RecordingSink:
+    def __init__(self):
+        self.size = 0
+        self.largest = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self.largest = max(self.largest, len(chunk))
+
+
+class TestFetch(unittest.IsolatedAsyncioTestCase):
+    """
+    against a local server with a big file on it
+    """
+
+    async def asyncSetUp(self):
+        self.requests = 0
+
+        async def video(request):
+            self.requests += 1
+            res = web.StreamResponse(headers={'Content-Type': 'video/mp4'})
+            await res.prepare(request)
+            for i in range(0, len(BODY), 256 * 1024):
+                await res.write(BODY[i:i + 256 * 1024])
+                await asyncio.sleep(0.001)
+            return res
+
+        app = web.Application()
+        app.router.add_get('/video.mp4', video)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/video.mp4'
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.fetcher = Fetcher()
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        await self.runner.cleanup()
+        self.folder.cleanup()
+
+    async def test_streams_in_chunks(self):
+        sink = RecordingSink()
+        self.assertEqual(await self.fetcher.fetch(self.url, sink), len(BODY))
+        self.assertEqual(sink.size, len(BODY))
+        self.assertLessEqual(sink.largest, CHUNK_SIZE)  # never the whole thing at once
+
+        out = io.BytesIO()
+        await self.fetcher.fetch('data:text/plain;base64,aGk=', out)
+        self.assertEqual(out.getvalue(), b'hi')
+
+        with self.assertRaises(FileNotFoundError):
+            await self.fetcher.fetch('AgACAgEAAxkBAAI', out)  # eg a telegram file id
+
+    async def test_errors_hide_the_url(self):
+        url = self.url.replace('/video.mp4', '/file/bot123:SECRET/missing.mp4')
+        with self.assertRaises(Exception) as e:
+            await self.fetcher.fetch(url, io.BytesIO())
+        self.assertIn('404', str(e.exception))
+        self.assertNotIn('SECRET', str(e.exception))
+
+    async def test_async_sink(self):
+        chunks = []
+
+        class AsyncSink:
+            async def write(self, chunk):
+                await asyncio.sleep(0)
+                chunks.append(len(chunk))
+
+        await self.fetcher.fetch(self.url, AsyncSink())
+        self.assertEqual(sum(chunks), len(BODY))
+
+    async def test_cached_get_file(self):
+        bot = SimpleNamespace(media_cache=MediaCache(os.path.join(self.folder.name, 'media'), janitor_interval=None))
+        sessions = [SimpleNamespace(user_id=str(i)) for i in range(3)]
+
+        paths = await asyncio.gather(*[cached_get_file(self.url, bot, s) for s in sessions])
+        self.assertEqual(self.requests, 1)  # downloaded once, copied for the others
+        self.assertEqual(len(set(paths)), 3)
+        for p in paths:
+            with open(p, 'rb') as f:
+                self.assertEqual(f.read(), BODY)
+
+        self.assertEqual(
+            [n for _, _, names in os.walk(bot.media_cache.folder) for n in names if n.startswith('.tmp-')], [])
+
+    async def test_upload_asset(self):
+        storage = LocalStorage(os.path.join(self.folder.name, 'storage'))
+        asset = await upload_asset(
+            session=Session('1', '2', {}, {}),
+            local_path=self.url,
+            db=AsyncDatabaseAdapter(InMemoryDb(), workers=0),
+            storage=AsyncStorageAdapter(storage),
+            folder='outputs',
+        )
+        self.assertTrue(asset['storage_path'].endswith('.mp4'))
+        self.assertEqual(storage.get_data(asset['storage_path']), BODY)
+
+    async def test_open_stream(self):
+        async with open_stream(self.url, spool_size=1024) as f:
+            self.assertEqual(f.read(), BODY)
+            self.assertTrue(f._rolled)  # spilled over to disk
+
+    async def test_blocking_download(self):
+        out = io.BytesIO()
+        await asyncio.to_thread(download, self.url, out)
+        self.assertEqual(out.getvalue(), BODY)
@@ -0,0 +1,127 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from cliobot.bots import Message, MessagingService
+from cliobot.commands import Model, BasePrompt, GenerationResults, ImageUrl
+from cliobot.commands.images import TextToImage
+from cliobot.storage import LocalStorage, AsyncStorageAdapter
+from cliobot.storage.archival import ArchivalQueue
+
+
+class RecordingMessagingService(MessagingService):
+    def __init__(self):
+        self.events = []
+
+    async def send_media(self, chat_id, media, text, reply_to_message_id=None, context=None, reply_buttons=None,
+                         buttons=None):
+        self.events.append(('send', text, time.perf_counter()))
+        return SimpleNamespace(id=len(self.events), chat_id=chat_id)
+
+    async def edit_message_media(self, message_id, chat_id, media, text=None, reply_buttons=None):
+        self.events.append(('edit', text, time.perf_counter()))
+
+    async def send_message(self, text, chat_id, context=None, reply_to_message_id=None, reply_buttons=None,
+                           buttons=None):
+        self.events.append(('message', text, time.perf_counter()))
+
+
+class SlowDb:
+    def __init__(self):
+        self.saved = []
+
+    async def save_asset(self, external_id, user_id, chat_id, storage_path):
+        await asyncio.sleep(0.2)  # a slow database (or storage)
+        self.saved.append((storage_path, time.perf_counter()))
+        return {'storage_path': storage_path}
+
+
+class ImagesModel(Model):
+    def __init__(self, count, delay):
+        super().__init__(BasePrompt)
+        self.count = count
+        self.delay = delay
+
+    async def stream_images(self, parsed, on_preview=None):
+        for i in range(self.count):
+            await asyncio.sleep(self.delay)
+            yield ImageUrl(data=bytes([i]) * 10, prompt=f'image {i}')
+
+    async def generate(self, parsed) -> GenerationResults:
+        return GenerationResults(images=[i async for i in self.stream_images(parsed)])
+
+
+def image(text):
+    return Message(
+        text=f'/image {text}',
+        user_id='123',
+        chat_id='456',
+        message_id='789',
+        user={},
+    )
+
+
+class TestTextToImage(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        db = SlowDb()
+        storage = AsyncStorageAdapter(LocalStorage(self.folder.name))
+        self.storage = storage
+        self.archival = ArchivalQueue(storage, db)
+        self.bot = SimpleNamespace(
+            messaging_service=RecordingMessagingService(),
+            db=db,
+            storage=storage,
+            archival=self.archival,
+        )
+        self.session = SimpleNamespace(context={}, preferences={}, user_id='123', chat_id='456')
+
+    async def asyncTearDown(self):
+        self.archival.close()
+        self.storage.close()
+        self.folder.cleanup()
+
+    async def test_progressive_delivery(self):
+        command = TextToImage({'fake': ImagesModel(count=3, delay=0.1)}, None)
+        started = time.perf_counter()
+        await command.process(image('a hamster'), self.session, self.bot)
+
+        events = self.bot.messaging_service.events
+        self.assertEqual([(e[0], e[1]) for e in events], [
+            ('send', 'Generating image, please wait...'),
+            ('edit', 'image 0'),  # the first one replaces the placeholder
+            ('send', 'image 1'),
+            ('send', 'image 2'),
+        ])
+        self.assertLess(events[1][2] - started, 0.15)  # delivered before the others are done
+        self.assertLess(events[-1][2] - started, 0.45)  # rather than 3 * (0.1 + 0.2) if stored one by one
+
+        # stored in the background, without holding up delivery
+        self.assertLess(len(self.bot.db.saved), 3)
+        await self.bot.archival.join()
+        self.assertEqual(len(self.bot.db.saved), 3)
+
+    async def test_without_storage(self):
+        self.bot.storage, self.bot.archival = None, None
+        command = TextToImage({'fake': ImagesModel(count=2, delay=0)}, None)
+        await command.process(image('a hamster'), self.session, self.bot)
+
+        events = self.bot.messaging_service.events
+        self.assertEqual([e[1] for e in events], ['Generating image, please wait...', 'image 0', 'image 1'])
+
+    async def test_generation_failure(self):
+        class Failing(ImagesModel):
+            async def stream_images(self, parsed, on_preview=None):
+                yield ImageUrl(data=b'1', prompt='image 0')
+                raise Exception('out of credits')
+
+        command = TextToImage({'fake': Failing(count=1, delay=0)}, None)
+        await command.process(image('a hamster'), self.session, self.bot)
+
+        events = self.bot.messaging_service.events
+        self.assertEqual([e[1] for e in events], ['Generating image, please wait...', 'image 0', '🚨 out of credits'])
+        await self.bot.archival.join()
+        self.assertEqual(len(self.bot.db.saved), 1)  # what made it through is still stored
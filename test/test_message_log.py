@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+
+from cliobot.db.inmemory import InMemoryDb
+from cliobot.db.message_log import BufferedMessageLog
+from cliobot.db.sqlite import SqliteDb
+
+
+class RecordingDb(InMemoryDb):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def save_messages(self, messages):
+        self.batches.append([m['external_id'] for m in messages])
+
+
+def save(db, external_id):
+    db.save_message(user_id='1', chat_id='2', text='hello', external_id=external_id)
+
+
+class TestMessageLog(unittest.TestCase):
+
+    def test_flush_on_size(self):
+        backend = RecordingDb()
+        db = BufferedMessageLog(backend, batch_size=3, flush_interval=60)
+        for i in range(3):
+            save(db, i)
+
+        time.sleep(0.1)  # well before the flush interval
+        self.assertEqual(backend.batches, [[0, 1, 2]])
+
+        save(db, 3)
+        db.close()
+        self.assertEqual(backend.batches, [[0, 1, 2], [3]])
+
+    def test_flush_on_time(self):
+        backend = RecordingDb()
+        db = BufferedMessageLog(backend, batch_size=100, flush_interval=0.05)
+        save(db, 1)
+        save(db, 2)
+        self.assertEqual(backend.batches, [])
+
+        time.sleep(0.2)
+        self.assertEqual(backend.batches, [[1, 2]])
+        db.close()
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sqlite = SqliteDb(os.path.join(folder, 'test.db'))
+            db = BufferedMessageLog(sqlite, batch_size=100, flush_interval=60)
+            for i in range(10):
+                save(db, str(i))
+            db.close()
+
+            sqlite = SqliteDb(os.path.join(folder, 'test.db'))
+            rows = sqlite.conn.execute("SELECT external_id FROM chat_messages ORDER BY id").fetchall()
+            self.assertEqual([r['external_id'] for r in rows], [str(i) for i in range(10)])
+            sqlite.close()
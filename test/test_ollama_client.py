@@ -1,7 +1,11 @@
+import asyncio
+import json
 import unittest
 
+from aiohttp import web
+
 from cliobot.config import load_config
-from cliobot.ollama.client import OllamaText, OllamaPrompt
+from cliobot.ollama.client import OllamaText, OllamaPrompt, OllamaClient
 from cliobot.utils import abs_path
 
 
@@ -36,3 +40,69 @@ class TestOllamaClient(unittest.IsolatedAsyncioTestCase):
         )
         print(res)
         self.assertIsNot(res.texts, [])
+
+
+class TestOllamaStreaming(unittest.IsolatedAsyncioTestCase):
+    """
+    against a local server pretending to be ollama
+    """
+
+    async def asyncSetUp(self):
+        self.cancelled = asyncio.Event()
+
+        async def generate(request):
+            params = await request.json()
+            res = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await res.prepare(request)
+
+            if params['model'] == 'broken':
+                await res.write(b'{"error": "model not found"}\n')
+                return res
+
+            try:
+                data = b''.join(
+                    json.dumps({'response': t, 'done': False}).encode() + b'\n'
+                    for t in ['Hello', ' there', '!']
+                ) + json.dumps({'response': '', 'done': True}).encode()
+                for i in range(0, len(data), 7):  # split mid-line
+                    await res.write(data[i:i + 7])
+                    await asyncio.sleep(0.01 if params['model'] == 'fast' else 0.5)
+            except (asyncio.CancelledError, ConnectionResetError):
+                self.cancelled.set()
+                raise
+            return res
+
+        app = web.Application()
+        app.router.add_post('/api/generate', generate)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        self.client = OllamaClient(f'http://127.0.0.1:{port}')
+        self.model = OllamaText(f'http://127.0.0.1:{port}', client=self.client)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def test_stream(self):
+        prompt = OllamaPrompt(command='', prompt='hi', model='fast', image=None)
+        self.assertEqual([t async for t in self.model.stream(prompt)], ['Hello', ' there', '!'])
+
+        res = await self.model.generate(prompt)
+        self.assertEqual(res.texts, ['Hello there!'])
+
+    async def test_error(self):
+        with self.assertRaisesRegex(Exception, 'model not found'):
+            await self.model.generate(OllamaPrompt(command='', prompt='hi', model='broken', image=None))
+
+    async def test_cancel(self):
+        task = asyncio.create_task(self.model.generate(OllamaPrompt(command='', prompt='hi', model='slow', image=None)))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        await asyncio.wait_for(self.cancelled.wait(), 2)  # the server saw the connection go
@@ -1,12 +1,18 @@
+import asyncio
+import json
+import time
 import unittest
 
+import openai
+from aiohttp import web
+
 from cliobot.config import load_config
 from cliobot.metrics import BaseMetrics
-from cliobot.openai.client import OpenAIClient
+from cliobot.openai.client import OpenAIClient, Dalle3, Dalle3Prompt
 from cliobot.utils import abs_path
 
 
-class TestOpenAIClient(unittest.TestCase):
+class TestOpenAIClient(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         config = load_config('config.yml')
@@ -20,50 +26,165 @@ class TestOpenAIClient(unittest.TestCase):
             BaseMetrics(None),
         )
 
-    def test_transcribe(self):
-        res = self.openai_client.transcribe(abs_path('test/res/hello.mp3'))
+    async def test_transcribe(self):
+        res = await self.openai_client.transcribe(abs_path('test/res/hello.mp3'))
         print(res)
         self.assertEqual(res, 'Hello there')
 
-        res = self.azure_client.transcribe(abs_path('test/res/hello.mp3'))
+        res = await self.azure_client.transcribe(abs_path('test/res/hello.mp3'))
         print(res)
         self.assertEqual(res, 'Hello there')
 
-    def test_dalle_txt2img(self):
-        res = self.azure_client.dalle3_txt2img(
+    async def test_dalle_txt2img(self):
+        res = await self.azure_client.dalle3_txt2img(
             'a blue coffee cup on top of a red table, besides a white plate',
             2,
             '512x512')  # size gets fixed automatically
         print(res)
         assert len(res) == 1  # always 1
 
-        res = self.openai_client.dalle3_txt2img(
+        res = await self.openai_client.dalle3_txt2img(
             'a blue coffee cup on top of a red table, besides a white plate',
             2,
             '512x512')  # size gets fixed automatically
         print(res)
         assert len(res) == 1  # always 1
 
-    def test_ask(self):
+    async def test_ask(self):
         # res = self.openai_client.ask('What is the meaning of life?')
         # print(res)
         # assert len(res) > 0
 
-        res = self.azure_client.ask('What is the meaning of life?')
+        res = await self.azure_client.ask('What is the meaning of life?')
         print(res)
         assert len(res) > 0
 
-    def test_img2txt(self):
-        res = self.openai_client.img2text(
+    async def test_img2txt(self):
+        res = await self.openai_client.img2text(
             "what's in this image?",
             'https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcRQX0YDlVeH53k9oST-dmEt-5w5IQwdxu7BhywRS2Q9cg&s'
         )
         print(res)
         self.assertIsNotNone(res)
 
-        res = self.openai_client.img2text(
+        res = await self.openai_client.img2text(
             "what's in this image?",
             abs_path('test/res/sandwich.jpg')
         )
         print(res)
         self.assertIsNotNone(res)
+
+
+class TestOpenAIClientPooling(unittest.IsolatedAsyncioTestCase):
+    """
+    against a local server pretending to be the chat completions api
+    """
+
+    async def asyncSetUp(self):
+        self.received = asyncio.Event()
+
+        async def completions(request):
+            self.received.set()
+            await asyncio.sleep(float(request.query.get('delay', 0.2)))
+            if (await request.json()).get('stream'):
+                res = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+                await res.prepare(request)
+                for token in ['h', 'i', '!']:
+                    chunk = {
+                        'id': '1',
+                        'object': 'chat.completion.chunk',
+                        'created': 0,
+                        'model': 'gpt-4',
+                        'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+                    }
+                    await res.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+                await res.write(b'data: [DONE]\n\n')
+                return res
+
+            return web.json_response({
+                'id': '1',
+                'object': 'chat.completion',
+                'created': 0,
+                'model': 'gpt-4',
+                'choices': [{
+                    'index': 0,
+                    'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': 'hi'},
+                }],
+            })
+
+        self.generating = 0
+        self.max_generating = 0
+
+        async def images(request):
+            self.generating += 1
+            self.max_generating = max(self.max_generating, self.generating)
+            try:
+                await asyncio.sleep(0.2)
+            finally:
+                self.generating -= 1
+            self.assertEqual((await request.json())['n'], 1)
+            return web.json_response({
+                'created': 0,
+                'data': [{'url': 'https://example.com/1.png', 'revised_prompt': 'a hamster'}],
+            })
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', completions)
+        app.router.add_post('/v1/images/generations', images)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        self.client = OpenAIClient(
+            [{'api_type': 'open_ai', 'api_key': 'test', 'base_url': f'http://127.0.0.1:{port}/v1/'}],
+            BaseMetrics(None),
+            timeouts={'gpt-3.5': 0.05},
+            max_retries=0,
+            image_parallelism=2,
+        )
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def test_concurrent_requests(self):
+        started = time.perf_counter()
+        res = await asyncio.gather(*[self.client.ask('hello') for _ in range(20)])
+        self.assertEqual(res, ['hi'] * 20)
+        self.assertLess(time.perf_counter() - started, 1)  # all in flight at once, not 20 * 0.2s
+
+    async def test_timeout_per_model(self):
+        with self.assertRaises(openai.APITimeoutError):
+            await self.client.ask('hello', model_version='gpt-3.5')
+
+    async def test_cancel(self):
+        task = asyncio.create_task(self.client.ask('hello'))
+        await self.received.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test_stream(self):
+        endpoint = self.client.router.candidates('gpt-4')[0]
+        tokens = []
+        async for t in self.client.ask_stream('hello'):
+            tokens.append(t)
+            self.assertEqual(endpoint.outstanding, 1)  # busy until the stream is done
+        self.assertEqual(tokens, ['h', 'i', '!'])
+        self.assertEqual(endpoint.outstanding, 0)
+
+        stream = self.client.ask_stream('hello')
+        await stream.__anext__()
+        await stream.aclose()  # eg the user cancelled
+        self.assertEqual(endpoint.outstanding, 0)
+
+    async def test_dalle3_fan_out(self):
+        started = time.perf_counter()
+        res = await Dalle3(self.client).generate(Dalle3Prompt(command='image', prompt='a hamster', num=4))
+
+        self.assertEqual(len(res.images), 4)
+        self.assertEqual(self.max_generating, 2)
+        self.assertLess(time.perf_counter() - started, 0.7)  # 2 at a time, not one after the other
@@ -0,0 +1,142 @@
+import asyncio
+import unittest
+
+import httpx
+import openai
+
+from cliobot.errors import BaseErrorHandler
+from cliobot.metrics import BaseMetrics
+from cliobot.openai.router import EndpointRouter, Endpoint
+
+REQUEST = httpx.Request('POST', 'http://localhost/v1/chat/completions')
+
+
+def throttled(retry_after=None):
+    headers = {'retry-after': str(retry_after)} if retry_after else {}
+    return openai.RateLimitError('throttled', response=httpx.Response(429, request=REQUEST, headers=headers), body=None)
+
+
+def endpoint(i, **kwargs):
+    return Endpoint(i, {'base_url': f'https://region-{i}.example.com', **kwargs}, model='gpt4')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEndpointRouter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = BaseMetrics(BaseErrorHandler())
+        self.router = EndpointRouter(failure_threshold=2, cooldown=30, attempts=3, metrics=self.metrics,
+                                     clock=self.clock)
+        self.endpoints = [endpoint(0), endpoint(1), endpoint(2, weight=2)]
+        for e in self.endpoints:
+            self.router.add('gpt-4', e)
+
+    async def test_least_outstanding(self):
+        release = asyncio.Event()
+        used = []
+
+        async def call(e):
+            used.append(e.index)
+            await release.wait()
+
+        tasks = [asyncio.create_task(self.router.call('gpt-4', call)) for _ in range(8)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(sorted(used), [0, 0, 1, 1, 2, 2, 2, 2])  # endpoint 2 has twice the weight
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual([e.outstanding for e in self.endpoints], [0, 0, 0])
+
+    async def test_retry_elsewhere(self):
+        async def call(e):
+            if e.index == 2:
+                raise throttled()
+            return e.index
+
+        for _ in range(2):
+            self.assertIn(await self.router.call('gpt-4', call), [0, 1])
+
+        # failed twice in a row - out of rotation for a while
+        self.assertEqual(self.endpoints[2].throttled, 2)
+        self.assertEqual(self.endpoints[2].open_until, 30)
+        self.assertEqual(self.metrics.counters['openai.region-2.example.com/gpt4.throttled'], 2)
+        self.assertNotEqual(self.router.acquire('gpt-4').index, 2)
+
+    async def test_circuit_breaker(self):
+        async def fail(e):
+            raise openai.APITimeoutError(REQUEST)
+
+        for _ in range(2):
+            with self.assertRaises(openai.APITimeoutError):
+                await self.router.call('gpt-4', fail)
+        self.assertTrue(all(e.open_until == 30 for e in self.endpoints))
+
+        async def ok(e):
+            return e.index
+
+        # everything is down - still tries the one coming back first
+        self.assertIsNotNone(await self.router.call('gpt-4', ok))
+
+        self.clock.now = 31  # half open - a single success closes it again
+        self.endpoints[0].open_until = self.endpoints[2].open_until = 100
+        self.assertEqual(await self.router.call('gpt-4', ok), 1)
+        self.assertEqual(self.endpoints[1].consecutive_failures, 0)
+        self.assertEqual(self.endpoints[1].open_until, 0)
+
+    async def test_retry_after(self):
+        async def call(e):
+            if e.index == 0:
+                raise throttled(retry_after=60)
+            return e.index
+
+        self.endpoints[1].open_until = self.endpoints[2].open_until = 1  # so that 0 goes first
+        self.assertEqual(await self.router.call('gpt-4', call), 1)
+        self.assertEqual(self.endpoints[0].open_until, 60)  # a single 429 is enough, with a retry-after
+
+    async def test_bad_request_not_retried(self):
+        calls = []
+
+        async def call(e):
+            calls.append(e.index)
+            raise openai.BadRequestError('nope', response=httpx.Response(400, request=REQUEST), body=None)
+
+        with self.assertRaises(openai.BadRequestError):
+            await self.router.call('gpt-4', call)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sum(e.failures for e in self.endpoints), 0)
+
+    async def test_cancel_swallowed_by_the_call(self):
+        started = asyncio.Event()
+
+        async def call(e):
+            started.set()
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:  # eg anyio, cancelled while connecting
+                pass
+            return 'late'
+
+        task = asyncio.create_task(self.router.call('gpt-4', call))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual([e.outstanding for e in self.endpoints], [0, 0, 0])
+        self.assertEqual([e.failures for e in self.endpoints], [0, 0, 0])
+
+    async def test_fallback_priority(self):
+        v1 = Endpoint(3, {'base_url': 'https://api.openai.com/v1/'}, priority=1)
+        self.router.add('*', v1)
+        self.assertEqual(self.router.acquire('dall-e-3'), v1)  # nothing else serves it
+
+        for e in self.endpoints:
+            e.open_until = 100
+        self.assertEqual(self.router.acquire('gpt-4'), v1)
@@ -1,5 +1,9 @@
+import asyncio
+import threading
+import time
 import unittest
 
+from cliobot.bots.ratelimit import ConcurrencyLimit
 from cliobot.config import load_config
 from cliobot.replicate.client import ReplicateEndpoint
 from cliobot.utils import abs_path
@@ -44,3 +48,91 @@ class TestReplicateClient(unittest.IsolatedAsyncioTestCase):
         print(res)
         self.assertIs(len(res.texts), 0)
         self.assertIsNot(res.images, [])
+
+
+class FakeReplicate:
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def async_run(self, version, input_args):
+        self.calls.append(input_args)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return [f'https://replicate.delivery/{len(self.calls)}-{i}.png' for i in range(input_args['num_outputs'])]
+
+
+class TestReplicateFanOut(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.endpoint = ReplicateEndpoint(
+            'image',
+            'test',
+            'stability-ai/sdxl:1',
+            {
+                'prompt': {'kind': 'str'},
+                'seed': {'kind': 'int'},
+                'num_outputs': {'alias': 'num', 'kind': 'int', 'default': 1, 'fan_out': True},
+            },
+            limit=ConcurrencyLimit(2),
+        )
+        self.endpoint.client = FakeReplicate()
+
+    async def test_fan_out(self):
+        started = time.perf_counter()
+        res = await self.endpoint.generate({'prompt': 'a hamster', 'num': 4, 'seed': 10})
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(len(res.images), 4)
+        self.assertEqual(len(self.endpoint.client.calls), 4)
+        self.assertEqual(sorted(c['seed'] for c in self.endpoint.client.calls), [10, 11, 12, 13])
+        self.assertTrue(all(c['num_outputs'] == 1 for c in self.endpoint.client.calls))
+
+        self.assertEqual(self.endpoint.client.max_running, 2)  # limited
+        self.assertLess(elapsed, 0.35)  # 2 rounds, not 4
+
+    async def test_stream_images(self):
+        self.endpoint.client.delay = 0
+        images = [i async for i in self.endpoint.stream_images({'prompt': 'a hamster', 'num': 3})]
+        self.assertEqual(len(images), 3)
+        self.assertEqual(images[0].prompt, 'a hamster')
+
+        res = await self.endpoint.generate({'prompt': 'a hamster'})  # no fan out
+        self.assertEqual(len(res.images), 1)
+
+    async def test_limit_shared_across_loops(self):
+        limit = ConcurrencyLimit(1)
+        running = []
+        peak = []
+
+        async def job():
+            async with limit:
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.05)
+                running.pop()
+
+        threads = [threading.Thread(target=lambda: asyncio.run(job())) for _ in range(3)]
+        [t.start() for t in threads]
+        await asyncio.gather(job(), asyncio.to_thread(lambda: [t.join() for t in threads]))
+
+        self.assertEqual(peak, [1] * 4)
+        self.assertEqual(limit.running, 0)
+
+    async def test_limit_cancelled_waiter(self):
+        limit = ConcurrencyLimit(1)
+        await limit.acquire()
+        waiter = asyncio.create_task(limit.acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        limit.release()
+        self.assertEqual(limit.running, 0)
+        await asyncio.wait_for(limit.acquire(), 1)
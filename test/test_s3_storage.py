@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import io
+import os
+import time
+import unittest
+
+import boto3
+from moto import mock_aws
+
+from cliobot.bots import Session
+from cliobot.db import AsyncDatabaseAdapter
+from cliobot.db.inmemory import InMemoryDb
+from cliobot.db.utils import upload_asset
+from cliobot.storage import AsyncStorageAdapter
+from cliobot.storage.s3 import S3Storage, MB
+
+BODY = os.urandom(12 * MB + 123)
+
+
+class TestS3Storage(unittest.IsolatedAsyncioTestCase):
+    """
+    against moto's in-process S3
+    """
+
+    def setUp(self):
+        self.aws = mock_aws()
+        self.aws.start()
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='cliobot')
+        self.storage = S3Storage(
+            access_key='key',
+            secret='secret',
+            bucket='cliobot',
+            region='us-east-1',
+            workers=2,
+            multipart_threshold=5 * MB,  # the smallest part S3 takes
+            multipart_chunksize=5 * MB,
+            max_concurrency=2,
+        )
+
+    def tearDown(self):
+        self.storage.close()
+        self.aws.stop()
+
+    def parts(self, path):
+        head = self.storage.s3.head_object(Bucket='cliobot', Key=path)
+        etag = head['ETag'].strip('"')
+        return int(etag.split('-')[1]) if '-' in etag else 1
+
+    def test_save_bytes(self):
+        self.assertEqual(self.storage.save_data(b'hello', 'a/b.txt', 'text/plain'), 'a/b.txt')
+        self.assertEqual(self.storage.get_data('a/b.txt'), b'hello')
+        self.assertTrue(self.storage.exists('a/b.txt'))
+        self.assertFalse(self.storage.exists('a/c.txt'))
+        self.assertEqual(self.storage.fetch_file('a/b.txt')['ContentType'], 'text/plain')
+
+    def test_multipart(self):
+        self.storage.save_data(io.BytesIO(BODY), 'big.mp4', 'video/mp4')
+        self.assertEqual(self.parts('big.mp4'), 3)
+        self.assertEqual(self.storage.get_data('big.mp4'), BODY)
+
+    async def test_async_stream(self):
+        async def chunks():
+            for i in range(0, len(BODY), 64 * 1024):
+                await asyncio.sleep(0)
+                yield BODY[i:i + 64 * 1024]
+
+        path = await self.storage.asave_data(chunks(), 'streamed.mp4', 'video/mp4')
+        self.assertEqual(self.parts(path), 3)
+        self.assertEqual(self.storage.get_data(path), BODY)
+
+    async def test_does_not_block_the_loop(self):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.gather(*[
+            self.storage.asave_data(BODY, f'big-{i}.mp4', 'video/mp4') for i in range(3)
+        ])
+        ticker.cancel()
+
+        self.assertGreater(len(ticks), 2)
+        self.assertLess(max(b - a for a, b in zip(ticks, ticks[1:])), 0.25)
+        for i in range(3):
+            self.assertEqual(self.storage.get_data(f'big-{i}.mp4'), BODY)
+
+    async def test_upload_asset(self):
+        asset = await upload_asset(
+            session=Session('1', '2', {}, {}),
+            local_path=f'data:image/png;base64,{base64.b64encode(b"png").decode()}',
+            db=AsyncDatabaseAdapter(InMemoryDb(), workers=0),
+            storage=AsyncStorageAdapter(self.storage),
+            folder='outputs',
+        )
+        self.assertTrue(asset['storage_path'].startswith('outputs/'))
+        self.assertEqual(self.storage.get_data(asset['storage_path']), b'png')
@@ -0,0 +1,85 @@
+import unittest
+
+from cliobot.db.inmemory import InMemoryDb
+from cliobot.db.session_cache import SessionCachingDb
+
+
+class CountingDb(InMemoryDb):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.batches = []
+
+    def create_or_get_chat_session(self, user_id):
+        self.reads += 1
+        return dict(super().create_or_get_chat_session(user_id))
+
+    def set_chat_contexts(self, items):
+        self.batches.append(items)
+        super().set_chat_contexts(items)
+
+
+class TestSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CountingDb()
+        self.db = SessionCachingDb(self.backend, max_size=2, ttl=60, flush_interval=60)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_hot_sessions_from_memory(self):
+        self.db.create_or_get_chat_session('1')
+        self.db.create_or_get_chat_session('1')
+        self.assertEqual(self.backend.reads, 1)
+
+        # least recently used goes away
+        self.db.create_or_get_chat_session('2')
+        self.db.create_or_get_chat_session('3')
+        self.db.create_or_get_chat_session('1')
+        self.assertEqual(self.backend.reads, 4)
+
+    def test_write_behind(self):
+        self.db.create_or_get_chat_session('1')
+        self.db.set_chat_context('1', {'command': 'image'}, {'model': 'sdxl'})
+        self.db.set_chat_context('2', {'command': 'ask'}, {})
+        self.db.set_chat_context('1', {'command': 'describe'}, {'model': 'sdxl'})
+
+        self.assertEqual(self.backend.batches, [])
+        self.assertEqual(self.db.create_or_get_chat_session('1')['context'], {'command': 'describe'})
+        self.assertEqual(self.db.create_or_get_chat_session('2')['context'], {'command': 'ask'})  # not flushed yet
+
+        self.db.flush()
+        self.assertEqual(self.backend.batches, [[
+            ('1', {'command': 'describe'}, {'model': 'sdxl'}),
+            ('2', {'command': 'ask'}, {}),
+        ]])
+
+    def test_flushed_while_reading(self):
+        cache = self.db
+
+        class RacingDb(CountingDb):
+            def create_or_get_chat_session(self, user_id):
+                res = super().create_or_get_chat_session(user_id)  # read before the batch lands...
+                if self.reads == 1:
+                    cache.set_chat_context(user_id, {'command': 'ask'}, {})
+                    cache.flush()  # ...which is written (and no longer pending) before the read returns
+                return res
+
+        self.backend = RacingDb()
+        self.db.db = self.backend
+
+        self.assertEqual(self.db.create_or_get_chat_session('1')['context'], {'command': 'ask'})
+        self.assertEqual(self.backend.reads, 2)  # read again, rather than caching what might be stale
+        self.assertEqual(self.db.create_or_get_chat_session('1')['context'], {'command': 'ask'})
+        self.assertEqual(self.backend.reads, 2)
+
+    def test_copies(self):
+        session = self.db.create_or_get_chat_session('1')
+        session['context']['foo'] = 'bar'
+        self.assertEqual(self.db.create_or_get_chat_session('1')['context'], {})
+
+    def test_flush_on_close(self):
+        self.db.set_chat_context('1', {'command': 'image'}, {})
+        self.db.close()
+        self.assertEqual(self.backend.create_or_get_chat_session('1')['context'], {'command': 'image'})
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from cliobot.db.sharded_sqlite import ShardedSqliteDb, AsyncShardedSqliteDb
+
+
+class TestShardedSqliteDb(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.db = ShardedSqliteDb(self.folder.name, shards=4)
+
+    def tearDown(self):
+        self.db.close()
+        self.folder.cleanup()
+
+    def test_stable_partitioning(self):
+        self.assertEqual(len([f for f in os.listdir(self.folder.name) if f.endswith('.db')]), 4)
+        self.assertEqual([self.db.shard_index('123') for _ in range(3)], [self.db.shard_index('123')] * 3)
+        self.assertEqual(len({self.db.shard_index(str(i)) for i in range(100)}), 4)
+
+    def test_single_shard_lookups(self):
+        self.db.create_or_get_chat_session('1')
+        self.db.set_chat_context('1', {'command': 'image'}, {})
+        self.db.save_message(user_id='1', chat_id='1', text='hi', external_id='10')
+        asset = self.db.save_asset('10', '1', '1', 'outputs/1/foo.png')
+
+        self.assertEqual(self.db.create_or_get_chat_session('1')['context'], {'command': 'image'})
+        self.assertEqual(self.db.get_asset('10', '1', '1'), asset)
+
+        for i, shard in enumerate(self.db.shards):
+            count = shard.conn.execute("SELECT count(*) AS c FROM chat_messages").fetchone()['c']
+            self.assertEqual(count, 1 if i == self.db.shard_index('1') else 0)
+
+    def test_batches(self):
+        users = [str(i) for i in range(20)]
+        for u in users:
+            self.db.create_or_get_chat_session(u)
+
+        self.db.set_chat_contexts([(u, {'user': u}, {}) for u in users])
+        self.db.save_messages([
+            {'user_id': u, 'chat_id': u, 'text': 'hi', 'external_id': f'{u}-{i}'}
+            for u in users for i in range(3)
+        ])
+
+        for u in users:
+            self.assertEqual(self.db.create_or_get_chat_session(u)['context'], {'user': u})
+
+        counts = self.db.scan("SELECT count(*) AS c FROM chat_messages")
+        self.assertEqual(len(counts), 4)
+        self.assertEqual(sum(r['c'] for r in counts), 60)
+
+        rows = self.db.scan("SELECT external_user_id FROM chat_sessions WHERE context LIKE ?", ('%user%',))
+        self.assertEqual(sorted(r['external_user_id'] for r in rows), sorted(users))
+
+    def test_writer_per_shard(self):
+        writers = {}
+        for shard in self.db.shards:
+            save = shard.save_messages
+
+            def record(messages, save=save):
+                for m in messages:
+                    writers[m['user_id']] = threading.current_thread().name
+                save(messages)
+
+            shard.save_messages = record
+
+        db = AsyncShardedSqliteDb(self.db, self.db)
+
+        async def run():
+            await asyncio.gather(*[
+                db.save_message(user_id=str(i), chat_id='1', text='hi', external_id=str(i)) for i in range(20)
+            ])
+
+        asyncio.run(run())
+        for user_id, thread in writers.items():
+            self.assertEqual(thread, f'sqlite-writer-{self.db.shard_index(user_id)}_0')
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from cliobot.bots import CachedSession
+from cliobot.db.sqlite import SqliteDb, AsyncSqliteDb, MIGRATIONS
+
+
+class TestSqliteDb(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.folder.name, 'test.db')
+        self.db = SqliteDb(self.file)
+
+    def tearDown(self):
+        self.db.close()
+        self.folder.cleanup()
+
+    def test_setup(self):
+        self.assertEqual(self.db.conn.execute("PRAGMA journal_mode").fetchone()['journal_mode'], 'wal')
+        self.assertEqual(self.db.conn.execute("PRAGMA user_version").fetchone()['user_version'], len(MIGRATIONS))
+
+        plan = self.db.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM assets WHERE external_id = ? AND external_user_id = ? AND external_chat_id = ?",
+            ('1', '2', '3')).fetchall()
+        self.assertIn('assets_lookup', plan[0]['detail'])
+
+        # migrations only run once
+        SqliteDb(self.file).close()
+
+    def test_assets(self):
+        res = self.db.save_asset('1', '2', '3', 'outputs/2/foo.png')
+        self.assertEqual(res['storage_path'], 'outputs/2/foo.png')
+        self.assertIsNotNone(res['id'])
+        self.assertEqual(self.db.get_asset('1', '2', '3'), res)
+        self.assertIsNone(self.db.get_asset('1', '2', '4'))
+
+    def test_sessions(self):
+        session = self.db.create_or_get_chat_session('1')
+        self.assertEqual(session['context'], {})
+
+        self.db.set_chat_context('1', {'command': 'image'}, {'model': 'sdxl'})
+        session = self.db.create_or_get_chat_session('1')
+        self.assertEqual(session['context'], {'command': 'image'})
+        self.assertEqual(session['preferences'], {'model': 'sdxl'})
+
+    def test_concurrent_writers(self):
+        errors = []
+
+        def write(writer):
+            try:
+                for i in range(50):
+                    self.db.save_message(user_id=str(writer), chat_id='1', text='hi', external_id=str(i))
+                    self.db.create_or_get_chat_session(str(writer))
+                    self.db.set_chat_context(str(writer), {'last': i}, {})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(w,)) for w in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(errors, [])
+        count = self.db.conn.execute("SELECT count(*) AS c FROM chat_messages").fetchone()['c']
+        self.assertEqual(count, 400)
+
+
+class SlowSqliteDb(SqliteDb):
+    def __init__(self, file):
+        super().__init__(file)
+        self.writers = set()
+
+    def save_message(self, **kwargs):
+        self.writers.add(threading.current_thread().name)
+        time.sleep(0.05)  # a slow disk
+        super().save_message(**kwargs)
+
+
+class TestAsyncSqliteDb(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.folder.name, 'test.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_sessions(self):
+        db = AsyncSqliteDb.open(self.file)
+
+        async def run():
+            session = await CachedSession.from_cache(db, '1', '2')
+            session.set('command', 'image')
+            await session.persist(db)
+            return await CachedSession.from_cache(db, '1', '2')
+
+        session = asyncio.run(run())
+        db.close()
+        self.assertEqual(session.context, {'command': 'image'})
+
+    def test_doesnt_block_the_loop(self):
+        sync_db = SlowSqliteDb(self.file)
+        db = AsyncSqliteDb(sync_db, readers=4)
+        ticks = []
+
+        async def tick():
+            for _ in range(10):
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(
+                tick(),
+                *[db.save_message(user_id='1', chat_id='1', text='hi', external_id=str(i)) for i in range(4)],
+            )
+
+        asyncio.run(run())
+        db.close()
+
+        self.assertLess(max(b - a for a, b in zip(ticks, ticks[1:])), 0.04)
+        self.assertEqual(len(sync_db.writers), 1)  # writes are serialized on the writer thread
@@ -0,0 +1,75 @@
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from cliobot.bots import Session
+from cliobot.bots.telegram_bot import TelegramMessagingService
+from cliobot.db.message_log import BufferedMessageLog
+from cliobot.db.sharded_sqlite import ShardedSqliteDb, AsyncShardedSqliteDb
+
+
+class FakeBot:
+    created = 0
+
+    def __init__(self, token):
+        FakeBot.created += 1
+        self._initialized = False
+
+    async def initialize(self):
+        await asyncio.sleep(0)
+        self._initialized = True
+
+    async def send_message(self, **kwargs):
+        return SimpleNamespace(id='100')
+
+    async def send_photo(self, **kwargs):
+        return SimpleNamespace(id='101', photo=[SimpleNamespace(file_id='photo')])
+
+
+class TestTelegramMessagingService(unittest.TestCase):
+
+    @mock.patch('cliobot.bots.telegram_bot.Bot', FakeBot)
+    def test_one_bot_per_loop(self):
+        FakeBot.created = 0
+        service = TelegramMessagingService('123:abc', db=None)
+
+        async def run():
+            # separate tasks (eg every busy reply sent from the polling loop) share it
+            bots = await asyncio.gather(*[asyncio.create_task(service.initialize()) for _ in range(5)])
+            self.assertEqual(len(set(map(id, bots))), 1)
+            self.assertTrue(bots[0]._initialized)
+
+        asyncio.run(run())
+        self.assertEqual(FakeBot.created, 1)
+
+        asyncio.run(run())  # another loop gets its own
+        self.assertEqual(FakeBot.created, 2)
+
+    @mock.patch('cliobot.bots.telegram_bot.Bot', FakeBot)
+    def test_replies_on_the_users_shard(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sharded = ShardedSqliteDb(folder, shards=4)
+            service = TelegramMessagingService('123:abc', db=AsyncShardedSqliteDb(BufferedMessageLog(sharded), sharded))
+            # users that don't share a shard with the bot, or with each other
+            user, other = [u for u in map(str, range(100)) if sharded.shard_index(u) != sharded.shard_index('123')][:2]
+            while sharded.shard_index(other) == sharded.shard_index(user):
+                other = str(int(other) + 1)
+
+            async def run():
+                await service.send_message('hi', chat_id=user)  # a private chat
+                await service.send_media('-1', {'image': b'png'}, session=Session(other, '-1', {}, {}), text='hi')
+
+            asyncio.run(run())
+            service.db.close()
+
+            sharded = ShardedSqliteDb(folder, shards=4)
+            rows = {
+                r['external_id']: i
+                for i, shard in enumerate(sharded.shards)
+                for r in shard.conn.execute("SELECT external_id, external_user_id FROM chat_messages").fetchall()
+            }
+            sharded.close()
+
+        self.assertEqual(rows, {'100': sharded.shard_index(user), '101': sharded.shard_index(other)})
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from cliobot.bots import Message, MessagingService
+from cliobot.bots.ratelimit import ThrottledEditor
+from cliobot.commands import Model, BasePrompt, GenerationResults
+from cliobot.commands.text import Ask
+
+
+class RecordingMessagingService(MessagingService):
+    def __init__(self, failing_edits=()):
+        self.sent = []
+        self.edits = []
+        self.failing_edits = failing_edits
+
+    async def send_message(self, text, chat_id, context=None, reply_to_message_id=None, reply_buttons=None,
+                           buttons=None):
+        self.sent.append(text)
+        return SimpleNamespace(id=len(self.sent), chat_id=chat_id)
+
+    async def edit_message(self, message_id, chat_id, text, context=None, reply_buttons=None):
+        if text in self.failing_edits:
+            raise Exception('message is too long')
+        self.edits.append(text)
+
+
+class StreamingModel(Model):
+    streams = True
+
+    def __init__(self, deltas, delay=0.01):
+        super().__init__(BasePrompt)
+        self.deltas = deltas
+        self.delay = delay
+
+    async def stream(self, parsed):
+        for d in self.deltas:
+            await asyncio.sleep(self.delay)
+            yield d
+
+
+class TextModel(Model):
+    def __init__(self):
+        super().__init__(BasePrompt)
+
+    async def generate(self, parsed) -> GenerationResults:
+        return GenerationResults(texts=['all at once'])
+
+
+def ask(text):
+    return Message(
+        text=f'/ask {text}',
+        user_id='123',
+        chat_id='456',
+        message_id='789',
+        user={},
+    )
+
+
+class TestAsk(unittest.IsolatedAsyncioTestCase):
+
+    async def test_throttled_editor(self):
+        edits = []
+
+        async def edit(value):
+            edits.append(value)
+
+        editor = ThrottledEditor(edit, interval=0.1)
+        for i in range(10):
+            editor.update(i)
+            await asyncio.sleep(0.02)
+        await editor.close()
+
+        self.assertEqual(edits[0], 0)  # right away
+        self.assertEqual(edits[-1], 9)  # and the latest, once done
+        self.assertLess(len(edits), 5)  # merged in between
+
+    async def test_throttled_editor_discard(self):
+        edits = []
+
+        async def edit(value):
+            edits.append(value)
+
+        editor = ThrottledEditor(edit, interval=10)
+        editor.update(1)
+        await asyncio.sleep(0.01)
+        editor.update(2)  # pending for the next 10s
+        await asyncio.wait_for(editor.close(flush=False), 1)
+        self.assertEqual(edits, [1])
+
+    async def test_throttled_editor_last_edit_fails(self):
+        async def edit(value):
+            if value == 2:
+                raise Exception('message is too long')
+
+        editor = ThrottledEditor(edit, interval=0.01)
+        editor.update(1)
+        await asyncio.sleep(0.02)
+        editor.update(2)
+        with self.assertRaises(Exception):
+            await editor.close()
+        self.assertEqual(editor.shown, 1)
+
+    async def test_streaming(self):
+        bot = SimpleNamespace(messaging_service=RecordingMessagingService())
+        command = Ask({'llm': StreamingModel(['The ', 'meaning ', 'of ', 'life ', 'is ', '42'])}, None,
+                      edit_interval=0.025)
+
+        self.assertTrue(await command.process(ask('what is the meaning of life?'), SimpleNamespace(
+            context={}, preferences={}), bot))
+
+        self.assertEqual(bot.messaging_service.sent, ['Thinking...'])  # a single message, edited as it goes
+        self.assertGreater(len(bot.messaging_service.edits), 1)
+        self.assertLess(len(bot.messaging_service.edits), 6)
+        self.assertEqual(bot.messaging_service.edits[0], 'The ...')
+        self.assertEqual(bot.messaging_service.edits[-1], 'The meaning of life is 42')
+
+    async def test_streaming_last_edit_fails(self):
+        bot = SimpleNamespace(messaging_service=RecordingMessagingService(failing_edits=['The meaning of life is 42']))
+        command = Ask({'llm': StreamingModel(['The ', 'meaning ', 'of ', 'life ', 'is ', '42'])}, None,
+                      edit_interval=0.025)
+
+        self.assertTrue(await command.process(ask('what is the meaning of life?'), SimpleNamespace(
+            context={}, preferences={}), bot))
+
+        self.assertNotIn('The meaning of life is 42', bot.messaging_service.edits)
+        self.assertEqual(bot.messaging_service.sent, ['Thinking...', 'The meaning of life is 42'])
+
+    async def test_not_streaming(self):
+        bot = SimpleNamespace(messaging_service=RecordingMessagingService())
+        command = Ask({'llm': TextModel()}, None)
+
+        self.assertTrue(await command.process(ask('hi'), SimpleNamespace(context={}, preferences={}), bot))
+        self.assertEqual(bot.messaging_service.sent, ['all at once'])
+        self.assertEqual(bot.messaging_service.edits, [])
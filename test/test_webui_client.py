@@ -1,13 +1,21 @@
+import asyncio
+import tempfile
 import unittest
 
+from cliobot.bots import Session
 from cliobot.config import load_config
-from cliobot.utils import abs_path
-from cliobot.webui.client import WebuiClient, Txt2imgPrompt, save_image
+from cliobot.db import AsyncDatabaseAdapter
+from cliobot.db.inmemory import InMemoryDb
+from cliobot.db.utils import upload_asset
+from cliobot.storage import LocalStorage, AsyncStorageAdapter
+from cliobot.utils import abs_path, base64_to_bytes
+from cliobot.webui.client import WebuiClient, Txt2imgPrompt, save_image, Txt2img
+from fake_webui import FakeWebui, png
 
 
 def save_images(imgs):
     for img in imgs:
-        save_image(img.url, abs_path('tmp'))
+        save_image(img.data, abs_path('tmp'))
 
 
 class TestWebuiClient(unittest.IsolatedAsyncioTestCase):
@@ -31,3 +39,75 @@ class TestWebuiClient(unittest.IsolatedAsyncioTestCase):
         save_images(res.images)
         self.assertIs(len(res.texts), 0)
         self.assertIs(len(res.images), 2)
+
+
+class TestWebuiPreviews(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.webui = FakeWebui(step_time=0.05)
+        self.client = WebuiClient(await self.webui.start(), 'user:pass', progress_interval=0.05)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.webui.stop()
+        self.folder.cleanup()
+
+    def prompt(self, **kwargs):
+        return Txt2imgPrompt(command='image', prompt='a banana', model='sdxl', steps=10, **kwargs)
+
+    async def test_previews(self):
+        previews = []
+
+        async def on_preview(image, progress):
+            previews.append((image[:8], progress))
+
+        res = await Txt2img('sdxl', self.client).generate_with_previews(self.prompt(batchsize=2), on_preview)
+
+        self.assertEqual(len(res.images), 2)
+        self.assertGreater(len(previews), 3)
+        self.assertTrue(all(image == b'\x89PNG\r\n\x1a\n' for image, _ in previews))
+        self.assertEqual([p for _, p in previews], sorted(p for _, p in previews))
+
+    async def test_concurrent_jobs_skip_previews(self):
+        previews = []
+
+        async def on_preview(image, progress):
+            previews.append(progress)
+
+        await asyncio.gather(
+            self.client.txt2img(self.prompt(), on_preview=on_preview),
+            self.client.txt2img(self.prompt(), on_preview=on_preview),
+        )
+        self.assertEqual(previews, [])  # can't tell whose they'd be
+        self.assertEqual(self.client.in_flight, 0)
+
+    async def test_no_previews(self):
+        res = await self.client.txt2img(self.prompt())
+        self.assertEqual(len(res.images), 1)
+        self.assertEqual(self.webui.requests[0]['steps'], 10)
+
+    async def test_raw_output(self):
+        res = await self.client.txt2img(self.prompt())
+        image = res.images[0]
+        self.assertIsNone(image.url)  # nothing written to disk
+        self.assertEqual(image.data, base64_to_bytes(png((0, 0, 255))))  # byte for byte what webui sent
+        self.assertEqual(image.media(), image.data)
+
+        storage = LocalStorage(self.folder.name)
+        asset = await upload_asset(
+            session=Session('1', '2', {}, {}),
+            local_path=image.url,
+            data=image.data,
+            mimetype=image.mimetype,
+            db=AsyncDatabaseAdapter(InMemoryDb(), workers=0),
+            storage=AsyncStorageAdapter(storage),
+            folder='outputs',
+        )
+        self.assertTrue(asset['storage_path'].endswith('.png'))
+        self.assertEqual(storage.get_data(asset['storage_path']), image.data)
+
+        self.client.temp_dir = self.folder.name
+        res = await self.client.txt2img(self.prompt())
+        with open(res.images[0].url, 'rb') as f:
+            self.assertEqual(f.read(), res.images[0].data)